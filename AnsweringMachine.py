@@ -18,7 +18,7 @@ from sipsimple.configuration.settings import SIPSimpleSettings
 from sipsimple.util import ISOTimestamp
 
 from BlinkLogger import BlinkLogger
-from HistoryManager import ChatHistory
+from HistoryManager import ChatHistory, RecordingHistory
 from resources import Resources
 from util import allocate_autorelease_pool, format_identity_to_string
 
@@ -155,6 +155,7 @@ class AnsweringMachine(object):
         timestamp = str(ISOTimestamp.now())
 
         self.add_to_history(media_type, local_uri, remote_uri, direction, cpim_from, cpim_to, timestamp, message, status)
+        RecordingHistory().add_recording(filename, 'audio', local_uri, remote_uri, start_time=self.start_time, duration=duration)
 
     def add_to_history(self, media_type, local_uri, remote_uri, direction, cpim_from, cpim_to, timestamp, message, status):
         try:
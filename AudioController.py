@@ -62,8 +62,9 @@ import AudioSession
 from AnsweringMachine import AnsweringMachine
 from BlinkLogger import BlinkLogger
 from ContactListModel import BlinkPresenceContact
-from HistoryManager import ChatHistory
+from HistoryManager import ChatHistory, RecordingHistory
 from SessionInfoController import ice_candidates
+from StatisticsScheduler import STATISTICS_INTERVAL, StatisticsScheduler
 from MediaStream import MediaStream, STREAM_IDLE, STREAM_PROPOSING, STREAM_INCOMING, STREAM_WAITING_DNS_LOOKUP, STREAM_FAILED, STREAM_RINGING, STREAM_DISCONNECTING, STREAM_CANCELLING, STREAM_CONNECTED, STREAM_CONNECTING
 from MediaStream import STATE_CONNECTING, STATE_FAILED, STATE_DNS_FAILED, STATE_FINISHED
 from ZRTPAuthentication import ZRTPAuthentication
@@ -81,8 +82,6 @@ def loadImages():
 
 
 
-STATISTICS_INTERVAL = 1.0
-
 # For voice over IP over Ethernet, an RTP packet contains 54 bytes (or 432 bits) header. These 54 bytes consist of 14 bytes Ethernet header, 20 bytes IP header, 8 bytes UDP header and 12 bytes RTP header.
 RTP_PACKET_OVERHEAD = 54
 
@@ -113,7 +112,6 @@ class AudioController(MediaStream):
 
     recordingImage = 0
     audioEndTime = None
-    timer = None
     last_stats = None
     transfer_timer = None
     user_hanged_up = False
@@ -255,10 +253,7 @@ class AudioController(MediaStream):
         self.info.setStringValue_("")
         self.view.setDelegate_(self)
 
-        if not self.timer:
-            self.timer = NSTimer.timerWithTimeInterval_target_selector_userInfo_repeats_(1.0, self, "updateTimer:", None, True)
-            NSRunLoop.currentRunLoop().addTimer_forMode_(self.timer, NSRunLoopCommonModes)
-            NSRunLoop.currentRunLoop().addTimer_forMode_(self.timer, NSEventTrackingRunLoopMode)
+        StatisticsScheduler().add_observer(self, sample_statistics=True)
 
         loadImages()
 
@@ -287,9 +282,7 @@ class AudioController(MediaStream):
     def dealloc(self):
         self.notification_center = None
         self.stream = None
-        if self.timer is not None and self.timer.isValid():
-            self.timer.invalidate()
-        self.timer = None
+        StatisticsScheduler().remove_observer(self)
         self.hangup_reason = None
         self.view.removeFromSuperview()
         self.view.release()
@@ -566,8 +559,9 @@ class AudioController(MediaStream):
     def transferSession(self, target):
         self.sessionController.transferSession(target)
 
-    def updateTimer_(self, timer):
-        self.updateStatistics()
+    @objc.python_method
+    def _NH_BlinkStreamStatisticsDidUpdate(self, sender, data):
+        # statistics of the stream have already been sampled by the scheduler
         self.updateTileStatistics()
         settings = SIPSimpleSettings()
 
@@ -584,11 +578,12 @@ class AudioController(MediaStream):
                 if self.audioEndTime and (time.time() - self.audioEndTime > settings.gui.close_delay):
                     self.removeFromSession()
                     NSApp.delegate().contactsWindowController.finalizeAudioSession(self)
-                    if timer.isValid():
-                        timer.invalidate()
-                    
+                    StatisticsScheduler().remove_observer(self)
                     self.audioEndTime = None
 
+        if not self.isTileVisible():
+            return
+
         if self.stream and self.stream.recorder is not None and self.stream.recorder.is_active:
             if self.isConferencing:
                 self.segmentedConferenceButtons.setImage_forSegment_(RecordingImages[self.recordingImage], self.conference_record_segment)
@@ -870,13 +865,27 @@ class AudioController(MediaStream):
             self.previous_rx_packets = stats['rx']['packets']
             self.previous_tx_packets = stats['tx']['packets']
 
+            self.addQoSSample(rtt, jitter, loss_rx, loss_tx, self.statistics['rx_bytes'] * 8, self.statistics['tx_bytes'] * 8)
+
         self.last_stats = stats
 
+    @objc.python_method
+    def isTileVisible(self):
+        window = self.view.window()
+        return window is not None and window.isVisible() and not self.view.isHiddenOrHasHiddenAncestor()
+
     @objc.python_method
     def updateDuration(self):
         if not self.session:
             return
 
+        if not self.isTileVisible():
+            if self.session.start_time:
+                now = self.session.end_time or ISOTimestamp.now()
+                if now >= self.session.start_time:
+                    self.duration = (now - self.session.start_time).seconds
+            return
+
         if self.zrtp_show_verify_phrase:
             self.elapsed.setStringValue_(NSLocalizedString("Authentication String:", "Label"))
             return
@@ -963,7 +972,6 @@ class AudioController(MediaStream):
                 send_qos_notify = True
 
             if send_qos_notify:
-                self.info.setStringValue_(text)
                 if not self.audio_has_quality_issues:
                     self.notification_center.post_notification("AudioSessionHasQualityIssues", sender=self, data=qos_data)
                 self.audio_has_quality_issues = True
@@ -971,10 +979,12 @@ class AudioController(MediaStream):
                 if self.audio_has_quality_issues:
                     self.notification_center.post_notification("AudioSessionQualityRestored", sender=self, data=qos_data)
                 self.audio_has_quality_issues = False
-                self.info.setStringValue_("")
-
+                text = ""
         else:
-            self.info.setStringValue_("")
+            text = ""
+
+        if self.isTileVisible():
+            self.info.setStringValue_(text)
 
     def menuWillOpen_(self, menu):
         if menu == self.encryptionMenu:
@@ -1315,6 +1325,7 @@ class AudioController(MediaStream):
         timestamp = str(ISOTimestamp.now())
 
         self.add_to_history(media_type, local_uri, remote_uri, direction, cpim_from, cpim_to, timestamp, message, status)
+        RecordingHistory().add_recording(filename, 'audio', local_uri, remote_uri)
 
     @objc.python_method
     def updateTransferProgress(self, msg):
@@ -1517,6 +1528,7 @@ class AudioController(MediaStream):
 
     @objc.python_method
     def _NH_MediaStreamWillEnd(self, sender, data):
+        self.saveQoSSamples()
         self.transfer_in_progress = False
         self.ice_negotiation_status = None
         self.holdByLocal = False
@@ -1,10 +1,14 @@
 # Copyright (C) 2009-2011 AG Projects. See LICENSE for details.
 #
 
+import atexit
 import datetime
+import gzip
 import os
+import queue
 import sys
 import threading
+import time
 
 from AppKit import NSApp
 
@@ -14,21 +18,279 @@ from application.python.queue import EventQueue
 from application.python.types import Singleton
 from application.system import makedirs
 from sipsimple.configuration.settings import SIPSimpleSettings
+from sipsimple.threading import run_in_thread
 from zope.interface import implementer
 from pprint import pformat
 
 
+# log lines are handed over to a writer thread which writes them in batches
+LOG_QUEUE_SIZE = 20000          # lines kept in memory, newer lines are dropped when full
+LOG_BATCH_SIZE = 1000           # lines taken from the queue for one write
+LOG_FLUSH_INTERVAL = 1.0        # seconds after which written lines are flushed to disk
+LOG_FLUSH_SIZE = 256 * 1024     # bytes written since the last flush that force a new flush
+LOG_SYNC_TIMEOUT = 2.0          # seconds to wait for a synchronous write or a drain
+
+
+class LogFileWriter(object, metaclass=Singleton):
+    """Writes log files from a dedicated thread.
+
+    Loggers only put the formatted lines in a bounded queue. The writer
+    thread takes whatever has accumulated, writes it with one call per
+    file and flushes the files once LOG_FLUSH_INTERVAL has passed or
+    LOG_FLUSH_SIZE bytes are waiting. A line written with sync=True is
+    flushed, and fsynced when fsync_on_error is set, before write()
+    returns, so errors logged right before a crash are not lost.
+
+    Files that grow past max_file_size bytes or that are older than
+    max_file_age seconds are renamed to <name>.<timestamp><ext>, then
+    compressed and pruned to the newest max_rotated_files segments on
+    the file-io thread. A limit of 0 disables that check.
+    """
+
+    def __init__(self):
+        self.fsync_on_error = False
+        self.max_file_size = 0
+        self.max_file_age = 0
+        self.max_rotated_files = 0
+        self.compress_rotated_files = True
+        self._queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+        self._files = {}
+        self._file_info = {}
+        self._failed_files = set()
+        self._dropped = 0
+        self._thread = None
+        self._lock = threading.Lock()
+        # drain the queue when the interpreter exits, the thread is a daemon
+        atexit.register(self.stop)
+
+    def write(self, filename, text, sync=False):
+        self._start()
+        done = threading.Event() if sync else None
+        try:
+            self._queue.put_nowait(('write', filename, text, done))
+        except queue.Full:
+            # never block the caller because the disk can't keep up
+            self._dropped += 1
+            return
+        if done is not None:
+            done.wait(LOG_SYNC_TIMEOUT)
+
+    def flush(self):
+        """Wait until all the lines queued so far are written to disk"""
+        if self._thread is not None:
+            self._command('flush')
+
+    def close(self, filename):
+        """Write the lines queued so far for filename and close the file"""
+        if self._thread is not None:
+            self._command('close', filename)
+
+    def stop(self):
+        with self._lock:
+            thread = self._thread
+            self._thread = None
+        if thread is None:
+            return
+        done = threading.Event()
+        try:
+            self._queue.put(('stop', None, None, done), timeout=LOG_SYNC_TIMEOUT)
+        except queue.Full:
+            return
+        thread.join(LOG_SYNC_TIMEOUT)
+
+    def _start(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='Log writer', daemon=True)
+                self._thread.start()
+
+    def _command(self, command, filename=None):
+        done = threading.Event()
+        try:
+            self._queue.put((command, filename, None, done), timeout=LOG_SYNC_TIMEOUT)
+        except queue.Full:
+            return
+        done.wait(LOG_SYNC_TIMEOUT)
+
+    def _run(self):
+        pending = {}
+        pending_sync = set()
+        unflushed = 0
+        last_flush = time.monotonic()
+
+        while True:
+            timeout = max(0, LOG_FLUSH_INTERVAL - (time.monotonic() - last_flush))
+            try:
+                batch = [self._queue.get(timeout=timeout)]
+            except queue.Empty:
+                batch = []
+            while len(batch) < LOG_BATCH_SIZE:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            events = []
+            stop = False
+            flush = False
+            for command, filename, text, done in batch:
+                if done is not None:
+                    events.append(done)
+                if command == 'write':
+                    pending.setdefault(filename, []).append(text)
+                    unflushed += len(text)
+                    if done is not None:
+                        pending_sync.add(filename)
+                elif command == 'close':
+                    self._write_pending(pending)
+                    self._close_file(filename)
+                elif command == 'flush':
+                    flush = True
+                elif command == 'stop':
+                    stop = True
+
+            self._write_pending(pending)
+
+            if self._dropped:
+                print('Log writer could not keep up, dropped %d lines' % self._dropped)
+                self._dropped = 0
+
+            if flush or stop or pending_sync or unflushed >= LOG_FLUSH_SIZE or time.monotonic() - last_flush >= LOG_FLUSH_INTERVAL:
+                for filename, file in list(self._files.items()):
+                    try:
+                        file.flush()
+                        if filename in pending_sync and self.fsync_on_error:
+                            os.fsync(file.fileno())
+                    except Exception:
+                        self._close_file(filename)
+                pending_sync.clear()
+                unflushed = 0
+                last_flush = time.monotonic()
+
+            for done in events:
+                done.set()
+
+            if stop:
+                for filename in list(self._files):
+                    self._close_file(filename)
+                break
+
+    def _write_pending(self, pending):
+        for filename, lines in pending.items():
+            data = ''.join(lines)
+            if self._must_rotate(filename, len(data)):
+                self._rotate_file(filename)
+            file = self._open_file(filename)
+            if file is None:
+                continue
+            try:
+                file.write(data)
+            except Exception:
+                # reopen on the next write, the file may have been moved away
+                self._close_file(filename)
+            else:
+                self._file_info[filename][0] += len(data)
+        pending.clear()
+
+    def _open_file(self, filename):
+        file = self._files.get(filename)
+        if file is None:
+            try:
+                file = self._files[filename] = open(filename, 'a', buffering=LOG_FLUSH_SIZE)
+                st = os.fstat(file.fileno())
+            except Exception as e:
+                self._files.pop(filename, None)
+                if filename not in self._failed_files:
+                    print("failed to open log file '%s': %s" % (filename, e))
+                    self._failed_files.add(filename)
+                return None
+            else:
+                self._failed_files.discard(filename)
+                # size and creation time of the current segment
+                self._file_info[filename] = [st.st_size, getattr(st, 'st_birthtime', st.st_mtime)]
+        return file
+
+    def _close_file(self, filename):
+        file = self._files.pop(filename, None)
+        self._file_info.pop(filename, None)
+        if file is not None:
+            try:
+                file.close()
+            except Exception:
+                pass
+
+    def _must_rotate(self, filename, length):
+        if filename not in self._files:
+            if not os.path.exists(filename) or self._open_file(filename) is None:
+                return False
+        size, created = self._file_info[filename]
+        if not size:
+            return False
+        if self.max_file_size and size + length > self.max_file_size:
+            return True
+        if self.max_file_age and time.time() - created > self.max_file_age:
+            return True
+        return False
+
+    def _rotate_file(self, filename):
+        self._close_file(filename)
+        base, ext = os.path.splitext(filename)
+        rotated_filename = '%s.%s%s' % (base, datetime.datetime.now().strftime('%Y%m%d-%H%M%S-%f'), ext)
+        try:
+            os.rename(filename, rotated_filename)
+        except OSError as e:
+            print("failed to rotate log file '%s': %s" % (filename, e))
+            return
+        self._archive_rotated_file(filename, rotated_filename, self.compress_rotated_files, self.max_rotated_files)
+
+    @run_in_thread('file-io')
+    def _archive_rotated_file(self, filename, rotated_filename, compress, max_rotated_files):
+        if compress:
+            try:
+                with open(rotated_filename, 'rb') as source, gzip.open(rotated_filename + '.gz', 'wb') as destination:
+                    while True:
+                        chunk = source.read(1024 * 1024)
+                        if not chunk:
+                            break
+                        destination.write(chunk)
+            except Exception as e:
+                print("failed to compress log file '%s': %s" % (rotated_filename, e))
+                try:
+                    os.remove(rotated_filename + '.gz')
+                except OSError:
+                    pass
+            else:
+                os.remove(rotated_filename)
+
+        if not max_rotated_files:
+            return
+
+        # rotated names sort by time as the timestamp comes right after the base name
+        directory = os.path.dirname(filename)
+        base, ext = os.path.splitext(os.path.basename(filename))
+        try:
+            segments = sorted(name for name in os.listdir(directory) if name.startswith(base + '.') and (name.endswith(ext) or name.endswith(ext + '.gz')) and name != base + ext)
+        except OSError:
+            return
+        for name in segments[:-max_rotated_files]:
+            try:
+                os.remove(os.path.join(directory, name))
+            except OSError:
+                pass
+
+
 class BlinkLogger(object, metaclass=Singleton):
     def __init__(self):
         self.gui_backlog = []
         self.gui_logger = self.backlog_keeper
         # logs/activity.txt mirrors every line that goes to the in-app
         # Activity panel. Always on (no setting gate) — when the GUI
-        # thread is stuck the panel can't redraw, but the file write
-        # happens off the GUI thread, so the on-disk log keeps growing
+        # thread is stuck the panel can't redraw, but the file is written
+        # by the LogFileWriter thread, so the on-disk log keeps growing
         # right up to the moment the process actually freezes. That's
         # how we pinpoint where it got stuck after a beachball.
-        self._activity_file = None
         self._activity_filename = None
         self._activity_lock = threading.Lock()
 
@@ -71,43 +333,33 @@ class BlinkLogger(object, metaclass=Singleton):
     def _write_activity(self, level, message):
         """Append a single line to logs/activity.txt.
 
-        Lazily opens the file from settings.logs.directory the first
-        time it's called (skipping silently if SIPSimpleSettings or the
-        filesystem isn't ready yet, so we never block app startup on
-        log-file errors). Holds a short lock around the write so calls
-        from worker / DB / GUI threads serialise without corrupting the
-        line stream. On write errors we close and reset so the next
-        call can retry — useful when the log directory has been moved
-        out from under us.
+        Lazily works out the file name from settings.logs.directory the
+        first time it's called (skipping silently if SIPSimpleSettings or
+        the filesystem isn't ready yet, so we never block app startup on
+        log-file errors). The line itself is queued to the LogFileWriter
+        thread; errors are written synchronously so that they are on disk
+        before we return, which is what matters for crash forensics.
         """
         try:
             text = message if isinstance(message, str) else str(message)
         except Exception:
             return
 
-        with self._activity_lock:
-            if self._activity_file is None:
-                try:
-                    settings = SIPSimpleSettings()
-                    log_directory = settings.logs.directory.normalized
-                    makedirs(log_directory)
-                    self._activity_filename = os.path.join(log_directory, 'activity.txt')
-                    self._activity_file = open(self._activity_filename, 'a')
-                except Exception:
-                    # Settings not loaded yet, or filesystem unhappy.
-                    # Don't latch an error flag — keep retrying on the
-                    # next call so the file opens as soon as possible.
-                    return
-            try:
-                ts = datetime.datetime.now()
-                self._activity_file.write('%s [%s] %s\n' % (ts, level, text))
-                self._activity_file.flush()
-            except Exception:
-                try:
-                    self._activity_file.close()
-                except Exception:
-                    pass
-                self._activity_file = None
+        if self._activity_filename is None:
+            with self._activity_lock:
+                if self._activity_filename is None:
+                    try:
+                        settings = SIPSimpleSettings()
+                        log_directory = settings.logs.directory.normalized
+                        makedirs(log_directory)
+                        self._activity_filename = os.path.join(log_directory, 'activity.txt')
+                    except Exception:
+                        # Settings not loaded yet, or filesystem unhappy.
+                        # Don't latch an error flag — keep retrying on the
+                        # next call so the file opens as soon as possible.
+                        return
+
+        LogFileWriter().write(self._activity_filename, '%s [%s] %s\n' % (datetime.datetime.now(), level, text), sync=level == 'ERROR')
 
     def log_error(self, message):
         print(message)
@@ -161,28 +413,28 @@ class FileLogger(object, metaclass=Singleton):
         self.msrp_level = msrp_level
 
         self._siptrace_filename = None
-        self._siptrace_file = None
-        self._siptrace_error = False
         self._siptrace_start_time = None
         self._siptrace_packet_count = 0
 
         self._msrptrace_filename = None
-        self._msrptrace_file = None
-        self._msrptrace_error = False
-
         self._pjsiptrace_filename = None
-        self._pjsiptrace_file = None
-        self._pjsiptrace_error = False
-
         self._notifications_filename = None
-        self._notifications_file = None
-        self._notifications_error = False
 
         self._log_directory_error = False
 
+        # settings are cached here and refreshed when they change, rather
+        # than looked up for every traced packet
+        self._trace_sip = False
+        self._trace_msrp = False
+        self._trace_pjsip = False
+        self._trace_notifications = False
+
+        self._process_name = os.path.basename(sys.argv[0]).rstrip('.py')
         self._event_queue = None
 
     def start(self):
+        self._load_settings()
+
         # try to create the log directory
         try:
             self._init_log_directory()
@@ -202,25 +454,8 @@ class FileLogger(object, metaclass=Singleton):
         self._event_queue.stop()
         self._event_queue.join()
 
-        # close sip trace file
-        if self._siptrace_file is not None:
-            self._siptrace_file.close()
-            self._siptrace_file = None
-
-        # close msrp trace file
-        if self._msrptrace_file is not None:
-            self._msrptrace_file.close()
-            self._msrptrace_file = None
-
-        # close pjsip trace file
-        if self._pjsiptrace_file is not None:
-            self._pjsiptrace_file.close()
-            self._pjsiptrace_file = None
-
-        # close notifications trace file
-        if self._notifications_file is not None:
-            self._notifications_file.close()
-            self._notifications_file = None
+        # write what is still queued and close the trace files
+        self._close_log_files()
 
         # unregister from receiving notifications
         notification_center = NotificationCenter()
@@ -230,7 +465,6 @@ class FileLogger(object, metaclass=Singleton):
         self._event_queue.put(notification)
 
     def _process_notification(self, notification):
-        settings = SIPSimpleSettings()
         handler = getattr(self, '_NH_%s' % notification.name, None)
         if handler is not None:
             handler(notification)
@@ -239,19 +473,9 @@ class FileLogger(object, metaclass=Singleton):
         if handler is not None:
             handler(notification)
 
-        if notification.name not in ('SIPEngineLog', 'SIPEngineSIPTrace') and settings.logs.trace_notifications and settings.logs.trace_notifications_to_file:
-            try:
-                self._init_log_file('notifications')
-            except Exception:
-                pass
-            else:
-                message = 'Notification name=%s sender=%s data=%s' % (notification.name, notification.sender, pformat(notification.data))
-                try:
-                    self._notifications_file.write('%s: %s\n' % (datetime.datetime.now(), message))
-                    self._notifications_file.flush()
-                except Exception as e:
-                    pass
-                    #print('Debug write message failed: %s' % message)
+        if notification.name not in ('SIPEngineLog', 'SIPEngineSIPTrace') and self._trace_notifications:
+            message = 'Notification name=%s sender=%s data=%s' % (notification.name, notification.sender, pformat(notification.data))
+            self._write_log('notifications', '%s: %s\n' % (datetime.datetime.now(), message))
 
 
     # notification handlers
@@ -260,31 +484,29 @@ class FileLogger(object, metaclass=Singleton):
     def _NH_CFGSettingsObjectDidChange(self, notification):
         settings = SIPSimpleSettings()
         if notification.sender is settings:
+            if any(key.startswith('logs.') for key in notification.data.modified):
+                self._load_settings()
             if 'logs.directory' in notification.data.modified:
-                # sip trace
-                if self._siptrace_file is not None:
-                    self._siptrace_file.close()
-                    self._siptrace_file = None
-                # pjsip trace
-                if self._pjsiptrace_file is not None:
-                    self._pjsiptrace_file.close()
-                    self._pjsiptrace_file = None
-                # notifications trace
-                if self._notifications_file is not None:
-                    self._notifications_file.close()
-                    self._notifications_file = None
+                # trace files are opened again in the new directory
+                self._close_log_files()
+                self._siptrace_filename = None
+                self._msrptrace_filename = None
+                self._pjsiptrace_filename = None
+                self._notifications_filename = None
                 # try to create the log directory
                 try:
                     self._init_log_directory()
                 except Exception:
                     pass
 
+    def _NH_BlinkWillTerminate(self, notification):
+        LogFileWriter().flush()
+
     # log handlers
     #
 
     def _LH_SIPEngineSIPTrace(self, notification):
-        settings = SIPSimpleSettings()
-        if not settings.logs.trace_sip or not settings.logs.trace_sip_to_file:
+        if not self._trace_sip:
             return
         if self._siptrace_start_time is None:
             self._siptrace_start_time = notification.datetime
@@ -299,30 +521,16 @@ class FileLogger(object, metaclass=Singleton):
         buf.append(data)
         buf.append('--')
         message = '\n'.join(buf)
-        try:
-            self._init_log_file('siptrace')
-        except Exception:
-            pass
-        else:
-            self._siptrace_file.write('%s [%s %d]: %s\n' % (notification.datetime, os.path.basename(sys.argv[0]).rstrip('.py'), os.getpid(), message))
-            self._siptrace_file.flush()
+        self._write_log('siptrace', '%s [%s %d]: %s\n' % (notification.datetime, self._process_name, os.getpid(), message))
 
     def _LH_SIPEngineLog(self, notification):
-        settings = SIPSimpleSettings()
-        if not settings.logs.trace_pjsip or not settings.logs.trace_pjsip_to_file:
+        if not self._trace_pjsip:
             return
         message = "(%(level)d) %(message)s" % notification.data.__dict__
-        try:
-            self._init_log_file('pjsiptrace')
-        except Exception:
-            pass
-        else:
-            self._pjsiptrace_file.write('[%s %d] %s\n' % (os.path.basename(sys.argv[0]).rstrip('.py'), os.getpid(), message))
-            self._pjsiptrace_file.flush()
+        self._write_log('pjsiptrace', '[%s %d] %s\n' % (self._process_name, os.getpid(), message))
 
     def _LH_DNSLookupTrace(self, notification):
-        settings = SIPSimpleSettings()
-        if not settings.logs.trace_sip or not settings.logs.trace_sip_to_file:
+        if not self._trace_sip:
             return
         message = 'DNS lookup %(query_type)s %(query_name)s' % notification.data.__dict__
         if notification.data.error is None:
@@ -340,17 +548,10 @@ class FileLogger(object, metaclass=Singleton):
                            dns.resolver.NoNameservers: 'no DNS name servers could be reached',
                            dns.resolver.Timeout: 'no DNS response received, the query has timed out'}
             message += ' failed: %s' % message_map.get(notification.data.error.__class__, '')
-        try:
-            self._init_log_file('siptrace')
-        except Exception:
-            pass
-        else:
-            self._siptrace_file.write('%s [%s %d]: %s\n' % (notification.datetime, os.path.basename(sys.argv[0]).rstrip('.py'), os.getpid(), message))
-            self._siptrace_file.flush()
+        self._write_log('siptrace', '%s [%s %d]: %s\n' % (notification.datetime, self._process_name, os.getpid(), message))
 
     def _LH_MSRPTransportTrace(self, notification):
-        settings = SIPSimpleSettings()
-        if not settings.logs.trace_msrp or not settings.logs.trace_msrp_to_file:
+        if not self._trace_msrp:
             return
         arrow = {'incoming': '<--', 'outgoing': '-->'}[notification.data.direction]
         local_address = notification.sender.getHost()
@@ -359,32 +560,32 @@ class FileLogger(object, metaclass=Singleton):
         remote_address = '%s:%d' % (remote_address.host, remote_address.port)
         data = notification.data.data.decode() if isinstance(notification.data.data, bytes) else notification.data.data
         message = '%s %s %s\n' % (local_address, arrow, remote_address) + data
-        try:
-            self._init_log_file('msrptrace')
-        except Exception:
-            pass
-        else:
-            self._msrptrace_file.write('%s [%s %d]: %s\n' % (notification.datetime, os.path.basename(sys.argv[0]).rstrip('.py'), os.getpid(), message))
-            self._msrptrace_file.flush()
+        self._write_log('msrptrace', '%s [%s %d]: %s\n' % (notification.datetime, self._process_name, os.getpid(), message))
 
     def _LH_MSRPLibraryLog(self, notification):
-        settings = SIPSimpleSettings()
-        if not settings.logs.trace_msrp or not settings.logs.trace_msrp_to_file:
+        if not self._trace_msrp:
             return
         if notification.data.level < self.msrp_level:
             return
         message = '%s%s' % (notification.data.level, notification.data.message)
-        try:
-            self._init_log_file('msrptrace')
-        except Exception:
-            pass
-        else:
-            self._msrptrace_file.write('%s [%s %d]: %s\n' % (notification.datetime, os.path.basename(sys.argv[0]).rstrip('.py'), os.getpid(), message))
-            self._msrptrace_file.flush()
+        self._write_log('msrptrace', '%s [%s %d]: %s\n' % (notification.datetime, self._process_name, os.getpid(), message))
 
     # private methods
     #
 
+    def _load_settings(self):
+        settings = SIPSimpleSettings()
+        self._trace_sip = settings.logs.trace_sip and settings.logs.trace_sip_to_file
+        self._trace_msrp = settings.logs.trace_msrp and settings.logs.trace_msrp_to_file
+        self._trace_pjsip = settings.logs.trace_pjsip and settings.logs.trace_pjsip_to_file
+        self._trace_notifications = settings.logs.trace_notifications and settings.logs.trace_notifications_to_file
+        writer = LogFileWriter()
+        writer.fsync_on_error = settings.logs.fsync_on_error
+        writer.max_file_size = settings.logs.max_file_size * 1024 * 1024
+        writer.max_file_age = settings.logs.max_file_age * 86400
+        writer.max_rotated_files = settings.logs.max_rotated_files
+        writer.compress_rotated_files = settings.logs.compress_rotated_files
+
     def _init_log_directory(self):
         settings = SIPSimpleSettings()
         log_directory = settings.logs.directory.normalized
@@ -394,44 +595,38 @@ class FileLogger(object, metaclass=Singleton):
             if not self._log_directory_error:
                 print("failed to create logs directory '%s': %s" % (log_directory, e))
                 self._log_directory_error = True
-            self._siptrace_error = True
-            self._pjsiptrace_error = True
-            self._notifications_error = True
             raise
         else:
             self._log_directory_error = False
             # sip trace
             if self._siptrace_filename is None:
                 self._siptrace_filename = os.path.join(log_directory, 'sip_trace.txt')
-                self._siptrace_error = False
 
             # msrp trace
             if self._msrptrace_filename is None:
                 self._msrptrace_filename = os.path.join(log_directory, 'msrp_trace.txt')
-                self._msrptrace_error = False
 
             # pjsip trace
             if self._pjsiptrace_filename is None:
                 self._pjsiptrace_filename = os.path.join(log_directory, 'pjsip_trace.txt')
-                self._pjsiptrace_error = False
 
             # notifications trace
             if self._notifications_filename is None:
                 self._notifications_filename = os.path.join(log_directory, 'notifications_trace.txt')
-                self._notifications_error = False
 
-    def _init_log_file(self, type):
-        if getattr(self, '_%s_file' % type) is None:
-            self._init_log_directory()
-            filename = getattr(self, '_%s_filename' % type)
+    def _write_log(self, type, text):
+        filename = getattr(self, '_%s_filename' % type)
+        if filename is None:
             try:
-                setattr(self, '_%s_file' % type, open(filename, 'a'))
-            except Exception as e:
-                if not getattr(self, '_%s_error' % type):
-                    print("failed to create log file '%s': %s" % (filename, e))
-                    setattr(self, '_%s_error' % type, True)
-                raise
-            else:
-                setattr(self, '_%s_error' % type, False)
-
+                self._init_log_directory()
+            except Exception:
+                return
+            filename = getattr(self, '_%s_filename' % type)
+        LogFileWriter().write(filename, text)
 
+    def _close_log_files(self):
+        writer = LogFileWriter()
+        for type in ('siptrace', 'msrptrace', 'pjsiptrace', 'notifications'):
+            filename = getattr(self, '_%s_filename' % type)
+            if filename is not None:
+                writer.close(filename)
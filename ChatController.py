@@ -8,9 +8,7 @@ from AppKit import (NSApp,
                     NSEventTrackingRunLoopMode,
                     NSFontAttributeName,
                     NSHTMLTextDocumentType,
-                    NSImageCompressionFactor,
                     NSInformationalRequest,
-                    NSJPEGFileType,
                     NSPNGFileType,
                     NSOffState,
                     NSUTF8StringEncoding,
@@ -22,7 +20,6 @@ from AppKit import (NSApp,
                     NSWindowBelow)
 
 from Foundation import (NSAttributedString,
-                        NSBitmapImageRep,
                         NSBundle,
                         NSColor,
                         NSData,
@@ -58,9 +55,7 @@ from Quartz import (CGDisplayBounds,
                     CGWindowListCopyWindowInfo,
                     CGWindowListCreateImage,
                     kCGWindowImageBoundsIgnoreFraming,
-                    kCGWindowListExcludeDesktopElements,
-                    kCGWindowListOptionIncludingWindow,
-                    kCGWindowNumber)
+                    kCGWindowListOptionIncludingWindow)
 import base64
 import datetime
 import hashlib
@@ -90,6 +85,7 @@ from sipsimple.account import BonjourAccount
 from sipsimple.core import SDPAttribute, SIPURI
 from sipsimple.configuration.settings import SIPSimpleSettings
 from sipsimple.streams.msrp.chat import ChatStream, ChatStreamError, ChatIdentity, SMPStatus
+from sipsimple.threading import run_in_thread
 from sipsimple.threading.green import run_in_green_thread
 from sipsimple.application import SIPApplication
 from sipsimple.util import ISOTimestamp
@@ -108,6 +104,7 @@ from PhotoPicker import PhotoPicker
 from SIPManager import SIPManager
 from SmileyManager import SmileyManager
 from ScreensharingPreviewPanel import ScreensharingPreviewPanel
+from ScreenSharingTiles import FULL_FRAME_CONTENT_TYPE, TILES_CONTENT_TYPE, ScreenSharingEncoder, ScreenSharingCompositor, ScreenSharingRateController
 from resources import ApplicationData
 from util import allocate_autorelease_pool, format_identity_to_string, format_size, html2txt, image_file_extension_pattern, sipuri_components_from_string, run_in_gui_thread
 
@@ -126,6 +123,7 @@ kUIOptionDisableSessionTerminate = 1 << 5
 kUIOptionDisableHide = 1 << 6
 
 MAX_MESSAGE_LENGTH = 16*1024
+REMOTE_SCREEN_IDLE_TIME = 10    # seconds without frames after which a key frame starts a new share
 
 TOOLBAR_SCREENSHARING_MENU_REQUEST_REMOTE = 201
 TOOLBAR_SCREENSHARING_MENU_OFFER_LOCAL = 202
@@ -149,7 +147,7 @@ kCGWindowImageDefault = 0
 
 class BlinkChatStream(ChatStream):
     priority = ChatStream.priority + 1
-    accept_wrapped_types = ['text/*', 'image/*', 'application/im-iscomposing+xml', 'application/blink-icon', 'application/blink-zrtp-sas', 'application/blink-logging-status']
+    accept_wrapped_types = ['text/*', 'image/*', 'application/im-iscomposing+xml', 'application/blink-icon', 'application/blink-zrtp-sas', 'application/blink-logging-status', FULL_FRAME_CONTENT_TYPE, TILES_CONTENT_TYPE]
 
     def _create_local_media(self, uri_path):
         local_media = super(BlinkChatStream, self)._create_local_media(uri_path)
@@ -184,6 +182,9 @@ class ChatController(MediaStream):
     history = None
     handler = None
     screensharing_handler = None
+    remote_screen = None
+    remote_screen_preview = None
+    remote_screen_time = 0
 
     session_was_active = False
 
@@ -239,6 +240,8 @@ class ChatController(MediaStream):
         self.notification_center.discard_observer(self, sender=self.stream)
         self.media_started = False
         self.stream = BlinkChatStream()
+        self.remote_screen = None
+        self.remote_screen_preview = None
         self.databaseLoggingButton.setHidden_(True)
         self.databaseLoggingButton.setState_(NSOffState)
 
@@ -748,9 +751,13 @@ class ChatController(MediaStream):
                 self.zoom_period_label = NSLocalizedString("Displaying all messages", "Label")
                 self.chatViewController.setHandleScrolling_(False)
 
-            results = self.history.get_messages(remote_uri=remote_uris, media_type=('chat', 'sms'), after_date=after_date, count=200, search_text=self.chatViewController.search_text)
+            results = self.history.get_messages(remote_uri=remote_uris, media_type=('chat', 'sms'), after_date=after_date, count=200, search_text=self.chatViewController.search_text, orderBy='rank' if self.chatViewController.search_text else 'time')
         else:
-            results = self.history.get_messages(remote_uri=remote_uris, media_type=('chat', 'sms'), count=self.showHistoryEntries, search_text=self.chatViewController.search_text)
+            results = self.history.get_messages(remote_uri=remote_uris, media_type=('chat', 'sms'), count=self.showHistoryEntries, search_text=self.chatViewController.search_text, orderBy='rank' if self.chatViewController.search_text else 'time')
+
+        if self.chatViewController.search_text:
+            # the most relevant matches are kept, but the conversation is shown in order
+            results = sorted(results, key=lambda row: row.time, reverse=True)
 
         # build a list of previously failed messages
         last_failed_messages=[]
@@ -812,6 +819,22 @@ class ChatController(MediaStream):
                 else:
                     self.chatViewController.scrolling_zoom_factor = 7
 
+        if self.chatViewController:
+            self.chatViewController.beginBatchRendering()
+        try:
+            self._render_history_entries(messages)
+        finally:
+            if self.chatViewController:
+                self.chatViewController.endBatchRendering()
+
+        if scrollToMessageId is not None:
+            self.chatViewController.scrollToId(scrollToMessageId)
+
+        self.chatViewController.loadingProgressIndicator.stopAnimation_(None)
+        self.chatViewController.loadingTextIndicator.setStringValue_("")
+
+    @objc.python_method
+    def _render_history_entries(self, messages):
         call_id = None
         seen_sms = {}
         last_media_type = None
@@ -866,12 +889,6 @@ class ChatController(MediaStream):
             call_id = message.sip_callid
             last_media_type = 'chat' if message.media_type == 'chat' else 'sms'
 
-        if scrollToMessageId is not None:
-            self.chatViewController.scrollToId(scrollToMessageId)
-
-        self.chatViewController.loadingProgressIndicator.stopAnimation_(None)
-        self.chatViewController.loadingTextIndicator.setStringValue_("")
-
     @objc.python_method
     @run_in_gui_thread
     def resend_last_failed_message(self, messages):
@@ -1536,6 +1553,33 @@ class ChatController(MediaStream):
             self.revalidateToolbar()
             BlinkLogger().log_info('Update chat controller %s -> %s' % (self.local_uri, self.remote_uri))
 
+    @objc.python_method
+    def renderRemoteScreen(self, message):
+        if self.remote_screen is None:
+            self.remote_screen = ScreenSharingCompositor()
+        try:
+            if message.content_type == TILES_CONTENT_TYPE:
+                image = self.remote_screen.add_tiles(message.content)
+            else:
+                image = self.remote_screen.add_keyframe(message.content)
+        except (KeyError, TypeError, ValueError) as e:
+            self.sessionController.log_info('Failed to decode remote screen: %s' % e)
+            return
+
+        if image is None:
+            return
+
+        now = time.time()
+        if message.content_type != TILES_CONTENT_TYPE and now - self.remote_screen_time > REMOTE_SCREEN_IDLE_TIME:
+            self.remote_screen_preview = None
+        self.remote_screen_time = now
+
+        # one panel per share, it stays closed once the user closed it
+        if self.remote_screen_preview is None:
+            self.remote_screen_preview = ScreensharingPreviewPanel(image)
+        else:
+            self.remote_screen_preview.updateImage_(image)
+
     @objc.python_method
     def _NH_ChatStreamGotMessage(self, stream, data):
         message = data.message
@@ -1566,6 +1610,10 @@ class ChatController(MediaStream):
 
             return
 
+        elif message.content_type in (FULL_FRAME_CONTENT_TYPE, TILES_CONTENT_TYPE):
+            self.renderRemoteScreen(message)
+            return
+
         # render images sent inline
         def filename_generator(name):
             yield name
@@ -2333,10 +2381,15 @@ class ConferenceScreenSharingHandler(object):
     delegate = None
     connected = False
     screenSharingTimer = None
+    encoder = None
+    rate_controller = None
     stream = None
     rect = None
     frames = 0.0
     last_time = None
+    last_frame_time = 0
+    pending_message_id = None
+    pending_message_time = None
     current_framerate = None
     log_first_frame = False
     show_preview = False
@@ -2364,7 +2417,10 @@ class ConferenceScreenSharingHandler(object):
         self.width = self.quality_settings[self.quality]['width']
         self.max_width = self.quality_settings[self.quality]['max_width']
         self.framerate = self.quality_settings[self.quality]['framerate']
+        self.rate_controller = ScreenSharingRateController(self.compression, self.framerate)
         self.log_first_frame = True
+        if self.encoder is not None:
+            self.encoder.request_keyframe()
         NSUserDefaults.standardUserDefaults().setValue_forKey_(self.quality, "ScreensharingQuality")
 
     def setShowPreview(self):
@@ -2378,6 +2434,7 @@ class ConferenceScreenSharingHandler(object):
         self.log_first_frame = True
         self.connected = True
         self.stream = stream
+        self.encoder = ScreenSharingEncoder()
         quality = NSUserDefaults.standardUserDefaults().stringForKey_("ScreensharingQuality")
         self.setQuality(quality)
         self.last_time = time.time()
@@ -2394,6 +2451,7 @@ class ConferenceScreenSharingHandler(object):
         self.log_first_frame = False
         self.connected = False
         self.may_send = True
+        self.pending_message_id = None
         self.frames = 0
         self.last_time = None
         self.show_preview = False
@@ -2406,91 +2464,132 @@ class ConferenceScreenSharingHandler(object):
             NotificationCenter().discard_observer(self, sender=self.stream)
             self.stream = None
 
+    @property
+    def delta_allowed(self):
+        # only peers that explicitly accept tiles can composite them, wildcards do not count
+        try:
+            return TILES_CONTENT_TYPE in self.stream.remote_accept_wrapped_types
+        except (AttributeError, TypeError):
+            return False
+
     @run_in_gui_thread
     def handle_notification(self, notification):
         handler = getattr(self, '_NH_%s' % notification.name, Null)
         handler(notification.sender, notification.data)
 
     def _NH_ChatStreamDidDeliverMessage(self, sender, data):
+        if data.message_id != self.pending_message_id:
+            return
+        self.pending_message_id = None
         self.may_send = True
         self.last_snapshot_time = time.time()
+        if self.rate_controller.delivered(self.last_snapshot_time - self.pending_message_time):
+            self.delegate.sessionController.log_debug('Screen sharing adapted to %.2f frames/s with %.2f compression' % (self.rate_controller.framerate, self.rate_controller.compression))
 
     def _NH_ChatStreamDidNotDeliverMessage(self, sender, data):
+        if data.message_id != self.pending_message_id:
+            return
+        self.pending_message_id = None
         self.may_send = True
         self.last_snapshot_time = time.time()
+        if self.rate_controller.failed():
+            self.delegate.sessionController.log_debug('Screen sharing adapted to %.2f frames/s with %.2f compression' % (self.rate_controller.framerate, self.rate_controller.compression))
+        # the remote compositor is missing a frame, send the next one in full
+        if self.encoder is not None:
+            self.encoder.request_keyframe()
 
     @allocate_autorelease_pool
     def sendScreenshotTimer_(self, timer):
-        def screenSharingWindowExists(id):
-            listOptions = kCGWindowListExcludeDesktopElements
-            windowList = CGWindowListCopyWindowInfo(listOptions, kCGNullWindowID)
-            i = 0
-            while i < windowList.count():
-                wob = windowList.objectAtIndex_(i)
-                if wob.objectForKey_(kCGWindowNumber) == id:
-                    del windowList
-                    return True
-                i += 1
-            return False
-
-        dt = time.time() - self.last_time
+        now = time.time()
+        dt = now - self.last_time
         if dt >= 1:
             self.current_framerate = self.frames / dt
             self.frames = 0.0
-            self.last_time = time.time()
-
-        if self.may_send and dt >= 1/self.framerate:
-            self.frames = self.frames + 1
-            rect = CGDisplayBounds(CGMainDisplayID())
-            if self.window_id:
-                if screenSharingWindowExists(self.window_id):
-                    image = CGWindowListCreateImage(rect, kCGWindowListOptionIncludingWindow, self.window_id, kCGWindowImageBoundsIgnoreFraming)
-                else:
-                    self.window_id = None
-                    if self.delegate:
-                        self.delegate.toggleScreensharingWithConferenceParticipants()
-                    else:
-                        self.setDisconnected()
-                    return
-            else:
-                image = CGWindowListCreateImage(rect, kCGWindowListOptionOnScreenOnly, kCGNullWindowID, kCGWindowImageDefault)
-            if CGImageGetWidth(image) <= 1:
-                return
-            image = NSImage.alloc().initWithCGImage_size_(image, NSZeroSize)
-            originalSize = image.size()
-            if self.width is not None and originalSize.width > self.width:
-                resizeWidth = self.width
-                resizeHeight = self.width * originalSize.height/originalSize.width
-                scaled_image = NSImage.alloc().initWithSize_(NSMakeSize(resizeWidth, resizeHeight))
-                scaled_image.lockFocus()
-                image.drawInRect_fromRect_operation_fraction_(NSMakeRect(0, 0, resizeWidth, resizeHeight), NSMakeRect(0, 0, originalSize.width, originalSize.height), NSCompositeSourceOver, 1.0)
-                scaled_image.unlockFocus()
-                image = scaled_image
-
-            if self.width is None and self.max_width is not None and originalSize.width > self.max_width:
-                resizeWidth = self.max_width
-                resizeHeight = self.max_width * originalSize.height/originalSize.width
-                scaled_image = NSImage.alloc().initWithSize_(NSMakeSize(resizeWidth, resizeHeight))
-                scaled_image.lockFocus()
-                image.drawInRect_fromRect_operation_fraction_(NSMakeRect(0, 0, resizeWidth, resizeHeight), NSMakeRect(0, 0, originalSize.width, originalSize.height), NSCompositeSourceOver, 1.0)
-                scaled_image.unlockFocus()
-                image = scaled_image
-
-            if self.show_preview:
-                ScreensharingPreviewPanel(image)
-                self.show_preview = False
-
-            jpg_data = NSBitmapImageRep.alloc().initWithData_(image.TIFFRepresentation()).representationUsingType_properties_(NSJPEGFileType, {NSImageCompressionFactor: self.compression})
-            # this also works and produces the same result, but it's not documented anywhere
-            #jpeg = image.IKIPJPEGDataWithMaxSize_compression_(image.size().width, self.compression)
-
-            data = base64.b64encode(jpg_data.bytes().tobytes()).decode()
-
-            if self.log_first_frame:
-                self.delegate.sessionController.log_info('Sending %s bytes with %dx%d screen' % (format_size(len(data)), image.size().width, image.size().height))
-                self.log_first_frame = False
-            self.delegate.sessionController.log_debug('Sending %s bytes with %dx%d screen' % (format_size(len(data)), image.size().width, image.size().height))
-            self.may_send = False
-            if self.stream:
-                self.stream.send_message(data, content_type='application/blink-screensharing', timestamp=ISOTimestamp.now())
+            self.last_time = now
+
+        # while a frame is being encoded or delivered newer frames are dropped instead of queued
+        if not self.may_send or now - self.last_frame_time < 1 / self.rate_controller.framerate:
+            return
+
+        self.may_send = False
+        self.last_frame_time = now
+        self.frames = self.frames + 1
+        show_preview, self.show_preview = self.show_preview, False
+        self.encodeFrame(self.stream, self.encoder, self.window_id, self.width, self.max_width, self.rate_controller.compression, self.delta_allowed, show_preview)
+
+    @run_in_thread('screen-sharing')
+    @allocate_autorelease_pool
+    def encodeFrame(self, stream, encoder, window_id, width, max_width, compression, delta, show_preview):
+        try:
+            frame, size = self._encodeFrame(stream, encoder, window_id, width, max_width, compression, delta, show_preview)
+        except Exception as e:
+            BlinkLogger().log_error('Failed to encode screen sharing frame: %s' % str(e))
+            frame, size = None, None
+            # the encoder may have kept part of the failed frame as reference
+            if encoder is not None:
+                encoder.request_keyframe()
+        # always called, otherwise no other frame would be sent
+        self.sendFrame(stream, frame, size)
+
+    def _encodeFrame(self, stream, encoder, window_id, width, max_width, compression, delta, show_preview):
+        rect = CGDisplayBounds(CGMainDisplayID())
+        if window_id:
+            if not CGWindowListCopyWindowInfo(kCGWindowListOptionIncludingWindow, window_id):
+                self.windowWasClosed(stream, window_id)
+                return None, None
+            image = CGWindowListCreateImage(rect, kCGWindowListOptionIncludingWindow, window_id, kCGWindowImageBoundsIgnoreFraming)
+        else:
+            image = CGWindowListCreateImage(rect, kCGWindowListOptionOnScreenOnly, kCGNullWindowID, kCGWindowImageDefault)
+        if image is None or CGImageGetWidth(image) <= 1:
+            return None, None
+        image = NSImage.alloc().initWithCGImage_size_(image, NSZeroSize)
+        originalSize = image.size()
+        if width is None and max_width is not None:
+            width = max_width
+        if width is not None and originalSize.width > width:
+            resizeWidth = width
+            resizeHeight = width * originalSize.height/originalSize.width
+            scaled_image = NSImage.alloc().initWithSize_(NSMakeSize(resizeWidth, resizeHeight))
+            scaled_image.lockFocus()
+            image.drawInRect_fromRect_operation_fraction_(NSMakeRect(0, 0, resizeWidth, resizeHeight), NSMakeRect(0, 0, originalSize.width, originalSize.height), NSCompositeSourceOver, 1.0)
+            scaled_image.unlockFocus()
+            image = scaled_image
+
+        if show_preview:
+            self.showPreview(image)
+
+        return encoder.encode(image, compression, delta=delta), image.size()
+
+    @run_in_gui_thread
+    def showPreview(self, image):
+        ScreensharingPreviewPanel(image)
+
+    @run_in_gui_thread
+    def windowWasClosed(self, stream, window_id):
+        if stream is not self.stream or window_id != self.window_id:
+            return
+        self.window_id = None
+        if self.delegate:
+            self.delegate.toggleScreensharingWithConferenceParticipants()
+        else:
+            self.setDisconnected()
+
+    @run_in_gui_thread
+    def sendFrame(self, stream, frame, size=None):
+        if stream is None or stream is not self.stream:
+            # sharing stopped or restarted while the frame was being encoded
+            return
+        if frame is None:
+            # nothing changed on screen since the previous frame or it could not be encoded
+            self.may_send = True
+            return
+
+        content_type, data = frame
+        frame_type = 'changed tiles' if content_type == TILES_CONTENT_TYPE else 'full frame'
+        if self.log_first_frame:
+            self.delegate.sessionController.log_info('Sending %s bytes with %dx%d screen (%s)' % (format_size(len(data)), size.width, size.height, frame_type))
+            self.log_first_frame = False
+        self.delegate.sessionController.log_debug('Sending %s bytes with %dx%d screen (%s)' % (format_size(len(data)), size.width, size.height, frame_type))
+        self.pending_message_time = time.time()
+        self.pending_message_id = self.stream.send_message(data, content_type=content_type, timestamp=ISOTimestamp.now())
 
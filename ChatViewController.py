@@ -7,6 +7,7 @@ __all__ = ['ChatInputTextView', 'ChatViewController', 'processHTMLText',
 import calendar
 import html
 import datetime
+import functools
 import json
 import objc
 import os
@@ -16,7 +17,7 @@ import urllib.request, urllib.parse, urllib.error
 import uuid
 
 from AppKit import NSCommandKeyMask, NSDragOperationNone, NSDragOperationCopy, NSFilenamesPboardType, NSShiftKeyMask, NSTextDidChangeNotification, NSOnState
-from Foundation import NSArray, NSDate, NSLocalizedString, NSMakeRange, NSNotificationCenter, NSObject, NSTextView, NSTimer, NSURL, NSURLRequest, NSWorkspace
+from Foundation import NSArray, NSDate, NSLocalizedString, NSMakeRange, NSNotificationCenter, NSObject, NSRunLoop, NSRunLoopCommonModes, NSTextView, NSTimer, NSURL, NSURLRequest, NSWorkspace
 from WebKit import WebView, WebViewProgressFinishedNotification, WebActionOriginalURLKey
 
 from application.notification import NotificationCenter
@@ -41,6 +42,14 @@ TYPING_IDLE_TIMEOUT = 5
 # if user is typing, is-composing notifications will be sent in the following interval
 TYPING_NOTIFY_INTERVAL = 30
 
+# number of rendered message bodies kept by processHTMLText
+HTML_TEXT_CACHE_SIZE = 1024
+
+# messages shown within this interval are sent to the web view in one batch
+RENDER_COALESCE_INTERVAL = 0.05
+
+_js_escape_pattern = re.compile(r'\\(.)', re.S)
+
 
 _url_pattern = re.compile("((?:http://|https://|sip:|sips:)[^ )<>\r\n]+)")
 _url_pattern_exact = re.compile("^((?:http://|https://|sip:|sips:)[^ )<>\r\n]+)$")
@@ -62,6 +71,12 @@ def processHTMLText(content='', usesmileys=True, is_html=False):
     except UnicodeDecodeError:
         return ''
 
+    return _processHTMLText(content, bool(usesmileys), bool(is_html))
+
+
+@functools.lru_cache(maxsize=HTML_TEXT_CACHE_SIZE)
+def _processHTMLText(content, usesmileys, is_html):
+    # cached, toggling smileys or updating a message renders the same bodies again
     if is_html:
         content = urlify(content)
         content = content.replace('\n', '')
@@ -82,9 +97,14 @@ def processHTMLText(content='', usesmileys=True, is_html=False):
             if usesmileys:
                 token = SmileyManager().subst_smileys_html(token)
         result.append(token)
-        content = "".join(result)
 
-    return content
+    return "".join(result)
+
+
+def unescape_js_string(content):
+    # processHTMLText returns the body of a double quoted JavaScript string,
+    # remove the escaping when the text is passed through JSON instead
+    return _js_escape_pattern.sub(r'\1', content)
 
 
 class ChatInputTextView(NSTextView):
@@ -231,6 +251,17 @@ class ChatViewController(NSObject):
 
     scrollingTimer = None
 
+    # entries waiting to be handed over to renderMessages() in the web view
+    render_entries = None
+    renderTimer = None
+    render_batch_depth = 0
+    render_queue_pending = False
+
+    # latest position of live location bubbles waiting to be redrawn
+    location_updates = None
+    location_update_times = None
+    locationUpdateTimer = None
+
     handle_scrolling = True
     scrolling_zoom_factor = 0
 
@@ -262,7 +293,9 @@ class ChatViewController(NSObject):
             self.inputText.setOwner(self)
             NSNotificationCenter.defaultCenter().addObserver_selector_name_object_(self, "textDidChange:", NSTextDidChangeNotification, self.inputText)
 
-        self.messageQueue = []
+        self.render_entries = []
+        self.location_updates = {}
+        self.location_update_times = {}
 
     @objc.IBAction
     def showRelatedMessages_(self, sender):
@@ -473,10 +506,12 @@ class ChatViewController(NSObject):
     @objc.python_method
     @run_in_gui_thread
     def clear(self):
+        self.render_entries = []
+        self.location_updates = {}
+        self.location_update_times = {}
         if self.finishedLoading:
+            self.render_queue_pending = False
             self.executeJavaScript("clear()")
-        else:
-            self.messageQueue = []
 
     @objc.python_method
     @run_in_gui_thread
@@ -494,13 +529,8 @@ class ChatViewController(NSObject):
             else:
                 timestamp = time.strftime("%H:%M", time.localtime(calendar.timegm(timestamp.utctimetuple())))
 
-        is_error = 1 if is_error else "null"
-        script = """renderSystemMessage('%s', "%s", "%s", %s)""" % (msgid, processHTMLText(content), timestamp, is_error)
-
-        if self.finishedLoading:
-            self.executeJavaScript(script)
-        else:
-            self.messageQueue.append(script)
+        entry = {'type': 'system', 'msgid': msgid, 'text': unescape_js_string(processHTMLText(content)), 'timestamp': str(timestamp), 'is_error': bool(is_error)}
+        self.renderEntry(entry)
 
     @objc.python_method
     @run_in_gui_thread
@@ -518,9 +548,7 @@ class ChatViewController(NSObject):
                 lock_icon_path = Resources.get('locked-green.png' if encryption == 'verified' else 'locked-red.png')
 
         if self.last_sender == sender:
-            icon_path = "null"
-        else:
-            icon_path = "'%s'" % icon_path
+            icon_path = None
 
         self.last_sender = sender
 
@@ -537,8 +565,6 @@ class ChatViewController(NSObject):
             displayed_timestamp = time.strftime("%H:%M", time.localtime(calendar.timegm(timestamp.utctimetuple())))
 
         content = processHTMLText(content, self.expandSmileys, is_html)
-        private = 1 if is_private else "null"
-        before = 1 if before else "null"
 
         if is_private and recipient:
             label = NSLocalizedString("Private message to %s", "Label") % html.escape(recipient) if direction == 'outgoing' else NSLocalizedString("Private message from %s", "Label") % html.escape(sender)
@@ -549,17 +575,14 @@ class ChatViewController(NSObject):
                 label = html.escape(self.account.display_name or self.account.id) if sender is None else html.escape(sender)
 
         try:
-            script = """renderMessage('%s', '%s', '%s', %s, "%s", '%s', '%s', %s, '%s', '%s', %s)""" % (msgid, direction, label, icon_path, content, displayed_timestamp, state, private, lock_icon_path, self.previous_msgid, before)
-        except UnicodeDecodeError:
-            script = """renderMessage('%s', '%s', '%s', %s, "%s", '%s', '%s', %s, '%s', '%s', %s)""" % (msgid, direction, label, icon_path, content.decode('utf-8'), displayed_timestamp, state, private, lock_icon_path, self.previous_msgid, before)
+            entry = {'type': 'message', 'msgid': msgid, 'direction': direction, 'sender': label, 'icon': icon_path, 'text': unescape_js_string(content),
+                     'timestamp': displayed_timestamp, 'state': state, 'private': bool(is_private), 'lock': lock_icon_path,
+                     'previous_msgid': self.previous_msgid, 'before': bool(before)}
         except Exception as e:
             self.delegate.showSystemMessage("Chat message id %s rendering error: %s" % (msgid, e), ISOTimestamp.now(), True)
             return
 
-        if self.finishedLoading:
-            self.executeJavaScript(script)
-        else:
-            self.messageQueue.append(script)
+        self.renderEntry(entry)
 
         if hasattr(self.delegate, "chatViewDidGetNewMessage_"):
             self.delegate.chatViewDidGetNewMessage_(self)
@@ -585,9 +608,7 @@ class ChatViewController(NSObject):
                 lock_icon_path = Resources.get('locked-green.png' if encryption == 'verified' else 'locked-red.png')
 
         if self.last_sender == sender:
-            icon_path = "null"
-        else:
-            icon_path = "'%s'" % icon_path
+            icon_path = None
 
         self.last_sender = sender
 
@@ -606,23 +627,22 @@ class ChatViewController(NSObject):
         else:
             displayed_timestamp = time.strftime("%H:%M", time.localtime(calendar.timegm(timestamp.utctimetuple())))
 
-        before_arg = 1 if before else "null"
-        # accuracy may be missing — pass "null" so the JS branch hides
-        # the ±metres annotation entirely. lat/lng are emitted as plain
-        # numbers (no quotes) to keep them as JavaScript Numbers in the
-        # arg list; JS toFixed(5) is what we use for the display label.
+        # accuracy may be missing — pass None so the JS branch hides the
+        # ±metres annotation entirely. lat/lng stay numbers so that they
+        # arrive as JavaScript Numbers; JS toFixed(5) is what we use for
+        # the display label.
         try:
-            lat_arg = '%.7f' % float(latitude)
-            lng_arg = '%.7f' % float(longitude)
+            lat_arg = round(float(latitude), 7)
+            lng_arg = round(float(longitude), 7)
         except (TypeError, ValueError):
             return
         if accuracy is None:
-            acc_arg = 'null'
+            acc_arg = None
         else:
             try:
-                acc_arg = '%.1f' % float(accuracy)
+                acc_arg = round(float(accuracy), 1)
             except (TypeError, ValueError):
-                acc_arg = 'null'
+                acc_arg = None
 
         # Outer label / sender row
         if hasattr(self.delegate, "sessionController"):
@@ -631,20 +651,11 @@ class ChatViewController(NSObject):
             label_source = self.account.display_name or self.account.id
         label = html.escape(label_source) if sender is None else html.escape(sender)
 
-        # JSON-encode the maps_url so any embedded quotes / specials are
-        # safely passed through into the JavaScript string literal.
-        maps_url_js = json.dumps(maps_url)
-
-        script = (
-            """renderLocationMessage('%s', '%s', '%s', %s, %s, %s, %s, %s, '%s', '%s', '%s', '%s', %s)"""
-            % (msgid, direction, label, icon_path, lat_arg, lng_arg, acc_arg, maps_url_js,
-               displayed_timestamp, state, lock_icon_path, self.previous_msgid, before_arg)
-        )
-
-        if self.finishedLoading:
-            self.executeJavaScript(script)
-        else:
-            self.messageQueue.append(script)
+        entry = {'type': 'location', 'msgid': msgid, 'direction': direction, 'sender': label, 'icon': icon_path,
+                 'lat': lat_arg, 'lng': lng_arg, 'accuracy': acc_arg, 'maps_url': maps_url,
+                 'timestamp': displayed_timestamp, 'state': state, 'lock': lock_icon_path,
+                 'previous_msgid': self.previous_msgid, 'before': bool(before)}
+        self.renderEntry(entry)
 
         if hasattr(self.delegate, "chatViewDidGetNewMessage_"):
             self.delegate.chatViewDidGetNewMessage_(self)
@@ -656,28 +667,54 @@ class ChatViewController(NSObject):
     def updateLocationMessage(self, msgid, latitude, longitude, accuracy):
         """Re-render an existing location bubble with new coordinates.
 
-        Mirrors showLocationMessage's argument formatting (numeric literals
-        for lat/lng, ``null`` for missing accuracy) so the JS function
-        receives proper Numbers and not stringly-typed values.
+        Mirrors showLocationMessage's argument formatting (numbers for
+        lat/lng, ``null`` for missing accuracy) so the JS function receives
+        proper Numbers and not stringly-typed values. The update is queued
+        behind any bubble still waiting to be rendered. A bubble is redrawn
+        at most once per chat.location_update_interval, updates arriving in
+        between only replace the position that will be drawn next.
         """
         try:
-            lat_arg = '%.7f' % float(latitude)
-            lng_arg = '%.7f' % float(longitude)
+            lat_arg = round(float(latitude), 7)
+            lng_arg = round(float(longitude), 7)
         except (TypeError, ValueError):
             return
         if accuracy is None:
-            acc_arg = 'null'
+            acc_arg = None
         else:
             try:
-                acc_arg = '%.1f' % float(accuracy)
+                acc_arg = round(float(accuracy), 1)
             except (TypeError, ValueError):
-                acc_arg = 'null'
+                acc_arg = None
 
-        script = "updateLocationMessage('%s', %s, %s, %s)" % (msgid, lat_arg, lng_arg, acc_arg)
-        if self.finishedLoading:
-            self.executeJavaScript(script)
-        else:
-            self.messageQueue.append(script)
+        self.location_updates[msgid] = {'type': 'location_update', 'msgid': msgid, 'lat': lat_arg, 'lng': lng_arg, 'accuracy': acc_arg}
+        self.flushLocationUpdates()
+
+    @objc.python_method
+    def flushLocationUpdates(self):
+        now = time.time()
+        next_update = None
+        interval = SIPSimpleSettings().chat.location_update_interval
+        # shares that have not moved for a while render their next tick right away anyway
+        for msgid, last_update in list(self.location_update_times.items()):
+            if now - last_update >= interval and msgid not in self.location_updates:
+                del self.location_update_times[msgid]
+        for msgid, entry in list(self.location_updates.items()):
+            due = self.location_update_times.get(msgid, 0) + interval
+            if due <= now:
+                del self.location_updates[msgid]
+                self.location_update_times[msgid] = now
+                self.renderEntry(entry)
+            elif next_update is None or due < next_update:
+                next_update = due
+
+        if next_update is not None and self.locationUpdateTimer is None:
+            self.locationUpdateTimer = NSTimer.timerWithTimeInterval_target_selector_userInfo_repeats_(next_update - now, self, "locationUpdateTimerFired:", None, False)
+            NSRunLoop.currentRunLoop().addTimer_forMode_(self.locationUpdateTimer, NSRunLoopCommonModes)
+
+    def locationUpdateTimerFired_(self, timer):
+        self.locationUpdateTimer = None
+        self.flushLocationUpdates()
 
     @objc.python_method
     def toggleSmileys(self, expandSmileys):
@@ -690,6 +727,15 @@ class ChatViewController(NSObject):
         script = """updateMessageBodyContent('%s', "%s")""" % (msgid, content)
         self.executeJavaScript(script)
 
+    @objc.python_method
+    def updateMessageContent(self, msgid, content):
+        # replace the body of a rendered message, like a PGP message whose decryption finished after it was rendered
+        for entry in self.rendered_messages:
+            if entry.msgid == msgid:
+                entry.content = content
+                self.updateMessage(msgid, content, entry.is_html, self.expandSmileys)
+                break
+
     @objc.python_method
     def toggleCollaborationEditor(self):
         if self.editorVisible:
@@ -740,8 +786,61 @@ class ChatViewController(NSObject):
         script = """scrollToId("%s")""" % id
         self.executeJavaScript(script)
 
+    @objc.python_method
+    def renderEntry(self, entry):
+        # Entries are coalesced and sent to the web view with one script
+        # call, either when the current batch ends or when the timer fires
+        self.render_entries.append(entry)
+        if not self.finishedLoading or self.render_batch_depth:
+            return
+        if self.renderTimer is None:
+            self.renderTimer = NSTimer.timerWithTimeInterval_target_selector_userInfo_repeats_(RENDER_COALESCE_INTERVAL, self, "renderTimerFired:", None, False)
+            NSRunLoop.currentRunLoop().addTimer_forMode_(self.renderTimer, NSRunLoopCommonModes)
+
+    def renderTimerFired_(self, timer):
+        self.renderTimer = None
+        self.flushRenderEntries()
+
+    @objc.python_method
+    def beginBatchRendering(self):
+        self.render_batch_depth += 1
+
+    @objc.python_method
+    def endBatchRendering(self):
+        self.render_batch_depth = max(0, self.render_batch_depth - 1)
+        if not self.render_batch_depth and self.finishedLoading:
+            self.flushRenderEntries()
+
+    @objc.python_method
+    def flushRenderEntries(self):
+        if self.renderTimer is not None:
+            self.renderTimer.invalidate()
+            self.renderTimer = None
+
+        if not self.render_entries:
+            return
+
+        entries = self.render_entries
+        self.render_entries = []
+        try:
+            script = "renderMessages(%s)" % json.dumps(entries)
+        except (TypeError, ValueError) as e:
+            BlinkLogger().log_error("Error rendering %d chat messages: %s" % (len(entries), e))
+            return
+
+        # the web view inserts the messages within a time budget per frame
+        # and returns how many are still queued on its side
+        pending = self.outputView.stringByEvaluatingJavaScriptFromString_(script)
+        self.render_queue_pending = pending not in (None, '', '0')
+
     @objc.python_method
     def executeJavaScript(self, script):
+        if self.finishedLoading:
+            self.flushRenderEntries()
+            if self.render_queue_pending:
+                # scripts may refer to messages that are not yet in the page
+                script = "drainRenderQueue(); " + script
+                self.render_queue_pending = False
         self.outputView.stringByEvaluatingJavaScriptFromString_(script)
 
     def webviewFinishedLoading_(self, notification):
@@ -750,9 +849,8 @@ class ChatViewController(NSObject):
         if hasattr(self.delegate, "chatViewDidLoad_"):
             self.delegate.chatViewDidLoad_(self)
 
-        for script in self.messageQueue:
-            self.outputView.stringByEvaluatingJavaScriptFromString_(script)
-        self.messageQueue = []
+        if not self.render_batch_depth:
+            self.flushRenderEntries()
 
     def webView_contextMenuItemsForElement_defaultMenuItems_(self, sender, element, defaultItems):
         for item in defaultItems:
@@ -864,6 +962,15 @@ class ChatViewController(NSObject):
         # memory clean up
         self.rendered_messages = set()
         self.pending_messages = {}
+        self.render_entries = []
+        if self.renderTimer:
+            self.renderTimer.invalidate()
+            self.renderTimer = None
+        self.location_updates = {}
+        self.location_update_times = {}
+        if self.locationUpdateTimer:
+            self.locationUpdateTimer.invalidate()
+            self.locationUpdateTimer = None
         self.view.removeFromSuperview()
         self.inputText.setOwner(None)
         self.inputText.removeFromSuperview()
@@ -878,6 +985,9 @@ class ChatViewController(NSObject):
         if self.scrollingTimer:
             self.scrollingTimer.invalidate()
             self.scrollingTimer = None
+        if self.renderTimer:
+            self.renderTimer.invalidate()
+            self.renderTimer = None
         NSNotificationCenter.defaultCenter().removeObserver_(self)
         objc.super(ChatViewController, self).dealloc()
 
@@ -76,7 +76,7 @@ import os
 import re
 import pickle
 import unicodedata
-import urllib.request, urllib.parse, urllib.error
+import urllib.parse
 import uuid
 import sys
 import time
@@ -93,11 +93,9 @@ from sipsimple.configuration.settings import SIPSimpleSettings
 from sipsimple.core import FrozenSIPURI, SIPURI, SIPCoreError
 from sipsimple.addressbook import AddressbookManager, Contact, ContactURI, Group, unique_id, Policy
 from sipsimple.account import Account, AccountManager, BonjourAccount
-from sipsimple.payloads import prescontent
 from sipsimple.threading.green import run_in_green_thread
 from sipsimple.threading import run_in_thread
 from sipsimple.util import ISOTimestamp
-from twisted.internet.error import ConnectionLost
 from zope.interface import implementer
 
 from ContactController import AddContactController, EditContactController
@@ -109,6 +107,7 @@ from SIPManager import MWIData
 from MergeContactController import MergeContactController
 from VirtualGroups import VirtualGroupsManager, VirtualGroup
 from PresencePublisher import on_the_phone_activity
+from PresenceIconFetcher import ICON_MODIFIED, IconCache, PresenceIconFetcher
 from resources import ApplicationData, Resources
 from util import allocate_autorelease_pool, format_date, format_uri_type, is_anonymous, sipuri_components_from_string, sip_prefix_pattern, strip_addressbook_special_characters, run_in_gui_thread, utc_to_local
 
@@ -328,7 +327,7 @@ class PresenceContactAvatar(Avatar):
 
     def save(self):
         data = self.icon.TIFFRepresentationUsingCompression_factor_(NSTIFFCompressionLZW, 1)
-        data.writeToFile_atomically_(self.path, False)
+        data.writeToFile_atomically_(self.path, True)
 
     def delete(self):
         unlink(self.path)
@@ -451,16 +450,7 @@ class BlinkContact(NSObject):
 
     @objc.python_method
     def split_uri(self, uri):
-        if isinstance(uri, (FrozenSIPURI, SIPURI)):
-            return (uri.user or '', uri.host or '')
-        elif '@' in uri:
-            uri = sip_prefix_pattern.sub("", uri)
-            user, _, host = uri.partition("@")
-            host = host.partition(":")[0]
-            return (user, host)
-        else:
-            user = uri.partition(":")[0] if uri else ''
-            return (user, '')
+        return split_uri(uri)
 
     @objc.python_method
     def matchesURI(self, uri, exact_match=False):
@@ -1345,78 +1335,53 @@ class BlinkPresenceContact(BlinkContact):
         NotificationCenter().post_notification("BlinkContactPresenceHasChanged", sender=self)
 
     @objc.python_method
-    @run_in_green_thread
     def _process_icon(self, icon_url):
         contact = self.contact
         if not contact:
             # Contact may have been destroyed before this function runs
             return
 
-        icon_path = PresenceContactAvatar.path_for_contact(contact)
-        if getattr(contact, 'updating_remote_icon', False):
-            return
-
-        contact.updating_remote_icon = True
-
         if not icon_url:
             # Don't remove icon, keep last used one around
-            contact.updating_remote_icon = False
             return
 
+        icon_path = PresenceContactAvatar.path_for_contact(contact)
         url, token, icon_hash = icon_url.partition('blink-icon')
         if token:
             # Fast path
-            if contact.icon_info and contact.icon_info.etag == icon_hash:
-                contact.updating_remote_icon = False
+            if contact.icon_info and contact.icon_info.etag == icon_hash and os.path.exists(icon_path):
                 return
-        # Need to download
-        headers = {'If-None-Match': contact.icon_info.etag} if contact.icon_info.etag and os.path.exists(icon_path) else {}
-        req = urllib.request.Request(icon_url, headers=headers)
-        try:
-            BlinkLogger().log_debug('Getting icon for %s %s' % (self.uri, icon_url))
-            response = urllib.request.urlopen(req)
-            content = response.read()
-            info = response.info()
-            content_type = info.get('content-type')
-            etag = info.get('etag')
-        except (ConnectionLost, urllib.error.HTTPError, urllib.error.URLError, TimeoutError) as e:
-            if e.status != 304:
-                BlinkLogger().log_error('Failed to get icon for %s: %s' % (self.uri, str(e)))
-            contact.updating_remote_icon = False
+
+        if getattr(contact, 'updating_remote_icon', False):
             return
-        else:
-            if etag.startswith('W/'):
-                etag = etag[2:]
-            etag = etag.replace('\"', '')
 
-        if content_type == prescontent.PresenceContentDocument.content_type:
-            try:
-                pres_content = prescontent.PresenceContentDocument.parse(content)
-                data = pres_content.data.value
-                content = base64.b64decode(data)
-            except Exception as e:
-                BlinkLogger().log_error('Failed to decode the icon: %s' % str(e))
-                contact.updating_remote_icon = False
-                return
+        contact.updating_remote_icon = True
+        etag = contact.icon_info.etag if contact.icon_info.etag and os.path.exists(icon_path) else None
+        BlinkLogger().log_debug('Getting icon for %s %s' % (self.uri, icon_url))
+        PresenceIconFetcher().fetch(icon_url, etag, self._icon_fetched, expected_etag=icon_hash if token else None)
+
+    @objc.python_method
+    @run_in_gui_thread
+    def _icon_fetched(self, icon_url, result, etag, digest):
+        contact = self.contact
+        if not contact:
+            return
+
+        contact.updating_remote_icon = False
+        if result != ICON_MODIFIED:
+            return
 
-        # Check if the icon can be loaded in a NSImage
         try:
-            icon = NSImage.alloc().initWithData_(NSData.alloc().initWithBytes_length_(content, len(content)))
-        except Exception as e:
-            BlinkLogger().log_error('Failed to process the icon for %s: %s' % (self.uri, str(e)))
-            contact.updating_remote_icon = False
+            IconCache().copy(digest, PresenceContactAvatar.path_for_contact(contact))
+        except OSError as e:
+            BlinkLogger().log_error('Failed to save icon for %s: %s' % (self.uri, str(e)))
             return
-        del icon
-                
-        with open(icon_path, 'wb') as f:
-            f.write(content)
 
         BlinkLogger().log_info('Saved icon for %s with etag %s' % (self.uri, etag))
 
         contact.icon_info.url = icon_url
         contact.icon_info.etag = etag
         contact.save()
-        contact.updating_remote_icon = False
 
     @objc.python_method
     @run_in_gui_thread
@@ -2265,6 +2230,144 @@ class AddressBookBlinkGroup(VirtualBlinkGroup):
         nc.post_notification("BlinkContactsHaveChanged", sender=self)
 
 
+def split_uri(uri):
+    if isinstance(uri, (FrozenSIPURI, SIPURI)):
+        return (uri.user or '', uri.host or '')
+    elif '@' in uri:
+        uri = sip_prefix_pattern.sub("", uri)
+        user, _, host = uri.partition("@")
+        host = host.partition(":")[0]
+        return (user, host)
+    else:
+        user = uri.partition(":")[0] if uri else ''
+        return (user, '')
+
+
+def phone_number_digits(number):
+    if not number or any(d not in "1234567890" for d in number):
+        return None
+    return number
+
+
+class ContactURIIndex(object):
+    """Index of the contacts list by address, user name prefix and phone number suffix.
+
+    Lookups return candidate (group, contact) pairs in contacts list order.
+    The candidates are a superset of the matching contacts, callers still
+    need to check them with matchesURI. The lower-cased names, addresses
+    and descriptions of the contacts are kept for the search box.
+    """
+
+    def __init__(self, groups, signature=None):
+        self.signature = signature
+        self.entries = []
+        self.addresses = {}
+        self.usernames = []
+        self.phone_numbers = {}
+        self.descriptions = []
+        self.search_texts = []
+        self.last_search = (None, None)
+
+        for group in groups:
+            for contact in group.contacts:
+                position = len(self.entries)
+                self.entries.append((group, contact))
+
+                addresses = {(getattr(contact, 'username', ''), getattr(contact, 'domain', ''))}
+                try:
+                    addresses.update(split_uri(item.uri) for item in contact.uris if item.uri)
+                    search_text = [item.uri.lower() for item in contact.uris]
+                except TypeError:
+                    search_text = []
+
+                for user, host in addresses:
+                    self.addresses.setdefault((user, host), []).append(position)
+                    self.usernames.append((user, position))
+                    # phone numbers are matched by their end, see BlinkContact.matchesURI
+                    digits = phone_number_digits(strip_addressbook_special_characters(user).lstrip("+"))
+                    if digits is not None:
+                        node = self.phone_numbers
+                        for digit in reversed(digits):
+                            node = node.setdefault(digit, {})
+                        node.setdefault(None, []).append(position)
+
+                description = '\n'.join(text.lower() for text in (getattr(contact, attribute, None) for attribute in ('organization', 'job_title', 'note')) if text is not None)
+                if description:
+                    self.descriptions.append((description, position))
+
+                search_text.append(str(contact.name or '').lower())
+                search_text.append(description)
+                self.search_texts.append('\0'.join(search_text))
+
+        self.usernames.sort()
+
+    def _address_positions(self, uri):
+        user, host = split_uri(uri)
+        positions = set()
+
+        if not host:
+            if not user:
+                return set(range(len(self.entries)))
+            index = bisect.bisect_left(self.usernames, (user,))
+            while index < len(self.usernames) and self.usernames[index][0].startswith(user):
+                positions.add(self.usernames[index][1])
+                index += 1
+        else:
+            positions.update(self.addresses.get((user, host), ()))
+
+        digits = phone_number_digits(user.lstrip("+").lstrip("0"))
+        if digits is not None and len(digits) > 7:
+            node = self.phone_numbers
+            for digit in reversed(digits):
+                try:
+                    node = node[digit]
+                except KeyError:
+                    break
+            else:
+                nodes = [node]
+                while nodes:
+                    node = nodes.pop()
+                    for key, value in node.items():
+                        if key is None:
+                            positions.update(value)
+                        else:
+                            nodes.append(value)
+
+        return positions
+
+    def lookup(self, uri):
+        if uri is None:
+            return []
+
+        if isinstance(uri, SIPURI):
+            uri = '%s@%s' % (uri.user.decode(), uri.host.decode())
+
+        positions = self._address_positions(uri)
+        text = str(uri).lower()
+        positions.update(position for description, position in self.descriptions if text in description)
+
+        return [self.entries[position] for position in sorted(positions)]
+
+    def search(self, text):
+        # Returns (group, contact, exact) tuples in contacts list order. Exact
+        # entries contain the text in their name, addresses or description,
+        # the others are address candidates to be checked with matchesURI.
+        # A query that contains the previous one only scans its results.
+        query = text.lower()
+        previous_query, previous_positions = self.last_search
+        if previous_query is not None and previous_query in query:
+            positions = previous_positions
+        else:
+            positions = range(len(self.entries))
+        found = [position for position in positions if query in self.search_texts[position]]
+        self.last_search = (query, found)
+
+        candidates = self._address_positions(text).difference(found)
+        results = [(position, True) for position in found] + [(position, False) for position in candidates]
+        results.sort()
+        return [self.entries[position] + (exact,) for position, exact in results]
+
+
 class CustomListModel(NSObject):
     """Contacts List Model behaviour, display and drag an drop actions"""
     groupsList = []
@@ -2685,6 +2788,7 @@ class ContactListModel(CustomListModel):
     nc = NotificationCenter()
     pending_watchers_map = {}
     active_watchers_map = {}
+    contact_index = None
 
     def init(self):
         self.all_contacts_group = AllContactsBlinkGroup()
@@ -2728,6 +2832,7 @@ class ContactListModel(CustomListModel):
         self.nc.add_observer(self, name="AudioCallLoggedToHistory")
         self.nc.add_observer(self, name="SIPAccountGotPresenceWinfo")
         self.nc.add_observer(self, name="BlinkAccountGotMessageSummary")
+        self.nc.add_observer(self, name="BlinkContactsHaveChanged")
 
         ns_nc = NSNotificationCenter.defaultCenter()
         ns_nc.addObserver_selector_name_object_(self, "groupExpanded:", NSOutlineViewItemDidExpandNotification, self.contactOutline)
@@ -2753,35 +2858,53 @@ class ContactListModel(CustomListModel):
             self.addressbook_group.loadAddressBook(notification.userInfo())
 
     @objc.python_method
-    def hasContactMatchingURI(self, uri, exact_match=False, skip_system_address_book=False):
+    def invalidateContactIndex(self):
+        self.contact_index = None
+
+    @objc.python_method
+    def getContactIndexCandidates(self, uri):
+        # candidate (group, contact) pairs for the uri in contacts list order
+        return self.getContactIndex().lookup(uri)
+
+    @objc.python_method
+    def getContactIndex(self):
+        # the index is rebuilt after contacts list changes or when groups changed size
+        groups = self.groupsList[:]
+        if self.all_contacts_group not in groups:
+            groups.append(self.all_contacts_group)
+        signature = tuple((id(group), len(group.contacts)) for group in groups)
+        contact_index = self.contact_index
+        if contact_index is None or contact_index.signature != signature:
+            contact_index = self.contact_index = ContactURIIndex(groups, signature)
+        return contact_index
+
+    @objc.python_method
+    def getContactsMatchingSearchText(self, text):
+        # same matching as "text in contact or contact.matchesURI(text)" over the searchable groups
+        groups = set(group for group in self.groupsList if not group.ignore_search)
+        return [blink_contact for group, blink_contact, exact in self.getContactIndex().search(text) if group in groups and (exact or blink_contact.matchesURI(text))]
+
+    @objc.python_method
+    def getSearchableContactsMatchingURI(self, uri, exact_match=False, skip_system_address_book=False):
         # add System AB group at the end so that we find contacts there as a last resort
-        groupsList = self.groupsList[:]
-        try:
-            groupsList.remove(self.addressbook_group)
-        except ValueError:
-            pass
-        else:
-            if not skip_system_address_book:
-                groupsList.append(self.addressbook_group)
+        groups = set(group for group in self.groupsList if not group.ignore_search)
+        if skip_system_address_book:
+            groups.discard(self.addressbook_group)
+        candidates = [(group, blink_contact) for group, blink_contact in self.getContactIndexCandidates(uri) if group in groups]
+        candidates.sort(key=lambda item: item[0] is self.addressbook_group)
+        return (blink_contact for group, blink_contact in candidates if blink_contact.matchesURI(uri, exact_match))
 
-        return any(blink_contact.matchesURI(uri, exact_match) for group in groupsList if not group.ignore_search for blink_contact in group.contacts)
+    @objc.python_method
+    def hasContactMatchingURI(self, uri, exact_match=False, skip_system_address_book=False):
+        return any(self.getSearchableContactsMatchingURI(uri, exact_match, skip_system_address_book))
 
     @objc.python_method
     def getFirstContactMatchingURI(self, uri, exact_match=False):
-        # add System AB group at the end so that we find contacts there as a last resort
-        groupsList = self.groupsList[:]
-        try:
-            groupsList.remove(self.addressbook_group)
-        except ValueError:
-            pass
-        else:
-            groupsList.append(self.addressbook_group)
-            
         if uri is None:
             return None
 
         try:
-            return next(blink_contact for group in groupsList if not group.ignore_search for blink_contact in group.contacts if blink_contact.matchesURI(uri, exact_match))
+            return next(self.getSearchableContactsMatchingURI(uri, exact_match))
         except StopIteration:
             return None
 
@@ -2814,16 +2937,14 @@ class ContactListModel(CustomListModel):
     @objc.python_method
     def getFirstContactFromAllContactsGroupMatchingURI(self, uri, exact_match=False):
         try:
-            return next(blink_contact for blink_contact in self.all_contacts_group.contacts if blink_contact.matchesURI(uri, exact_match))
+            return next(blink_contact for group, blink_contact in self.getContactIndexCandidates(uri) if group is self.all_contacts_group and blink_contact.matchesURI(uri, exact_match))
         except StopIteration:
             return None
 
     @objc.python_method
     def getPresenceContactsMatchingURI(self, uri, exact_match=False):
-        try:
-            return list((blink_contact, group) for group in self.groupsList if group != self.online_contacts_group for blink_contact in group.contacts if isinstance(blink_contact, BlinkPresenceContact) and blink_contact.contact.presence.subscribe and blink_contact.matchesURI(uri, exact_match))
-        except StopIteration:
-            return None
+        groups = set(group for group in self.groupsList if group != self.online_contacts_group)
+        return list((blink_contact, group) for group, blink_contact in self.getContactIndexCandidates(uri) if group in groups and isinstance(blink_contact, BlinkPresenceContact) and blink_contact.contact.presence.subscribe and blink_contact.matchesURI(uri, exact_match))
 
     @objc.python_method
     def presencePolicyExistsForURI_(self, uri):
@@ -3128,7 +3249,7 @@ class ContactListModel(CustomListModel):
 
     @objc.python_method
     def getBlinkContactsForURI(self, uri, exact_match=False):
-        return (blink_contact for blink_contact in self.all_contacts_group.contacts if blink_contact.matchesURI(uri, exact_match))
+        return (blink_contact for group, blink_contact in self.getContactIndexCandidates(uri) if group is self.all_contacts_group and blink_contact.matchesURI(uri, exact_match))
 
     @objc.python_method
     def getBlinkGroupsForBlinkContact(self, blink_contact):
@@ -3142,17 +3263,16 @@ class ContactListModel(CustomListModel):
     def getBlinkContactsAndGroupsForURI(self, uri):
         main_contacts = []
         other_contacts = []
-        allowed_groups = [group for group in self.groupsList if (group.add_contact_allowed or isinstance(group, AllContactsBlinkGroup))]
-        for group in allowed_groups:
-            for blink_contact in group.contacts:
-                if not isinstance(blink_contact, BlinkPresenceContact):
-                    continue
+        allowed_groups = set(group for group in self.groupsList if (group.add_contact_allowed or isinstance(group, AllContactsBlinkGroup)))
+        for group, blink_contact in self.getContactIndexCandidates(uri):
+            if group not in allowed_groups or not isinstance(blink_contact, BlinkPresenceContact):
+                continue
 
-                if blink_contact.matchesURI(uri, True):
-                    if isinstance(blink_contact, AllContactsBlinkGroupBlinkPresenceContact):
-                        main_contacts.append(blink_contact)
-                    else:
-                        other_contacts.append((blink_contact, group))
+            if blink_contact.matchesURI(uri, True):
+                if isinstance(blink_contact, AllContactsBlinkGroupBlinkPresenceContact):
+                    main_contacts.append(blink_contact)
+                else:
+                    other_contacts.append((blink_contact, group))
 
         return (main_contacts, other_contacts)
 
@@ -3451,6 +3571,10 @@ class ContactListModel(CustomListModel):
         handler = getattr(self, '_NH_%s' % notification.name, Null)
         handler(notification)
 
+    @objc.python_method
+    def _NH_BlinkContactsHaveChanged(self, notification):
+        self.invalidateContactIndex()
+
     @objc.python_method
     def _NH_SIPApplicationWillStart(self, notification):
         # Load virtual groups
@@ -3792,6 +3916,7 @@ class ContactListModel(CustomListModel):
 
     @objc.python_method
     def _NH_BonjourAccountDidAddNeighbour(self, notification):
+        self.invalidateContactIndex()
         # BlinkLogger().log_info('startup: BonjourAccountDidAddNeighbour enter')
         neighbour = notification.data.neighbour
         record = notification.data.record
@@ -3844,6 +3969,7 @@ class ContactListModel(CustomListModel):
 
     @objc.python_method
     def _NH_BonjourAccountDidUpdateNeighbour(self, notification):
+        self.invalidateContactIndex()
         # BlinkLogger().log_info('startup: BonjourAccountDidUpdateNeighbour enter')
         neighbour = notification.data.neighbour
         record = notification.data.record
@@ -3882,6 +4008,7 @@ class ContactListModel(CustomListModel):
 
     @objc.python_method
     def _NH_BonjourAccountDidRemoveNeighbour(self, notification):
+        self.invalidateContactIndex()
         # BlinkLogger().log_info('startup: BonjourAccountDidRemoveNeighbour enter')
         record = notification.data.record
         display_name = record.name
@@ -3938,6 +4065,7 @@ class ContactListModel(CustomListModel):
 
     @objc.python_method
     def _NH_AddressbookPolicyWasActivated(self, notification):
+        self.invalidateContactIndex()
         policy = notification.sender
 
         if policy.presence.policy == 'block':
@@ -3958,6 +4086,7 @@ class ContactListModel(CustomListModel):
 
     @objc.python_method
     def _NH_AddressbookPolicyWasDeleted(self, notification):
+        self.invalidateContactIndex()
         policy = notification.sender
         if policy.presence.policy == 'block':
             changes = 0
@@ -3989,6 +4118,7 @@ class ContactListModel(CustomListModel):
 
     @objc.python_method
     def _NH_AddressbookContactWasActivated(self, notification):
+        self.invalidateContactIndex()
         contact = notification.sender
 
         blink_contact = BlinkPresenceContact(contact, log_presence_transitions = True)
@@ -4015,6 +4145,7 @@ class ContactListModel(CustomListModel):
 
     @objc.python_method
     def _NH_AddressbookContactWasDeleted(self, notification):
+        self.invalidateContactIndex()
         contact = notification.sender
         blink_contact = next(blink_contact for blink_contact in self.all_contacts_group.contacts if blink_contact.contact == contact)
         blink_contact.avatar.delete()
@@ -4025,6 +4156,7 @@ class ContactListModel(CustomListModel):
 
     @objc.python_method
     def _NH_AddressbookContactDidChange(self, notification):
+        self.invalidateContactIndex()
         contact = notification.sender
 
         uri_attributes = set(['uris.default', 'uris', 'name'])
@@ -4079,6 +4211,7 @@ class ContactListModel(CustomListModel):
 
     @objc.python_method
     def _NH_AddressbookGroupWasActivated(self, notification):
+        self.invalidateContactIndex()
         group = notification.sender
 
         positions = [g.position for g in AddressbookManager().get_groups()+VirtualGroupsManager().get_groups() if g.position is not None and g.id != 'bonjour']
@@ -4103,6 +4236,7 @@ class ContactListModel(CustomListModel):
 
     @objc.python_method
     def _NH_AddressbookGroupWasDeleted(self, notification):
+        self.invalidateContactIndex()
         group = notification.sender
         try:
             blink_group = next(grp for grp in self.groupsList if grp.group == group)
@@ -4124,6 +4258,7 @@ class ContactListModel(CustomListModel):
 
     @objc.python_method
     def _NH_AddressbookGroupDidChange(self, notification):
+        self.invalidateContactIndex()
         group = notification.sender
         try:
             blink_group = next(grp for grp in self.groupsList if grp.group == group)
@@ -4160,6 +4295,7 @@ class ContactListModel(CustomListModel):
 
     @objc.python_method
     def _NH_AddressbookGroupWasCreated(self, notification):
+        self.invalidateContactIndex()
         self.saveGroupPosition()
 
     @objc.python_method
@@ -474,6 +474,7 @@ class ContactWindowController(NSWindowController):
         nc.add_observer(self, name="DefaultAudioDeviceDidChange")
         nc.add_observer(self, name="LDAPDirectorySearchFoundContact")
         nc.add_observer(self, name="HistoryEntriesVisibilityChanged")
+        nc.add_observer(self, name="RecordingHistoryDidChange")
         nc.add_observer(self, name="MediaStreamDidInitialize")
         nc.add_observer(self, name="SIPApplicationWillStart")
         nc.add_observer(self, name="SIPApplicationWillEnd")
@@ -3204,11 +3205,10 @@ class ContactWindowController(NSWindowController):
         text = self.searchBox.stringValue().strip()
         if text == "":
             # Nothing to search for. Switch back to the contacts tab and
-            # bail before touching matchesURI — that list comprehension
-            # iterates every contact in every group and was the single
-            # hottest frame in the py-spy startup profile (~18% of CPU
-            # samples). Running it for an empty query produced an empty
-            # result set anyway.
+            # bail before searching the contacts — matching every contact
+            # in every group was the single hottest frame in the py-spy
+            # startup profile (~18% of CPU samples). Running it for an
+            # empty query produced an empty result set anyway.
             self.mainTabView.selectTabViewItemWithIdentifier_("contacts")
             self.updateStartSessionButtons()
             # BlinkLogger().log_info('startup: searchContacts(noarg) body exit (empty query)')
@@ -3221,7 +3221,7 @@ class ContactWindowController(NSWindowController):
 
         if self.mainTabView.selectedTabViewItem().identifier() == "search":
             self.local_found_contacts = []
-            local_found_contacts = [contact for group in self.model.groupsList if group.ignore_search is False for contact in group.contacts if (text in contact or contact.matchesURI(text))]
+            local_found_contacts = self.model.getContactsMatchingSearchText(text)
             found_count = {}
             for local_found_contact in local_found_contacts:
                 if hasattr(local_found_contact, 'contact') and local_found_contact.contact is not None:
@@ -5723,6 +5723,11 @@ class ContactWindowController(NSWindowController):
     def _NH_HistoryEntriesVisibilityChanged(self, notification):
         self.model.reload_history_groups(force_reload=True)
 
+    @objc.python_method
+    def _NH_RecordingHistoryDidChange(self, notification):
+        # the contact menus are built when they open, only the recordings menu is kept around
+        self.updateRecordingsMenu()
+
     @objc.python_method
     def _NH_PresenceSubscriptionDidFail(self, notification):
         try:
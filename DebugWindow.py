@@ -1,7 +1,8 @@
 # Copyright (C) 2009-2011 AG Projects. See LICENSE for details.
 #
 
-from AppKit import (NSFontAttributeName,
+from AppKit import (NSEventTrackingRunLoopMode,
+                    NSFontAttributeName,
                     NSForegroundColorAttributeName,
                     NSOnState,
                     NSOffState)
@@ -15,10 +16,14 @@ from Foundation import (NSAttributedString,
                         NSMutableAttributedString,
                         NSNotificationCenter,
                         NSObject,
-                        NSString
+                        NSRunLoop,
+                        NSRunLoopCommonModes,
+                        NSString,
+                        NSTimer
                         )
 import objc
 
+from collections import deque
 from datetime import datetime
 
 from application.notification import NotificationCenter, IObserver
@@ -58,6 +63,12 @@ Disabled = Disabled()
 Simplified = Simplified()
 Full = Full()
 
+# Only the most recent output is kept so the window can stay open during
+# long sessions, updates are applied at most once per refresh interval
+NOTIFICATIONS_LIMIT = 10000
+TEXT_VIEW_LIMIT = 1000000    # characters per text view
+REFRESH_INTERVAL = 1.0/30
+
 
 @implementer(IObserver)
 class DebugWindow(NSObject):
@@ -107,6 +118,11 @@ class DebugWindow(NSObject):
 
     notifications = []
     notifications_unfiltered = []
+    notifications_filter = ''
+    pending_notifications = []
+    pending_text = {}
+    pending_labels = {}
+    refresh_timer = None
 
     lastSIPMessageWasDNS = False
 
@@ -141,6 +157,12 @@ class DebugWindow(NSObject):
 
         NSBundle.loadNibNamed_owner_("DebugWindow", self)
 
+        self.notifications_unfiltered = deque(maxlen=NOTIFICATIONS_LIMIT)
+        self.notifications = self.notifications_unfiltered
+        self.pending_notifications = []
+        self.pending_text = {}
+        self.pending_labels = {}
+
         for textView in [self.activityTextView, self.sipTextView, self.rtpTextView, self.msrpTextView, self.xcapTextView, self.pjsipTextView]:
             textView.setString_("")
 
@@ -436,33 +458,43 @@ class DebugWindow(NSObject):
     @objc.IBAction
     def clearClicked_(self, sender):
         if sender.tag() == 100:
+            self.pending_text.pop(self.activityTextView, None)
             self.activityTextView.textStorage().deleteCharactersInRange_(NSMakeRange(0, self.activityTextView.textStorage().length()))
         elif sender.tag() == 101:
+            self.pending_text.pop(self.sipTextView, None)
             self.sipTextView.textStorage().deleteCharactersInRange_(NSMakeRange(0, self.sipTextView.textStorage().length()))
             self.sipInCount = 0
             self.sipOutCount = 0
             self.sipBytes = 0
+            self.pending_labels.pop(self.sipInfoLabel, None)
             self.sipInfoLabel.setStringValue_('')
         elif sender.tag() == 102:
+            self.pending_text.pop(self.rtpTextView, None)
             self.rtpTextView.textStorage().deleteCharactersInRange_(NSMakeRange(0, self.rtpTextView.textStorage().length()))
         elif sender.tag() == 104:
             self.msrpInCount = 0
             self.msrpOutCount = 0
             self.msrpBytes = 0
+            self.pending_labels.pop(self.msrpInfoLabel, None)
             self.msrpInfoLabel.setStringValue_('')
+            self.pending_text.pop(self.msrpTextView, None)
             self.msrpTextView.textStorage().deleteCharactersInRange_(NSMakeRange(0, self.msrpTextView.textStorage().length()))
         elif sender.tag() == 105:
+            self.pending_text.pop(self.xcapTextView, None)
             self.xcapTextView.textStorage().deleteCharactersInRange_(NSMakeRange(0, self.xcapTextView.textStorage().length()))
         elif sender.tag() == 103:
-            self.notifications = []
-            self.notifications_unfiltered = []
+            self.notifications_unfiltered = deque(maxlen=NOTIFICATIONS_LIMIT)
+            self.notifications = self.notifications_unfiltered if not self.notifications_filter else deque(maxlen=NOTIFICATIONS_LIMIT)
+            self.pending_notifications = []
             self.notificationsBytes = 0
             self.notificationsTextView.reloadData()
             self.notificationsInfoLabel.setStringValue_('')
         elif sender.tag() == 107:
             self.pjsipCount = 0
             self.pjsipBytes = 0
+            self.pending_labels.pop(self.pjsipInfoLabel, None)
             self.pjsipInfoLabel.setStringValue_('')
+            self.pending_text.pop(self.pjsipTextView, None)
             self.pjsipTextView.textStorage().deleteCharactersInRange_(NSMakeRange(0, self.pjsipTextView.textStorage().length()))
 
     @objc.IBAction
@@ -470,13 +502,54 @@ class DebugWindow(NSObject):
         self.renderNotifications()
 
     def renderNotifications(self):
+        self.flushNotifications()
         text = str(self.filterNotificationsSearchBox.stringValue().strip().lower())
-        self.notifications = [notification for notification in self.notifications_unfiltered if text in notification[0].lower()] if text else self.notifications_unfiltered
-        self.notificationsTextView.noteNumberOfRowsChanged()
+        if not text:
+            self.notifications = self.notifications_unfiltered
+        else:
+            # a longer filter only needs to look at what the previous one matched
+            if self.notifications_filter and self.notifications_filter in text:
+                notifications = self.notifications
+            else:
+                notifications = self.notifications_unfiltered
+            self.notifications = deque((notification for notification in notifications if text in notification[4]), maxlen=NOTIFICATIONS_LIMIT)
+        self.notifications_filter = text
+        self.notificationsTextView.reloadData()
+        self.updateNotificationsView()
+
+    @objc.python_method
+    def flushNotifications(self):
+        if not self.pending_notifications:
+            return
+
+        pending_notifications, self.pending_notifications = self.pending_notifications, []
+        filtered = self.notifications is not self.notifications_unfiltered
+        removed = False
+        for notification in pending_notifications:
+            if len(self.notifications_unfiltered) == NOTIFICATIONS_LIMIT:
+                removed = True
+                if filtered and self.notifications and self.notifications[0] is self.notifications_unfiltered[0]:
+                    self.notifications.popleft()
+            self.notifications_unfiltered.append(notification)
+            if filtered and self.notifications_filter in notification[4]:
+                self.notifications.append(notification)
+
+        if removed:
+            self.notificationsTextView.reloadData()
+        else:
+            self.notificationsTextView.noteNumberOfRowsChanged()
+        self.updateNotificationsView()
+
+    @objc.python_method
+    def updateNotificationsView(self):
         self.notificationsTextView.scrollRowToVisible_(len(self.notifications)-1)
-        self.notificationsInfoLabel.setStringValue_('%d notifications, %sytes' % (len(self.notifications), format_size(self.notificationsBytes)) if not text else '%d notifications matched' % len(self.notifications))
+        self.notificationsInfoLabel.setStringValue_('%d notifications, %sytes' % (len(self.notifications), format_size(self.notificationsBytes)) if not self.notifications_filter else '%d notifications matched' % len(self.notifications))
 
     def dealloc(self):
+        if self.refresh_timer is not None:
+            self.refresh_timer.invalidate()
+            self.refresh_timer = None
+
         # Observers added in init
         NSNotificationCenter.defaultCenter().removeObserver_(self)
         notification_center = NotificationCenter()
@@ -506,23 +579,61 @@ class DebugWindow(NSObject):
 
         objc.super(DebugWindow, self).dealloc()
 
+    @objc.python_method
+    def append_text(self, textView, text):
+        # text views are updated on the next refresh tick, in one edit
+        try:
+            pending_text = self.pending_text[textView]
+        except KeyError:
+            pending_text = self.pending_text[textView] = NSMutableAttributedString.alloc().init()
+        pending_text.appendAttributedString_(text)
+        self.scheduleRefresh()
+
     @objc.python_method
     def append_line(self, textView, line):
         if isinstance(line, NSAttributedString):
-            textView.textStorage().appendAttributedString_(line)
+            self.append_text(textView, line)
         else:
-            textView.textStorage().appendAttributedString_(NSAttributedString.alloc().initWithString_attributes_(line+"\n", self.normalText))
-
-        if self.autoScrollCheckbox.state() == NSOnState:
-            textView.scrollRangeToVisible_(NSMakeRange(textView.textStorage().length()-1, 1))
+            self.append_text(textView, NSAttributedString.alloc().initWithString_attributes_(line+"\n", self.normalText))
 
     @objc.python_method
     def append_error_line(self, textView, line):
         red = NSDictionary.dictionaryWithObject_forKey_(NSColor.redColor(), NSForegroundColorAttributeName)
-        textView.textStorage().appendAttributedString_(NSAttributedString.alloc().initWithString_attributes_(line+"\n", red))
+        self.append_text(textView, NSAttributedString.alloc().initWithString_attributes_(line+"\n", red))
 
-        if self.autoScrollCheckbox.state() == NSOnState:
-            textView.scrollRangeToVisible_(NSMakeRange(textView.textStorage().length()-1, 1))
+    @objc.python_method
+    def set_info_label(self, label, text):
+        self.pending_labels[label] = text
+        self.scheduleRefresh()
+
+    @objc.python_method
+    def scheduleRefresh(self):
+        if self.refresh_timer is None:
+            self.refresh_timer = NSTimer.timerWithTimeInterval_target_selector_userInfo_repeats_(REFRESH_INTERVAL, self, "refreshTimer:", None, False)
+            NSRunLoop.currentRunLoop().addTimer_forMode_(self.refresh_timer, NSRunLoopCommonModes)
+            NSRunLoop.currentRunLoop().addTimer_forMode_(self.refresh_timer, NSEventTrackingRunLoopMode)
+
+    def refreshTimer_(self, timer):
+        self.refresh_timer = None
+        self.flushNotifications()
+
+        pending_text, self.pending_text = self.pending_text, {}
+        autoscroll = self.autoScrollCheckbox.state() == NSOnState
+        for textView, text in pending_text.items():
+            storage = textView.textStorage()
+            storage.beginEditing()
+            storage.appendAttributedString_(text)
+            if storage.length() > TEXT_VIEW_LIMIT:
+                # drop the oldest lines, a quarter of the limit at a time
+                end = storage.string().find("\n", storage.length() - TEXT_VIEW_LIMIT * 3 // 4)
+                storage.deleteCharactersInRange_(NSMakeRange(0, end + 1 if end != -1 else storage.length()))
+            storage.endEditing()
+            if autoscroll:
+                textView.scrollRangeToVisible_(NSMakeRange(storage.length(), 0))
+
+        pending_labels, self.pending_labels = self.pending_labels, {}
+        for label, text in pending_labels.items():
+            label.setStringValue_(text)
 
     # Patterns matched against the un-timestamped activity message to
     # decide whether the line ALSO belongs in the RTP tab.  Anything
@@ -799,9 +910,7 @@ class DebugWindow(NSObject):
             text += '%s Remote SIP User Agent is "%s"\n' % (session.start_time, session.remote_user_agent)
 
         astring = NSAttributedString.alloc().initWithString_attributes_(text, self.normalText)
-        self.rtpTextView.textStorage().appendAttributedString_(astring)
-        if self.autoScrollCheckbox.state() == NSOnState:
-            self.rtpTextView.scrollRangeToVisible_(NSMakeRange(self.rtpTextView.textStorage().length()-1, 1))
+        self.append_text(self.rtpTextView, astring)
 
     @objc.python_method
     def renderVideo(self, session):
@@ -895,9 +1004,7 @@ class DebugWindow(NSObject):
             text += '%s Remote SIP User Agent is "%s"\n' % (session.start_time, session.remote_user_agent)
 
         astring = NSAttributedString.alloc().initWithString_attributes_(text, self.normalText)
-        self.rtpTextView.textStorage().appendAttributedString_(astring)
-        if self.autoScrollCheckbox.state() == NSOnState:
-            self.rtpTextView.scrollRangeToVisible_(NSMakeRange(self.rtpTextView.textStorage().length()-1, 1))
+        self.append_text(self.rtpTextView, astring)
 
     @objc.python_method
     def renderSIP(self, notification):
@@ -1009,16 +1116,14 @@ class DebugWindow(NSObject):
                 line = '%s %s' % (first.strip(), event or content_type)
                 text.appendAttributedString_(NSAttributedString.alloc().initWithString_attributes_(line+"\n", self.boldTextAttribs))
 
-        self.sipInfoLabel.setStringValue_("%d SIP messages sent, %d SIP messages received, %sytes" % (self.sipOutCount, self.sipInCount, format_size(self.sipBytes)))
+        self.set_info_label(self.sipInfoLabel, "%d SIP messages sent, %d SIP messages received, %sytes" % (self.sipOutCount, self.sipInCount, format_size(self.sipBytes)))
 
         if self.filter_sip_application is not None and applications is not None:
             if self.filter_sip_application not in applications:
                 return
 
-        self.sipTextView.textStorage().appendAttributedString_(text)
-        self.sipTextView.textStorage().appendAttributedString_(self.newline)
-        if self.autoScrollCheckbox.state() == NSOnState:
-            self.sipTextView.scrollRangeToVisible_(NSMakeRange(self.sipTextView.textStorage().length()-1, 1))
+        text.appendAttributedString_(self.newline)
+        self.append_text(self.sipTextView, text)
 
     @objc.python_method
     def renderDNS(self, text):
@@ -1040,7 +1145,7 @@ class DebugWindow(NSObject):
             else:
                 self.append_line(self.pjsipTextView, text)
 
-            self.pjsipInfoLabel.setStringValue_("%d lines, %sytes" % (self.pjsipCount, format_size(self.pjsipBytes)))
+            self.set_info_label(self.pjsipInfoLabel, "%d lines, %sytes" % (self.pjsipCount, format_size(self.pjsipBytes)))
 
     @objc.python_method
     def renderXCAP(self, text):
@@ -1113,11 +1218,12 @@ class DebugWindow(NSObject):
             else:
                 name = notification.name
 
-            self.notifications_unfiltered.append((NSString.stringWithString_(name),
-                                            NSString.stringWithString_(str(notification.sender)),
-                                            NSString.stringWithString_(attribs),
-                                            NSString.stringWithString_(str(ts))))
-            self.renderNotifications()
+            self.pending_notifications.append((NSString.stringWithString_(name),
+                                               NSString.stringWithString_(str(notification.sender)),
+                                               NSString.stringWithString_(attribs),
+                                               NSString.stringWithString_(str(ts)),
+                                               name.lower()))
+            self.scheduleRefresh()
 
     @objc.python_method
     def _NH_CFGSettingsObjectDidChange(self, notification):
@@ -1137,17 +1243,13 @@ class DebugWindow(NSObject):
     def _NH_AudioSessionHasQualityIssues(self, notification):
         text = '%s Audio call quality to %s is poor: loss %s, rtt: %s\n' % (notification.datetime, notification.sender.sessionController.target_uri, notification.data.packet_loss_rx, notification.data.latency)
         astring = NSAttributedString.alloc().initWithString_attributes_(text, self.normalText)
-        self.rtpTextView.textStorage().appendAttributedString_(astring)
-        if self.autoScrollCheckbox.state() == NSOnState:
-            self.rtpTextView.scrollRangeToVisible_(NSMakeRange(self.rtpTextView.textStorage().length()-1, 1))
+        self.append_text(self.rtpTextView, astring)
 
     @objc.python_method
     def _NH_AudioSessionQualityRestored(self, notification):
         text = '%s Audio call quality to %s is back to normal: loss %s, rtt: %s\n' % (notification.datetime, notification.sender.sessionController.target_uri, notification.data.packet_loss_rx, notification.data.latency)
         astring = NSAttributedString.alloc().initWithString_attributes_(text, self.normalText)
-        self.rtpTextView.textStorage().appendAttributedString_(astring)
-        if self.autoScrollCheckbox.state() == NSOnState:
-            self.rtpTextView.scrollRangeToVisible_(NSMakeRange(self.rtpTextView.textStorage().length()-1, 1))
+        self.append_text(self.rtpTextView, astring)
 
     @objc.python_method
     def _NH_MSRPTransportTrace(self, notification):
@@ -1201,7 +1303,7 @@ class DebugWindow(NSObject):
         if settings.logs.trace_msrp_in_gui != Full:
             self.append_line(self.msrpTextView, self.newline)
 
-        self.msrpInfoLabel.setStringValue_("%d MSRP messages sent, %d MRSP messages received, %sytes" % (self.msrpOutCount, self.msrpInCount, format_size(self.msrpBytes)))
+        self.set_info_label(self.msrpInfoLabel, "%d MSRP messages sent, %d MRSP messages received, %sytes" % (self.msrpOutCount, self.msrpInCount, format_size(self.msrpBytes)))
 
     @objc.python_method
     def _NH_MSRPLibraryLog(self, notification):
@@ -1229,9 +1331,7 @@ class DebugWindow(NSObject):
         if stream.codec and stream.sample_rate:
             text += '%s %s call established using %s codec at %sHz\n' % (notification.datetime, mType, stream.codec, stream.sample_rate)
         astring = NSAttributedString.alloc().initWithString_attributes_(text, self.normalText)
-        self.rtpTextView.textStorage().appendAttributedString_(astring)
-        if self.autoScrollCheckbox.state() == NSOnState:
-            self.rtpTextView.scrollRangeToVisible_(NSMakeRange(self.rtpTextView.textStorage().length()-1, 1))
+        self.append_text(self.rtpTextView, astring)
 
     @objc.python_method
     def _NH_RTPStreamICENegotiationDidSucceed(self, notification):
@@ -1260,9 +1360,7 @@ class DebugWindow(NSObject):
         for check in data.valid_list:
             text += '\t%s\n' % check
         astring = NSAttributedString.alloc().initWithString_attributes_(text, self.normalText)
-        self.rtpTextView.textStorage().appendAttributedString_(astring)
-        if self.autoScrollCheckbox.state() == NSOnState:
-            self.rtpTextView.scrollRangeToVisible_(NSMakeRange(self.rtpTextView.textStorage().length()-1, 1))
+        self.append_text(self.rtpTextView, astring)
 
     @objc.python_method
     def _NH_RTPStreamICENegotiationStateDidChange(self, notification):
@@ -1284,9 +1382,7 @@ class DebugWindow(NSObject):
             
         if text:
             astring = NSAttributedString.alloc().initWithString_attributes_(text, self.normalText)
-            self.rtpTextView.textStorage().appendAttributedString_(astring)
-            if self.autoScrollCheckbox.state() == NSOnState:
-                self.rtpTextView.scrollRangeToVisible_(NSMakeRange(self.rtpTextView.textStorage().length()-1, 1))
+            self.append_text(self.rtpTextView, astring)
 
     @objc.python_method
     def _NH_RTPStreamICENegotiationDidFail(self, notification):
@@ -1296,9 +1392,7 @@ class DebugWindow(NSObject):
 
         text = '%s %s ICE negotiation failed: %s\n' % (notification.datetime, mtype, reason)
         astring = NSAttributedString.alloc().initWithString_attributes_(text, self.normalText)
-        self.rtpTextView.textStorage().appendAttributedString_(astring)
-        if self.autoScrollCheckbox.state() == NSOnState:
-            self.rtpTextView.scrollRangeToVisible_(NSMakeRange(self.rtpTextView.textStorage().length()-1, 1))
+        self.append_text(self.rtpTextView, astring)
 
     @objc.python_method
     def _append_rtp_line(self, text):
@@ -1306,10 +1400,7 @@ class DebugWindow(NSObject):
         if not text.endswith('\n'):
             text += '\n'
         astring = NSAttributedString.alloc().initWithString_attributes_(text, self.normalText)
-        self.rtpTextView.textStorage().appendAttributedString_(astring)
-        if self.autoScrollCheckbox.state() == NSOnState:
-            self.rtpTextView.scrollRangeToVisible_(
-                NSMakeRange(self.rtpTextView.textStorage().length() - 1, 1))
+        self.append_text(self.rtpTextView, astring)
 
     # ----- ZRTP negotiation traces -----------------------------------------
     # All four notifications are posted by sipsimple's RTP stream wrapper
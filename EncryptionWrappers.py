@@ -1,11 +1,10 @@
 # Copyright (C) 2012 AG Projects. See LICENSE for details.
 #
 
-__all__ = ['encrypt', 'decrypt']
+__all__ = ['encrypt', 'decrypt', 'derive_key', 'encrypt_with_key', 'decrypt_with_key']
 
 
 import hashlib
-from binascii import hexlify, unhexlify
 from Crypto.Cipher import AES
 
 
@@ -22,31 +21,44 @@ from Crypto.Cipher import AES
 # http://stackoverflow.com/questions/8008253/c-sharp-version-of-openssl-evp-bytestokey-method
 # http://nullege.com/codes/show/src@f@u@Fukei-HEAD@fukei@crypto.py
 
-iv = '\0' * 16
-salt = 'saltsalt'
+iv = b'\0' * 16
+salt = b'saltsalt'
 iterations = 5
 digest = 'sha1'
 
 
 def encrypt(data, key):
-    key = bytes_to_key(key, salt, iterations, digest)
-    cipher = AES.new(key, AES.MODE_CBC, iv)
-    return cipher.encrypt(pkcs7_encode(data))
+    return encrypt_with_key(data, derive_key(key))
 
 def decrypt(data, key):
-    key = bytes_to_key(key, salt, iterations, digest)
-    cipher = AES.new(key, AES.MODE_CBC, iv)
+    return decrypt_with_key(data, derive_key(key))
+
+# Deriving the key is the expensive part, callers that process many
+# entries with the same password derive it once and use these instead
+
+def derive_key(key):
+    return bytes_to_key(_to_bytes(key), salt, iterations, digest)
+
+def encrypt_with_key(data, derived_key):
+    cipher = AES.new(derived_key, AES.MODE_CBC, iv)
+    return cipher.encrypt(pkcs7_encode(_to_bytes(data)))
+
+def decrypt_with_key(data, derived_key):
+    cipher = AES.new(derived_key, AES.MODE_CBC, iv)
     return pkcs7_decode(cipher.decrypt(data))
 
 
 # Helpers
 
+def _to_bytes(data):
+    return data.encode('utf-8') if isinstance(data, str) else data
+
 def pkcs7_encode(text, k=16):
     n = k - (len(text) % k)
-    return text + unhexlify(n * ("%02x" % n))
+    return text + bytes([n]) * n
 
 def pkcs7_decode(text, k=16):
-    n = int(hexlify(text[-1]), 16)
+    n = text[-1]
     if n > k:
         raise ValueError("Input is not padded or padding is corrupt")
     return text[:-n]
@@ -60,7 +72,7 @@ def bytes_to_key(key, salt, iterations=1, digest='sha1'):
     parts = [data]
     i = 1
     desired_len = len(key)
-    while len(''.join(parts)) < desired_len:
+    while len(b''.join(parts)) < desired_len:
         h = digest_func()
         data = parts[i - 1] + key + salt
         h.update(data)
@@ -68,6 +80,5 @@ def bytes_to_key(key, salt, iterations=1, digest='sha1'):
         for x in range(iterations-1):
             parts[i] = digest_func(parts[i]).digest()
         i += 1
-    parts = ''.join(parts)
+    parts = b''.join(parts)
     return parts[:len(key)]
-
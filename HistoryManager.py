@@ -18,17 +18,20 @@ from AppKit import (NSApp,
 
 from Foundation import NSLocalizedString
 
+import base64
+import bisect
 import json
 import pickle
 import os
 import re
 import shutil
+import threading
 import time
 import urllib.parse
 import urllib.request, urllib.parse, urllib.error
 import pytz
 
-from datetime import datetime, timezone as timezone2
+from datetime import datetime, timedelta, timezone as timezone2
 from uuid import uuid1
 from pytz import timezone
 
@@ -42,12 +45,15 @@ from sqlobject import connectionForURI
 from sqlobject import dberrors
 
 from eventlib.twistedutil import block_on
-from twisted.internet import reactor
+from twisted.internet import defer, reactor
 from twisted.internet.threads import deferToThreadPool
 from twisted.python.threadpool import ThreadPool
 
 from BlinkLogger import BlinkLogger
-from EncryptionWrappers import encrypt, decrypt
+from EncryptionWrappers import derive_key, encrypt_with_key, decrypt_with_key
+from HistoryPolling import ConditionalPoll, POLL_NOT_MODIFIED, POLL_UNCHANGED
+from JournalStream import JournalStreamParser
+from QoSStatistics import decode_qos_samples, qos_report
 from resources import ApplicationData
 from util import allocate_autorelease_pool, format_identity_to_string, sipuri_components_from_string, run_in_gui_thread
 
@@ -63,7 +69,13 @@ from zope.interface import implementer
 
 pool = ThreadPool(minthreads=1, maxthreads=1, name='db-ops')
 pool.start()
-reactor.addSystemEventTrigger('before', 'shutdown', pool.stop)
+# stopped after the 'before' triggers, which may still queue writes
+reactor.addSystemEventTrigger('during', 'shutdown', pool.stop)
+
+# decrypts and decodes replicated chat journal entries
+decode_pool = ThreadPool(minthreads=1, maxthreads=4, name='journal-decode')
+decode_pool.start()
+reactor.addSystemEventTrigger('before', 'shutdown', decode_pool.stop)
 
 
 @decorator
@@ -157,6 +169,8 @@ class SessionHistoryEntry(SQLObject):
 class SessionHistory(object, metaclass=Singleton):
     __version__ = 7
 
+    bulk_insert_chunk_size = 500
+
     def __init__(self):
         path = ApplicationData.get('history')
         makedirs(path)
@@ -324,6 +338,47 @@ class SessionHistory(object, metaclass=Singleton):
             BlinkLogger().log_error("Error adding record %s to sessions table: %s" % (session_id, e))
             return False
 
+    @run_in_db_thread
+    def add_entries_bulk(self, entries):
+        """Store a batch of sessions in a single transaction.
+
+        Each entry is a dictionary keyed by the sessions table columns,
+        entries already present are skipped. Returns the number of entries
+        written.
+        """
+        columns = ('session_id', 'media_types', 'direction', 'status', 'failure_reason', 'start_time', 'end_time', 'duration', 'local_uri', 'remote_uri', 'remote_focus', 'participants', 'sip_callid', 'sip_fromtag', 'sip_totag', 'am_filename', 'encryption', 'display_name', 'device_id', 'remote_full_uri', 'hidden')
+        defaults = {'am_filename': '', 'encryption': '', 'display_name': '', 'device_id': '', 'remote_full_uri': '', 'hidden': 0}
+        rows = ["(%s)" % ", ".join(SessionHistoryEntry.sqlrepr(entry.get(column, defaults.get(column))) for column in columns) for entry in entries]
+        if not rows:
+            return 0
+
+        query = "insert or ignore into sessions (%s) values %%s" % ", ".join(columns)
+        transaction = self.db.transaction()
+        try:
+            for i in range(0, len(rows), self.bulk_insert_chunk_size):
+                transaction.query(query % ", ".join(rows[i:i+self.bulk_insert_chunk_size]))
+        except Exception as e:
+            transaction.rollback()
+            BlinkLogger().log_error("Error adding %d records to sessions table: %s" % (len(rows), e))
+            return 0
+        else:
+            transaction.commit(close=True)
+            return len(rows)
+
+    @run_in_db_thread
+    def get_known_calls(self, call_ids):
+        """Return the (direction, sip_callid, sip_fromtag) of the stored sessions with any of the given call ids"""
+        call_ids = list(set(call_ids))
+        known_calls = set()
+        try:
+            for i in range(0, len(call_ids), self.bulk_insert_chunk_size):
+                query = "select direction, sip_callid, sip_fromtag from sessions where sip_callid in (%s)" % ", ".join(SessionHistoryEntry.sqlrepr(call_id) for call_id in call_ids[i:i+self.bulk_insert_chunk_size])
+                known_calls.update(tuple(row) for row in self.db.queryAll(query))
+        except Exception as e:
+            BlinkLogger().log_error("Error getting calls from sessions table: %s" % e)
+            return None
+        return known_calls
+
     def get_display_names(self, uris):
         return block_on(self._get_display_names(uris))
 
@@ -489,10 +544,285 @@ class SessionHistory(object, metaclass=Singleton):
             BlinkLogger().log_error("Error deleting messages from session history table: %s" % e)
             return False
         else:
+            try:
+                self.db.queryAll("delete from session_qos where session_id not in (select session_id from sessions)")
+            except dberrors.OperationalError:
+                pass    # QoS table not created yet
             self.db.queryAll('vacuum')
             return True
 
 
+class QoSHistory(object, metaclass=Singleton):
+    """Per call QoS samples, kept in history.sqlite next to the sessions table.
+
+    Every audio or video stream of a call is stored as one row holding its
+    fixed width samples as encoded by QoSStatistics, keyed by the session_id
+    of the sessions table. Samples are collected in memory during the call
+    and written once when the stream ends, rows are never updated.
+    """
+    __version__ = 1
+
+    table = 'session_qos'
+    schema = ("create table if not exists session_qos (session_id text not null, media_type text not null, start_time numeric not null, samples blob not null, primary key (session_id, media_type))",)
+
+    def __init__(self):
+        path = ApplicationData.get('history')
+        makedirs(path)
+        db_uri = "sqlite://" + os.path.join(path,"history.sqlite")
+        TableVersions()    # initialize versions table
+        self._initialize(db_uri)
+
+    @run_in_db_thread
+    def _initialize(self, db_uri):
+        self.db = connectionForURI(db_uri)
+        try:
+            version = TableVersions().get_table_version(self.table)
+            for query in self.schema:
+                self.db.queryAll(query)
+        except Exception as e:
+            BlinkLogger().log_error("Error creating table %s: %s" % (self.table, e))
+            return
+
+        if version is None:
+            TableVersions().set_table_version(self.table, self.__version__)
+
+    @run_in_db_thread
+    def add_samples(self, session_id, media_type, start_time, samples):
+        # samples are raw bytes, written as a blob literal
+        query = "insert or ignore into session_qos (session_id, media_type, start_time, samples) values (%s, %s, %s, X'%s')" % (self.db.sqlrepr(session_id), self.db.sqlrepr(media_type), self.db.sqlrepr(start_time), bytes(samples).hex())
+        try:
+            self.db.queryAll(query)
+        except Exception as e:
+            BlinkLogger().log_error("Error adding QoS samples of session %s: %s" % (session_id, e))
+            return False
+        return True
+
+    @run_in_db_thread
+    def get_samples(self, session_id):
+        query = "select media_type, samples from session_qos where session_id = %s" % self.db.sqlrepr(session_id)
+        try:
+            return dict((media_type, decode_qos_samples(bytes(samples))) for media_type, samples in self.db.queryAll(query))
+        except Exception as e:
+            BlinkLogger().log_error("Error getting QoS samples of session %s: %s" % (session_id, e))
+            return {}
+
+    @run_in_db_thread
+    def get_report(self, media_type='audio', remote_uri=None, after_date=None, before_date=None, count=1000, loss_threshold=3.0):
+        """Per call summaries of the most recent calls and their aggregate"""
+        connection = self.db.getConnection()
+        try:
+            return qos_report(connection, media_type, remote_uri, after_date, before_date, count, loss_threshold)
+        except Exception as e:
+            BlinkLogger().log_error("Error getting QoS report: %s" % e)
+            return None
+        finally:
+            self.db.releaseConnection(connection)
+
+
+class RecordingHistory(object, metaclass=Singleton):
+    """Catalogue of the audio and video recordings, kept in history.sqlite.
+
+    The catalogue is loaded in memory at start and kept sorted by start time,
+    so listing the recordings of a contact does not touch the disk. Blink adds
+    the recordings it makes when they are saved. Files copied or removed by
+    hand are picked up by reconcile, which only lists the account directories
+    and runs in the db thread at most once every reconcile_interval, when the
+    catalogue is queried. Queries never wait for the catalogue to load, they
+    return what is known so far and RecordingHistoryDidChange is posted once
+    loading or a reconcile changed the catalogue.
+    """
+    __version__ = 1
+
+    table = 'recordings'
+    schema = ("create table if not exists recordings (path text primary key, recording_type text not null, local_uri text not null, remote_uri text not null, start_time text not null, duration integer)",
+              "create index if not exists recordings_remote_idx on recordings (remote_uri, start_time)")
+    reconcile_interval = 60
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._loaded = threading.Event()
+        self._entries = []     # (start_time, path, recording_type, local_uri, remote_uri, duration), sorted
+        self._paths = {}       # path -> entry
+        self._last_reconcile = 0
+        self.directory = ApplicationData.get('history')
+        makedirs(self.directory)
+        db_uri = "sqlite://" + os.path.join(self.directory,"history.sqlite")
+        TableVersions()    # initialize versions table
+        self._initialize(db_uri)
+
+    @run_in_db_thread
+    def _initialize(self, db_uri):
+        self.db = connectionForURI(db_uri)
+        try:
+            version = TableVersions().get_table_version(self.table)
+            for query in self.schema:
+                self.db.queryAll(query)
+            rows = list(self.db.queryAll("select start_time, path, recording_type, local_uri, remote_uri, duration from recordings"))
+        except Exception as e:
+            BlinkLogger().log_error("Error loading table %s: %s" % (self.table, e))
+            self._loaded.set()
+            NotificationCenter().post_notification('RecordingHistoryDidChange', sender=self)
+            return
+
+        entries = []
+        for start_time, path, recording_type, local_uri, remote_uri, duration in rows:
+            try:
+                start_time = datetime.strptime(start_time, "%Y-%m-%d %H:%M:%S")
+            except (TypeError, ValueError):
+                continue
+            entries.append((start_time, path, recording_type, local_uri, remote_uri, duration))
+        self._set_entries(entries)
+
+        if version is None:
+            TableVersions().set_table_version(self.table, self.__version__)
+
+        self._reconcile(notify=False)
+        self._loaded.set()
+        NotificationCenter().post_notification('RecordingHistoryDidChange', sender=self)
+
+    def _set_entries(self, entries):
+        with self._lock:
+            self._paths = dict((entry[1], entry) for entry in entries)
+            self._entries = sorted(self._paths.values())
+
+    def _parse_filename(self, path, local_uri):
+        # Recordings are named YYYYmmdd-HHMMSS-user@domain[-direction].ext
+        base, ext = os.path.splitext(os.path.basename(path))
+        recording_type = 'audio' if ext == '.wav' else 'video'
+        toks = base.split('-', 2)
+        start_time = None
+        remote = base
+        if len(toks) == 3:
+            try:
+                start_time = datetime.strptime(toks[0] + toks[1][:6], "%Y%m%d%H%M%S")
+            except ValueError:
+                pass
+            else:
+                remote = toks[2]
+                for direction in ('-incoming', '-outgoing'):
+                    if remote.endswith(direction):
+                        remote = remote[:-len(direction)]
+        if start_time is None:
+            start_time = datetime.fromtimestamp(int(os.stat(path).st_ctime))
+        try:
+            remote_uri = format_identity_to_string(SIPURI.parse('sip:%s' % remote))
+        except Exception:
+            remote_uri = remote
+        return (start_time, path, recording_type, local_uri, remote_uri, None)
+
+    def _reconcile(self, notify=True):
+        # Caller needs to be in the db thread
+        self._last_reconcile = time.time()
+        with self._lock:
+            known = dict(self._paths)
+
+        added = []
+        seen = set()
+        try:
+            accounts = os.listdir(self.directory)
+        except OSError:
+            accounts = []
+        for account in accounts:
+            dirname = os.path.join(self.directory, account)
+            if not os.path.isdir(dirname):
+                continue
+            try:
+                files = os.listdir(dirname)
+            except OSError:
+                continue
+            for file in files:
+                if file.startswith('.'):
+                    continue
+                path = os.path.join(dirname, file)
+                seen.add(path)
+                if path not in known:
+                    try:
+                        added.append(self._parse_filename(path, account))
+                    except OSError:
+                        pass
+
+        # recordings may have been saved outside the history directory
+        removed = [path for path in known if path not in seen and not os.path.exists(path)]
+
+        if not added and not removed:
+            return
+        if not self._write(added, removed):
+            return
+
+        with self._lock:
+            for path in removed:
+                self._paths.pop(path, None)
+            for entry in added:
+                self._paths.setdefault(entry[1], entry)
+            self._entries = sorted(self._paths.values())
+        BlinkLogger().log_debug("Recordings catalogue: %d added, %d removed" % (len(added), len(removed)))
+        if notify:
+            NotificationCenter().post_notification('RecordingHistoryDidChange', sender=self)
+
+    @run_in_db_thread
+    def reconcile(self):
+        self._reconcile()
+
+    def _write(self, added, removed=()):
+        # Caller needs to be in the db thread
+        transaction = self.db.transaction()
+        try:
+            for i in range(0, len(removed), 500):
+                transaction.query("delete from recordings where path in (%s)" % ", ".join(self.db.sqlrepr(path) for path in removed[i:i+500]))
+            for i in range(0, len(added), 500):
+                rows = ["(%s, %s, %s, %s, %s, %s)" % (self.db.sqlrepr(path), self.db.sqlrepr(recording_type), self.db.sqlrepr(local_uri), self.db.sqlrepr(remote_uri), self.db.sqlrepr(start_time.strftime("%Y-%m-%d %H:%M:%S")), self.db.sqlrepr(duration)) for start_time, path, recording_type, local_uri, remote_uri, duration in added[i:i+500]]
+                transaction.query("insert or replace into recordings (path, recording_type, local_uri, remote_uri, start_time, duration) values %s" % ", ".join(rows))
+        except Exception as e:
+            transaction.rollback()
+            BlinkLogger().log_error("Error updating table %s: %s" % (self.table, e))
+            return False
+        else:
+            transaction.commit(close=True)
+            return True
+
+    @run_in_db_thread
+    def _save(self, entry):
+        self._write([entry])
+
+    def add_recording(self, path, recording_type, local_uri, remote_uri, start_time=None, duration=None):
+        if start_time is None:
+            try:
+                start_time = self._parse_filename(path, local_uri)[0]
+            except OSError:
+                start_time = datetime.now()
+        entry = (start_time.replace(microsecond=0), path, recording_type, local_uri, remote_uri, duration)
+        with self._lock:
+            self._paths[path] = entry
+            self._entries = sorted(self._paths.values())
+        self._save(entry)
+
+    def get_recordings(self, remote_uris=None, after_date=None, before_date=None, count=None):
+        """
+        Return the recordings as (start_time, path, recording_type, local_uri,
+        remote_uri, duration) tuples sorted by start time, optionally only
+        those with the given remote parties, started in [after_date,
+        before_date) and the most recent count of them. While the catalogue is
+        being loaded only the recordings known so far are returned.
+        """
+        if self._loaded.is_set() and time.time() - self._last_reconcile > self.reconcile_interval:
+            self._last_reconcile = time.time()
+            self.reconcile()
+
+        with self._lock:
+            entries = self._entries
+
+        if after_date is not None:
+            entries = entries[bisect.bisect_left(entries, (after_date,)):]
+        if before_date is not None:
+            entries = entries[:bisect.bisect_left(entries, (before_date,))]
+        if remote_uris:
+            remote_uris = set(remote_uris)
+            entries = [entry for entry in entries if entry[4] in remote_uris]
+        if count is not None:
+            entries = entries[-count:] if count else []
+        return list(entries)
+
+
 class ChatMessage(SQLObject):
     class sqlmeta:
         table = 'chat_messages'
@@ -517,20 +847,63 @@ class ChatMessage(SQLObject):
     id_idx            = DatabaseIndex('msgid')
     local_idx         = DatabaseIndex('local_uri')
     remote_idx        = DatabaseIndex('remote_uri')
+    remote_media_time_idx = DatabaseIndex('remote_uri', 'media_type', 'time')
     uuid              = StringCol()
     journal_id        = StringCol()
     encryption        = StringCol(default='')
 
 
+class ChatMessageRecord(object):
+    """Lightweight read-only chat message row returned by ChatHistory.iter_messages"""
+
+    __slots__ = ('id', 'msgid', 'time', 'date', 'direction', 'media_type', 'content_type', 'status', 'sip_callid', 'cpim_from', 'cpim_to', 'cpim_timestamp', 'body', 'encryption', 'cursor')
+
+    columns = ('id', 'msgid', 'time', 'date', 'direction', 'media_type', 'content_type', 'status', 'sip_callid', 'cpim_from', 'cpim_to', 'cpim_timestamp', 'body', 'encryption')
+
+    def __init__(self, row):
+        (self.id, self.msgid, time, date, self.direction, self.media_type, self.content_type, self.status,
+         self.sip_callid, self.cpim_from, self.cpim_to, self.cpim_timestamp, self.body, self.encryption) = row
+        # keep the raw column values for keyset pagination, they compare exactly against what is stored
+        self.cursor = (time, self.id)
+        try:
+            self.time = datetime.fromisoformat(time)
+        except (TypeError, ValueError):
+            self.time = time
+        try:
+            self.date = datetime.fromisoformat(date).date()
+        except (TypeError, ValueError):
+            self.date = date
+
+    def __repr__(self):
+        return "<%s %s %s>" % (self.__class__.__name__, self.id, self.msgid)
+
+
 class ChatHistory(object, metaclass=Singleton):
-    __version__ = 8
+    __version__ = 10
+
+    # Full-text index over chat_messages.body, maintained by triggers so that
+    # every insert, body update and delete keeps it in sync. The trigram
+    # tokenizer preserves the substring semantics of the former LIKE scans.
+    fts_table = 'chat_messages_fts'
+    fts_min_search_length = 3
+    fts_enabled = False
+
+    # rows per INSERT statement when storing messages in bulk
+    bulk_insert_chunk_size = 500
+
+    # body rewrites of the same message within this interval are written once, with the newest body
+    body_update_coalesce_interval = 2.0
 
     def __init__(self):
         path = ApplicationData.get('history')
         makedirs(path)
         db_uri = "sqlite://" + os.path.join(path,"history.sqlite")
+        self._pending_body_updates = {}
+        self._pending_body_updates_lock = threading.Lock()
         TableVersions()    # initialize versions table
         self._initialize(db_uri)
+        # the last location of a share must not be lost when quitting right after it
+        reactor.callFromThread(reactor.addSystemEventTrigger, 'before', 'shutdown', self._write_pending_body_updates)
 
     @run_in_db_thread
     def _initialize(self, db_uri):
@@ -549,11 +922,60 @@ class ChatHistory(object, metaclass=Singleton):
                 except Exception as e:
                     BlinkLogger().log_error("Error creating history table %s: %s" % (ChatMessage.sqlmeta.table,e))
                 else:
+                    self._create_fts_index()
                     TableVersions().set_table_version(ChatMessage.sqlmeta.table, self.__version__)
 
         except Exception as e:
             BlinkLogger().log_error("Error checking history table %s: %s" % (ChatMessage.sqlmeta.table,e))
 
+        try:
+            self.fts_enabled = bool(self.db.queryAll("select name from sqlite_master where type='table' and name=%s" % ChatMessage.sqlrepr(self.fts_table)))
+        except Exception as e:
+            BlinkLogger().log_error("Error checking full-text index %s: %s" % (self.fts_table, e))
+            self.fts_enabled = False
+
+    def _create_fts_index(self):
+        # Caller needs to be in the db thread
+        queries = ("CREATE VIRTUAL TABLE IF NOT EXISTS %s USING fts5(body, content='chat_messages', content_rowid='id', tokenize='trigram')" % self.fts_table,
+                   "CREATE TRIGGER IF NOT EXISTS %(fts)s_insert AFTER INSERT ON chat_messages BEGIN "
+                   "INSERT INTO %(fts)s(rowid, body) VALUES (new.id, new.body); END" % {'fts': self.fts_table},
+                   "CREATE TRIGGER IF NOT EXISTS %(fts)s_delete AFTER DELETE ON chat_messages BEGIN "
+                   "INSERT INTO %(fts)s(%(fts)s, rowid, body) VALUES ('delete', old.id, old.body); END" % {'fts': self.fts_table},
+                   "CREATE TRIGGER IF NOT EXISTS %(fts)s_update AFTER UPDATE OF body ON chat_messages BEGIN "
+                   "INSERT INTO %(fts)s(%(fts)s, rowid, body) VALUES ('delete', old.id, old.body); "
+                   "INSERT INTO %(fts)s(rowid, body) VALUES (new.id, new.body); END" % {'fts': self.fts_table})
+        try:
+            for query in queries:
+                self.db.queryAll(query)
+        except Exception as e:
+            # SQLite built without FTS5 or trigram support, searches fall back to LIKE scans
+            BlinkLogger().log_error("Error creating full-text index %s: %s" % (self.fts_table, e))
+            return False
+        else:
+            BlinkLogger().log_debug("Created full-text index %s" % self.fts_table)
+            return True
+
+    def _rebuild_fts_index(self):
+        # Caller needs to be in the db thread
+        query = "INSERT INTO %(fts)s(%(fts)s) VALUES ('rebuild')" % {'fts': self.fts_table}
+        try:
+            self.db.queryAll(query)
+        except Exception as e:
+            BlinkLogger().log_error("Error rebuilding full-text index %s: %s" % (self.fts_table, e))
+
+    def _fts_match(self, search_text):
+        # Quote the text as a single FTS5 phrase so that user input is never parsed as query syntax
+        return '"%s"' % search_text.replace('"', '""')
+
+    def _use_fts(self, search_text):
+        # Trigram phrases shorter than 3 characters never match, those fall back to LIKE
+        return self.fts_enabled and len(search_text) >= self.fts_min_search_length
+
+    def _search_clause(self, search_text):
+        if self._use_fts(search_text):
+            return "chat_messages.id in (select rowid from %s where %s match %s)" % (self.fts_table, self.fts_table, ChatMessage.sqlrepr(self._fts_match(search_text)))
+        return "body like %s" % ChatMessage.sqlrepr('%'+search_text+'%')
+
     @allocate_autorelease_pool
     def _migrate_version(self, previous_version):
         if previous_version is None:
@@ -681,6 +1103,17 @@ class ChatHistory(object, metaclass=Singleton):
             except Exception as e:
                 BlinkLogger().log_error("Error pruning non-location metadata rows: %s" % e)
 
+        if next_upgrade_version < 9:
+            if self._create_fts_index():
+                self._rebuild_fts_index()
+
+        if next_upgrade_version < 10:
+            query = "CREATE INDEX IF NOT EXISTS chat_messages_remote_media_time_idx ON chat_messages (remote_uri, media_type, time)"
+            try:
+                self.db.queryAll(query)
+            except Exception as e:
+                BlinkLogger().log_error("Error adding index chat_messages_remote_media_time_idx to table %s: %s" % (ChatMessage.sqlmeta.table, e))
+
         TableVersions().set_table_version(ChatMessage.sqlmeta.table, self.__version__)
 
     @run_in_db_thread
@@ -738,6 +1171,38 @@ class ChatHistory(object, metaclass=Singleton):
         except Exception as e:
             BlinkLogger().log_error("Error updating message body for %s: %s" % (msgid, e))
 
+    def queue_message_body_update(self, msgid, body):
+        """Replace the persisted body of a message, coalescing frequent rewrites.
+
+        A live location share rewrites the body of its origin row on every
+        tick, while only the latest position matters. Updates are kept in
+        memory for body_update_coalesce_interval seconds, only the newest
+        body of each message is kept, and they are then written together in
+        one transaction. Can be called from any thread.
+        """
+        with self._pending_body_updates_lock:
+            schedule = not self._pending_body_updates
+            self._pending_body_updates[msgid] = body
+        if schedule:
+            reactor.callFromThread(reactor.callLater, self.body_update_coalesce_interval, self._write_pending_body_updates)
+
+    @run_in_db_thread
+    def _write_pending_body_updates(self):
+        with self._pending_body_updates_lock:
+            updates, self._pending_body_updates = self._pending_body_updates, {}
+        if not updates:
+            return
+
+        transaction = self.db.transaction()
+        try:
+            for msgid, body in updates.items():
+                transaction.query("update chat_messages set body = %s where msgid = %s" % (ChatMessage.sqlrepr(body), ChatMessage.sqlrepr(msgid)))
+        except Exception as e:
+            transaction.rollback()
+            BlinkLogger().log_error("Error updating the body of %d messages: %s" % (len(updates), e))
+        else:
+            transaction.commit(close=True)
+
 
     @run_in_db_thread
     def add_message(self, msgid, media_type, local_uri, remote_uri, direction, cpim_from, cpim_to, cpim_timestamp, body, content_type, private, status, time='', uuid='', journal_id='', skip_replication=False, call_id='', encryption=''):
@@ -752,15 +1217,7 @@ class ChatHistory(object, metaclass=Singleton):
         if not cpim_timestamp:
             cpim_timestamp = str(ISOTimestamp.now())
 
-        try:
-            timestamp = dateutil.parser.isoparse(cpim_timestamp)
-            offset = timestamp.utcoffset()
-            timestamp = timestamp.replace(tzinfo=timezone2.utc)
-            timestamp = timestamp - offset
-            # save the date as UTC date 0 offset
-        except (ValueError, AttributeError) as e:
-            self.log_error('Failed to parse timestamp %s for message id %s: %s' % (cpim_timestamp, msgid, str(e)))
-            timestamp = datetime.utcnow()
+        timestamp = self._parse_timestamp(cpim_timestamp, msgid)
 
         try:
             ChatMessage(
@@ -809,6 +1266,72 @@ class ChatHistory(object, metaclass=Singleton):
         NotificationCenter().post_notification('MessageSaved', sender=self, data=NotificationData(msgid=msgid, success=False))
         return False
 
+    def _parse_timestamp(self, cpim_timestamp, msgid):
+        try:
+            timestamp = dateutil.parser.isoparse(cpim_timestamp)
+            offset = timestamp.utcoffset()
+            timestamp = timestamp.replace(tzinfo=timezone2.utc)
+            timestamp = timestamp - offset
+            # save the date as UTC date 0 offset
+        except (ValueError, AttributeError, TypeError) as e:
+            BlinkLogger().log_error('Failed to parse timestamp %s for message id %s: %s' % (cpim_timestamp, msgid, str(e)))
+            timestamp = datetime.utcnow()
+        return timestamp
+
+    @run_in_db_thread
+    def add_messages_bulk(self, messages):
+        """Store a batch of messages in a single transaction.
+
+        Each message is a dictionary with the same keys as the add_message
+        arguments. Rows that already exist for the same msgid, local_uri and
+        remote_uri get their status and journal_id updated, like add_message
+        does for duplicates. One MessagesSaved notification is posted for the
+        whole batch instead of a MessageSaved notification per row.
+        """
+        columns = ('msgid', 'sip_callid', 'time', 'date', 'media_type', 'direction', 'local_uri', 'remote_uri', 'cpim_from', 'cpim_to', 'cpim_timestamp', 'body', 'content_type', 'private', 'status', 'uuid', 'journal_id', 'encryption')
+        rows = []
+        msgids = []
+        for message in messages:
+            try:
+                values = dict((key, message[key]) for key in ('msgid', 'media_type', 'local_uri', 'remote_uri', 'direction', 'cpim_from', 'cpim_to', 'body', 'content_type', 'private', 'status'))
+            except KeyError as e:
+                BlinkLogger().log_error('Error inserting Chat SQL record: missing %s' % e)
+                continue
+
+            if values['content_type'] is not None and not isinstance(values['content_type'], str):
+                values['content_type'] = str(values['content_type'])
+
+            cpim_timestamp = message.get('cpim_timestamp') or str(ISOTimestamp.now())
+            timestamp = self._parse_timestamp(cpim_timestamp, values['msgid'])
+            values.update(sip_callid=message.get('call_id', ''),
+                          time=timestamp,
+                          date=timestamp.date(),
+                          cpim_timestamp=cpim_timestamp,
+                          uuid=message.get('uuid', ''),
+                          journal_id=message.get('journal_id', ''),
+                          encryption=message.get('encryption', ''))
+            rows.append("(%s)" % ", ".join(ChatMessage.sqlrepr(values[column]) for column in columns))
+            msgids.append(values['msgid'])
+
+        if not rows:
+            return 0
+
+        query = "insert into chat_messages (%s) values %%s on conflict (msgid, local_uri, remote_uri) do update set status = excluded.status, journal_id = excluded.journal_id" % ", ".join(columns)
+        transaction = self.db.transaction()
+        try:
+            for i in range(0, len(rows), self.bulk_insert_chunk_size):
+                transaction.query(query % ", ".join(rows[i:i+self.bulk_insert_chunk_size]))
+        except Exception as e:
+            transaction.rollback()
+            BlinkLogger().log_error("Error adding %d records to history table: %s" % (len(rows), e))
+            NotificationCenter().post_notification('MessagesSaved', sender=self, data=NotificationData(msgids=msgids, success=False))
+            return 0
+        else:
+            transaction.commit(close=True)
+
+        NotificationCenter().post_notification('MessagesSaved', sender=self, data=NotificationData(msgids=msgids, success=True))
+        return len(rows)
+
     @run_in_db_thread
     def update_from_journal_put_results(self, msgid, journal_id):
         try:
@@ -842,7 +1365,7 @@ class ChatHistory(object, metaclass=Singleton):
             media_type_sql = media_type_sql.lstrip("(")
             query += " and media_type in (%s)" % media_type_sql
         if search_text:
-            query += " and body like %s" % ChatMessage.sqlrepr('%'+search_text+'%')
+            query += " and %s" % self._search_clause(search_text)
         if after_date:
             query += " and time >= %s" % ChatMessage.sqlrepr(after_date)
         if before_date:
@@ -875,7 +1398,7 @@ class ChatHistory(object, metaclass=Singleton):
                 media_type_sql = media_type_sql.lstrip("(")
                 query += " and media_type in (%s)" % media_type_sql
             if search_text:
-                query += " and body like %s" % ChatMessage.sqlrepr('%'+search_text+'%')
+                query += " and %s" % self._search_clause(search_text)
             if after_date:
                 query += " and time >= %s" % ChatMessage.sqlrepr(after_date)
             if before_date:
@@ -896,7 +1419,7 @@ class ChatHistory(object, metaclass=Singleton):
                 media_type_sql = media_type_sql.lstrip("(")
                 query += " and media_type in (%s)" % media_type_sql
             if search_text:
-                query += " and body like %s" % ChatMessage.sqlrepr('%'+search_text+'%')
+                query += " and %s" % self._search_clause(search_text)
             if after_date:
                 query += " and time >= %s" % ChatMessage.sqlrepr(after_date)
             if before_date:
@@ -921,7 +1444,7 @@ class ChatHistory(object, metaclass=Singleton):
                 media_type_sql = media_type_sql.lstrip("(")
                 query += " and media_type in (%s)" % media_type_sql
             if search_text:
-                query += " and body like %s" % ChatMessage.sqlrepr('%'+search_text+'%')
+                query += " and %s" % self._search_clause(search_text)
             if after_date:
                 query += " and time >= %s" % ChatMessage.sqlrepr(after_date)
             if before_date:
@@ -970,8 +1493,19 @@ class ChatHistory(object, metaclass=Singleton):
             media_type_sql = media_type_sql.rstrip(",)")
             media_type_sql = media_type_sql.lstrip("(")
             query += " and media_type in (%s)" % media_type_sql
+        clause_tables = None
         if search_text:
-            query += " and body like %s" % ChatMessage.sqlrepr('%'+search_text+'%')
+            if orderBy == 'rank' and self._use_fts(search_text):
+                # join the full-text index so results can be ordered by relevance
+                clause_tables = (self.fts_table,)
+                query += " and %s.rowid = chat_messages.id and %s match %s" % (self.fts_table, self.fts_table, ChatMessage.sqlrepr(self._fts_match(search_text)))
+                orderBy = '%s.rank' % self.fts_table
+                orderType = 'asc'
+            else:
+                query += " and %s" % self._search_clause(search_text)
+        if orderBy == 'rank':
+            # relevance ordering needs the full-text index, use chronological order otherwise
+            orderBy = 'time'
         if date:
             query += " and time like %s" % ChatMessage.sqlrepr(date+'%')
         if after_date:
@@ -981,7 +1515,7 @@ class ChatHistory(object, metaclass=Singleton):
         query += " order by %s %s limit %d" % (orderBy, orderType, count)
 
         try:
-            return list(ChatMessage.select(query))
+            return list(ChatMessage.select(query, clauseTables=clause_tables))
         except Exception as e:
             BlinkLogger().log_error("Error getting chat messages from chat history table: %s" % e)
             return []
@@ -989,6 +1523,43 @@ class ChatHistory(object, metaclass=Singleton):
     def get_messages(self, msgid=None, call_id=None, local_uri=None, remote_uri=None, media_type=None, date=None, after_date=None, before_date=None, search_text=None, orderBy='time', orderType='desc', count=100):
         return block_on(self._get_messages(msgid, call_id, local_uri, remote_uri, media_type, date, after_date, before_date, search_text, orderBy, orderType, count))
 
+    @run_in_db_thread
+    def _iter_messages(self, remote_uris, media_types, before, limit, search_text):
+        # One index range scan per (remote_uri, media_type) pair, each bounded
+        # by the limit, so the cost of a page does not depend on its depth
+        subqueries = []
+        for remote_uri in remote_uris:
+            for media_type in media_types:
+                query = "select %s from chat_messages where remote_uri = %s and media_type = %s" % (", ".join(ChatMessageRecord.columns), ChatMessage.sqlrepr(str(remote_uri)), ChatMessage.sqlrepr(media_type))
+                if before is not None:
+                    query += " and (time, id) < (%s, %s)" % (ChatMessage.sqlrepr(before[0]), ChatMessage.sqlrepr(before[1]))
+                if search_text:
+                    query += " and %s" % self._search_clause(search_text)
+                query += " order by time desc, id desc limit %d" % limit
+                subqueries.append("select * from (%s)" % query)
+
+        if not subqueries:
+            return []
+
+        query = " union all ".join(subqueries) + " order by time desc, id desc limit %d" % limit
+        try:
+            return [ChatMessageRecord(row) for row in self.db.queryAll(query)]
+        except Exception as e:
+            BlinkLogger().log_error("Error getting chat messages from chat history table: %s" % e)
+            return []
+
+    def iter_messages(self, remote_uris, media_types, before=None, limit=100, search_text=None):
+        """Return a page of ChatMessageRecord objects, newest first.
+
+        before is the cursor of the oldest record from the previous page, as
+        found in ChatMessageRecord.cursor, or None for the most recent page.
+        """
+        if isinstance(remote_uris, str):
+            remote_uris = (remote_uris,)
+        if isinstance(media_types, str):
+            media_types = (media_types,)
+        return block_on(self._iter_messages(remote_uris, media_types, before, limit, search_text))
+
     @run_in_db_thread
     def delete_journaled_messages(self, account, journal_ids, after_date):
         # TODO
@@ -1193,6 +1764,8 @@ class SessionHistoryReplicator(object):
 
     last_calls_connections = {}
     last_calls_connections_authRequestCount = {}
+    poll_interval = 300
+    max_poll_interval = 3600
 
     @property
     def sessionControllersManager(self):
@@ -1235,20 +1808,17 @@ class SessionHistoryReplicator(object):
             return
         query_string = "action=get_history&realm=%s" % account.id.domain
         url = urllib.parse.urlunparse(account.server.settings_url[:4] + (query_string,) + account.server.settings_url[5:])
-        nsurl = NSURL.URLWithString_(url)
         BlinkLogger().log_debug("Retrieving calls history for %s from %s" % (account.id, url))
-        request = NSURLRequest.requestWithURL_cachePolicy_timeoutInterval_(nsurl, NSURLRequestReloadIgnoringLocalAndRemoteCacheData, 15)
-        connection = NSURLConnection.alloc().initWithRequest_delegate_(request, self)
-        timer = NSTimer.timerWithTimeInterval_target_selector_userInfo_repeats_(300, self, "updateGetCallsTimer:", None, True)
-        NSRunLoop.currentRunLoop().addTimer_forMode_(timer, NSRunLoopCommonModes)
-        NSRunLoop.currentRunLoop().addTimer_forMode_(timer, NSEventTrackingRunLoopMode)
-        self.last_calls_connections[account.id] = { 'connection': connection,
+        self.last_calls_connections[account.id] = { 'connection': None,
             'authRequestCount': 0,
-            'timer': timer,
+            'timer': None,
             'url': url,
-            'data': ''
+            'data': '',
+            'status': None,
+            'headers': {},
+            'poll': ConditionalPoll(self.poll_interval, self.max_poll_interval)
         }
-        self.updateGetCallsTimer_(None)
+        self._get_calls(account.id)
 
     @run_in_gui_thread
     def close_last_call_connection(self, account):
@@ -1268,25 +1838,56 @@ class SessionHistoryReplicator(object):
         except KeyError:
             pass
 
+    def _get_calls(self, key):
+        try:
+            poll = self.last_calls_connections[key]
+        except KeyError:
+            return
+        if poll['connection']:
+            poll['connection'].cancel()
+        request = NSMutableURLRequest.requestWithURL_cachePolicy_timeoutInterval_(NSURL.URLWithString_(poll['url']), NSURLRequestReloadIgnoringLocalAndRemoteCacheData, 15)
+        # validators of the last response, the server answers with 304 if the history did not change
+        for name, value in poll['poll'].request_headers().items():
+            request.setValue_forHTTPHeaderField_(value, name)
+        poll['data'] = ''
+        poll['status'] = None
+        poll['headers'] = {}
+        poll['authRequestCount'] = 0
+        poll['connection'] = NSURLConnection.alloc().initWithRequest_delegate_(request, self)
+
+    def _schedule_get_calls(self, key, changed):
+        try:
+            poll = self.last_calls_connections[key]
+        except KeyError:
+            return
+        interval = poll['poll'].next_interval(changed)
+        if poll['timer'] and poll['timer'].isValid():
+            poll['timer'].invalidate()
+        poll['timer'] = NSTimer.timerWithTimeInterval_target_selector_userInfo_repeats_(interval, self, "updateGetCallsTimer:", None, False)
+        NSRunLoop.currentRunLoop().addTimer_forMode_(poll['timer'], NSRunLoopCommonModes)
+        NSRunLoop.currentRunLoop().addTimer_forMode_(poll['timer'], NSEventTrackingRunLoopMode)
+
     def updateGetCallsTimer_(self, timer):
         try:
             key = next((account for account in list(self.last_calls_connections.keys()) if self.last_calls_connections[account]['timer'] == timer))
         except StopIteration:
             return
         else:
+            self._get_calls(key)
+
+    # NSURLConnection delegate method
+    def connection_didReceiveResponse_(self, connection, response):
+        try:
+            key = next((account for account in list(self.last_calls_connections.keys()) if self.last_calls_connections[account]['connection'] == connection))
+        except StopIteration:
+            pass
+        else:
+            poll = self.last_calls_connections[key]
             try:
-                connection = self.last_calls_connections[key]['connection']
-                nsurl = NSURL.URLWithString_(self.last_calls_connections[key]['url'])
-            except KeyError:
-                pass
-            else:
-                if connection:
-                    connection.cancel()
-                request = NSURLRequest.requestWithURL_cachePolicy_timeoutInterval_(nsurl, NSURLRequestReloadIgnoringLocalAndRemoteCacheData, 15)
-                connection = NSURLConnection.alloc().initWithRequest_delegate_(request, self)
-                self.last_calls_connections[key]['data'] = ''
-                self.last_calls_connections[key]['authRequestCount'] = 0
-                self.last_calls_connections[key]['connection'] = connection
+                poll['status'] = response.statusCode()
+                poll['headers'] = dict(response.allHeaderFields())
+            except AttributeError:
+                return
 
     # NSURLConnection delegate method
     def connection_didReceiveData_(self, connection, data):
@@ -1308,19 +1909,39 @@ class SessionHistoryReplicator(object):
         except StopIteration:
             pass
         else:
-            BlinkLogger().log_debug("Calls history for %s retrieved from %s" % (key, self.last_calls_connections[key]['url']))
+            poll = self.last_calls_connections[key]
+            poll['connection'] = None
             try:
                 account = AccountManager().get_account(key)
             except KeyError:
-                pass
+                return
+
+            data, poll['data'] = poll['data'], ''
+            if poll['status'] not in (None, 200, 304):
+                BlinkLogger().log_debug("Failed to retrieve calls history for %s from %s: HTTP %s" % (key, poll['url'], poll['status']))
+                self._schedule_get_calls(key, True)
+                return
+
+            result = poll['poll'].response_received(poll['status'], poll['headers'], data)
+            if result == POLL_NOT_MODIFIED:
+                BlinkLogger().log_debug("Calls history for %s not modified since last retrieval" % key)
+                self._schedule_get_calls(key, False)
+                return
+            if result == POLL_UNCHANGED:
+                BlinkLogger().log_debug("Calls history for %s unchanged since last retrieval" % key)
+                self._schedule_get_calls(key, False)
+                return
+
+            BlinkLogger().log_debug("Calls history for %s retrieved from %s" % (key, poll['url']))
+            try:
+                calls = json.loads(data)
+            except (TypeError, json.decoder.JSONDecodeError) as e:
+                BlinkLogger().log_debug("Failed to parse calls history for %s from %s: %s" % (key, poll['url'], str(e)))
+                poll['poll'].applied(False)
+                self._schedule_get_calls(key, True)
             else:
-                BlinkLogger().log_debug("Calls history for %s retrieved from %s" % (key, self.last_calls_connections[key]['url']))
-                try:
-                    calls = json.loads(self.last_calls_connections[key]['data'])
-                except (TypeError, json.decoder.JSONDecodeError) as e:
-                    BlinkLogger().log_debug("Failed to parse calls history for %s from %s: %s" % (key, self.last_calls_connections[key]['url'], str(e)))
-                else:
-                    self.syncServerHistoryWithLocalHistory(account, calls)
+                self._schedule_get_calls(key, True)
+                self.syncServerHistoryWithLocalHistory(account, calls)
 
     # NSURLConnection delegate method
     def connection_didFailWithError_(self, connection, error):
@@ -1329,179 +1950,180 @@ class SessionHistoryReplicator(object):
         except StopIteration:
             return
         BlinkLogger().log_error("Failed to retrieve calls history for %s from %s: %s" % (key, self.last_calls_connections[key]['url'], error.userInfo()['NSLocalizedDescription']))
+        self.last_calls_connections[key]['connection'] = None
+        self._schedule_get_calls(key, True)
+
+    def _parse_server_call(self, account, direction, call):
+        try:
+            remote_uri, display_name, full_uri, fancy_uri = sipuri_components_from_string(call['remoteParty'])
+            status = call['status']
+            duration = call['duration']
+            call_id = call['sessionId']
+            from_tag = call['fromTag']
+            to_tag = call['toTag']
+            startTime = call['startTime']
+            stopTime = call['stopTime']
+            media = call['media']
+        except (KeyError, TypeError):
+            return None
 
-    @run_in_green_thread
-    @allocate_autorelease_pool
-    def syncServerHistoryWithLocalHistory(self, account, calls):
-        if calls is None:
-            return
-        received_synced = 0
-        placed_synced = 0
+        try:
+            start_time = datetime.strptime(startTime, "%Y-%m-%d  %H:%M:%S")
+        except (TypeError, ValueError):
+            return None
 
-        notification_center = NotificationCenter()
         try:
-            if calls['received']:
-                BlinkLogger().log_debug("%d received calls retrieved from call history server of %s" % (len(calls['received']),account.id))
-                for call in calls['received']:
-                    direction = 'incoming'
-                    local_entry = SessionHistory().get_entries(direction=direction, count=1, call_id=call['sessionId'], from_tag=call['fromTag'])
-                    if not len(local_entry):
-                        id=str(uuid1())
-                        participants = ""
-                        focus = "0"
-                        local_uri = str(account.id)
-                        try:
-                            remote_uri, display_name, full_uri, fancy_uri = sipuri_components_from_string(call['remoteParty'])
-                            status = call['status']
-                            duration = call['duration']
-                            call_id = call['sessionId']
-                            from_tag = call['fromTag']
-                            to_tag = call['toTag']
-                            startTime = call['startTime']
-                            stopTime = call['stopTime']
-                            media = call['media']
-                        except KeyError:
-                            continue
+            end_time = datetime.strptime(stopTime, "%Y-%m-%d  %H:%M:%S")
+        except (TypeError, ValueError):
+            end_time = start_time
 
-                        media_type = ", ".join(media) or 'audio'
+        try:
+            _timezone = timezone(call['timezone'].replace('\\/', '/'))
+        except KeyError:
+            _timezone = timezone('Europe/Amsterdam')  # default used by CDRTool app
 
-                        try:
-                            start_time = datetime.strptime(startTime, "%Y-%m-%d  %H:%M:%S")
-                        except (TypeError, ValueError):
-                            continue
+        start_time = _timezone.localize(start_time).astimezone(pytz.utc)
+        end_time = _timezone.localize(end_time).astimezone(pytz.utc)
 
-                        try:
-                            _timezone = timezone(call['timezone'].replace('\\/', '/'))
-                        except KeyError:
-                            _timezone = timezone('Europe/Amsterdam') #default used by CDRTool app
+        if duration > 0:
+            success = 'completed'
+        elif direction == 'incoming':
+            success = 'missed'
+        else:
+            success = 'cancelled' if status == "487" else 'failed'
+
+        return {'session_id': str(uuid1()),
+                'media_types': ", ".join(media) or 'audio',
+                'media': media,
+                'direction': direction,
+                'status': success,
+                'failure_reason': status,
+                'start_time': start_time,
+                'end_time': end_time,
+                'duration': duration,
+                'local_uri': str(account.id),
+                'remote_uri': remote_uri,
+                'remote_focus': "0",
+                'participants': "",
+                'sip_callid': call_id,
+                'sip_fromtag': from_tag,
+                'sip_totag': to_tag}
 
-                        try:
-                            end_time = datetime.strptime(stopTime, "%Y-%m-%d  %H:%M:%S")
-                        except (TypeError, ValueError):
-                            end_time = start_time
-
-                        start_time = _timezone.localize(start_time).astimezone(pytz.utc)
-                        end_time = _timezone.localize(end_time).astimezone(pytz.utc)
-
-                        success = 'completed' if duration > 0 else 'missed'
-
-                        BlinkLogger().log_debug("Adding incoming %s call %s at %s from %s from server history" % (success, call_id, start_time, remote_uri))
-                        received_synced += 1
-                        self.sessionControllersManager.add_to_session_history(id, media_type, direction, success, status, start_time, end_time, duration, local_uri, remote_uri, focus, participants, call_id, from_tag, to_tag, '', '')
-                        if 'audio' in media:
-                            direction = 'incoming'
-                            status = 'delivered'
-                            cpim_from = remote_uri
-                            cpim_to = local_uri
-                            timestamp = str(ISOTimestamp.now())
-                            if success == 'missed':
-                                message = '<h3>Missed Incoming Audio Call</h3>'
-                                #message += '<h4>Technicall Information</h4><table class=table_session_info><tr><td class=td_session_info>Call Id</td><td class=td_session_info>%s</td></tr><tr><td class=td_session_info>From Tag</td><td class=td_session_info>%s</td></tr><tr><td class=td_session_info>To Tag</td><td class=td_session_info>%s</td></tr></table>' % (call_id, from_tag, to_tag)
-                                media_type = 'missed-call'
-                            else:
-                                duration = self.sessionControllersManager.get_printed_duration(start_time, end_time)
-                                message = '<h3>Incoming Audio Call</h3>'
-                                message += '<p>The call has been answered elsewhere'
-                                message += '<p>Call duration: %s' % duration
-                                #message += '<h4>Technicall Information</h4><table class=table_session_info><tr><td class=td_session_info>Call Id</td><td class=td_session_info>%s</td></tr><tr><td class=td_session_info>From Tag</td><td class=td_session_info>%s</td></tr><tr><td class=td_session_info>To Tag</td><td class=td_session_info>%s</td></tr></table>' % (call_id, from_tag, to_tag)
-                                media_type = 'audio'
-                            self.sessionControllersManager.add_to_chat_history(id, media_type, local_uri, remote_uri, direction, cpim_from, cpim_to, timestamp, message, status, skip_replication=True)
-                            notification_center.post_notification('AudioCallLoggedToHistory', sender=self, data=NotificationData(direction=direction, history_entry=False, remote_party=remote_uri, local_party=local_uri, check_contact=True, missed=bool(media_type =='missed-call')))
-
-                        if 'audio' in call['media'] and success == 'missed':
-                            elapsed = end_time - start_time
-                            elapsed_hours = elapsed.days * 24 + elapsed.seconds / (60*60)
-                            if elapsed_hours < 48:
-                                try:
-                                    uri = SIPURI.parse('sip:'+str(remote_uri))
-                                except Exception:
-                                    pass
-                                else:
-                                    nc_title = 'Missed Call (' + media_type  + ')'
-                                    nc_subtitle = 'From %s' % format_identity_to_string(uri, check_contact=True, format='full')
-                                    nc_body = 'Missed call at %s' % start_time.strftime("%Y-%m-%d %H:%M")
-                                    NSApp.delegate().gui_notify(nc_title, nc_body, nc_subtitle)
+    @run_in_gui_thread
+    def _server_history_applied(self, key, success):
+        try:
+            poll = self.last_calls_connections[key]['poll']
+        except KeyError:
+            return
+        # validators and digest only skip documents that were fully applied
+        poll.applied(success)
 
-        except Exception as e:
-            BlinkLogger().log_error("Error: %s" % e)
-            import traceback
-            print(traceback.print_exc())
-
-        try:
-            if calls['placed']:
-                for call in calls['placed']:
-                    direction = 'outgoing'
-                    local_entry = SessionHistory().get_entries(direction=direction, count=1, call_id=call['sessionId'], from_tag=call['fromTag'])
-                    if not len(local_entry):
-                        id=str(uuid1())
-                        participants = ""
-                        focus = "0"
-                        local_uri = str(account.id)
-                        try:
-                            remote_uri, display_name, full_uri, fancy_uri = sipuri_components_from_string(call['remoteParty'])
-                            status = call['status']
-                            duration = call['duration']
-                            call_id = call['sessionId']
-                            from_tag = call['fromTag']
-                            to_tag = call['toTag']
-                            startTime = call['startTime']
-                            stopTime = call['stopTime']
-                            media = call['media']
-                        except KeyError:
-                            continue
+    @run_in_green_thread
+    def syncServerHistoryWithLocalHistory(self, account, calls):
+        self._server_history_applied(account.id, self._syncServerHistoryWithLocalHistory(account, calls))
 
-                        media_type = ", ".join(media) or 'audio'
+    @allocate_autorelease_pool
+    def _syncServerHistoryWithLocalHistory(self, account, calls):
+        """Add the calls missing from the local history, returns False if they could not be saved"""
+        if calls is None:
+            return True
 
-                        try:
-                            start_time = datetime.strptime(startTime, "%Y-%m-%d  %H:%M:%S")
-                        except (TypeError, ValueError):
-                            continue
+        server_calls = []
+        for direction, key in (('incoming', 'received'), ('outgoing', 'placed')):
+            try:
+                entries = calls[key] or []
+            except (KeyError, TypeError):
+                continue
+            if direction == 'incoming' and entries:
+                BlinkLogger().log_debug("%d received calls retrieved from call history server of %s" % (len(entries), account.id))
+            server_calls.extend(entry for entry in (self._parse_server_call(account, direction, call) for call in entries) if entry is not None)
 
-                        try:
-                            end_time = datetime.strptime(stopTime, "%Y-%m-%d  %H:%M:%S")
-                        except (TypeError, ValueError):
-                            end_time = start_time
+        if not server_calls:
+            return True
 
-                        try:
-                            _timezone = timezone(call['timezone'].replace('\\/', '/'))
-                        except KeyError:
-                            _timezone = timezone('Europe/Amsterdam')  # default used by CDRTool app
+        # one lookup for the whole batch, the difference is computed here
+        known_calls = block_on(SessionHistory().get_known_calls([entry['sip_callid'] for entry in server_calls]))
+        if known_calls is None:
+            return False
+
+        new_calls = []
+        for entry in server_calls:
+            key = (entry['direction'], entry['sip_callid'], entry['sip_fromtag'])
+            if key not in known_calls:
+                known_calls.add(key)
+                new_calls.append(entry)
+
+        if not new_calls:
+            return True
+
+        for entry in new_calls:
+            BlinkLogger().log_debug("Adding %s %s call %s at %s %s %s from server history" % (entry['direction'], entry['status'], entry['sip_callid'], entry['start_time'], 'from' if entry['direction'] == 'incoming' else 'to', entry['remote_uri']))
+
+        if not block_on(SessionHistory().add_entries_bulk(new_calls)):
+            return False
+
+        received_synced = 0
+        placed_synced = 0
+        chat_messages = []
+        notification_center = NotificationCenter()
+
+        for entry in new_calls:
+            try:
+                if entry['direction'] == 'incoming':
+                    received_synced += 1
+                else:
+                    placed_synced += 1
+
+                if 'audio' not in entry['media']:
+                    continue
+
+                local_uri = entry['local_uri']
+                remote_uri = entry['remote_uri']
+                success = entry['status']
+                media_type = 'audio'
+                if entry['direction'] == 'incoming':
+                    if success == 'missed':
+                        message = '<h3>Missed Incoming Audio Call</h3>'
+                        media_type = 'missed-call'
+                    else:
+                        duration = self.sessionControllersManager.get_printed_duration(entry['start_time'], entry['end_time'])
+                        message = '<h3>Incoming Audio Call</h3>'
+                        message += '<p>The call has been answered elsewhere'
+                        message += '<p>Call duration: %s' % duration
+                else:
+                    if success == 'failed':
+                        message = '<h3>Failed Outgoing Audio Call</h3>'
+                        message += '<p>Reason: %s' % entry['failure_reason']
+                    elif success == 'cancelled':
+                        message = '<h3>Cancelled Outgoing Audio Call</h3>'
+                    else:
+                        duration = self.sessionControllersManager.get_printed_duration(entry['start_time'], entry['end_time'])
+                        message = '<h3>Outgoing Audio Call</h3>'
+                        message += '<p>Call duration: %s' % duration
 
-                        start_time = _timezone.localize(start_time).astimezone(pytz.utc)
-                        end_time = _timezone.localize(end_time).astimezone(pytz.utc)
+                chat_messages.append({'msgid': entry['session_id'], 'media_type': media_type, 'local_uri': local_uri, 'remote_uri': remote_uri, 'direction': 'incoming', 'cpim_from': remote_uri, 'cpim_to': local_uri, 'cpim_timestamp': str(ISOTimestamp.now()), 'body': message, 'content_type': 'html', 'private': '0', 'status': 'delivered'})
+                notification_center.post_notification('AudioCallLoggedToHistory', sender=self, data=NotificationData(direction=entry['direction'], history_entry=False, remote_party=remote_uri, local_party=local_uri, check_contact=True, missed=bool(media_type == 'missed-call')))
 
-                        if duration > 0:
-                            success = 'completed'
+                if media_type == 'missed-call':
+                    elapsed = entry['end_time'] - entry['start_time']
+                    elapsed_hours = elapsed.days * 24 + elapsed.seconds / (60*60)
+                    if elapsed_hours < 48:
+                        try:
+                            uri = SIPURI.parse('sip:'+str(remote_uri))
+                        except Exception:
+                            pass
                         else:
-                            success = 'cancelled' if status == "487" else 'failed'
-
-                        BlinkLogger().log_debug("Adding outgoing %s call %s at %s to %s from server history" % (success, call_id, start_time, remote_uri))
-                        placed_synced += 1
-                        self.sessionControllersManager.add_to_session_history(id, media_type, direction, success, status, start_time, end_time, duration, local_uri, remote_uri, focus, participants, call_id, from_tag, to_tag, '', '')
-                        if 'audio' in media:
-                            local_uri = local_uri
-                            remote_uri = remote_uri
-                            direction = 'incoming'
-                            status = 'delivered'
-                            cpim_from = remote_uri
-                            cpim_to = local_uri
-                            timestamp = str(ISOTimestamp.now())
-                            media_type = 'audio'
-                            if success == 'failed':
-                                message = '<h3>Failed Outgoing Audio Call</h3>'
-                                message += '<p>Reason: %s' % status
-                            elif success == 'cancelled':
-                                message= '<h3>Cancelled Outgoing Audio Call</h3>'
-                            else:
-                                duration = self.sessionControllersManager.get_printed_duration(start_time, end_time)
-                                message= '<h3>Outgoing Audio Call</h3>'
-                                message += '<p>Call duration: %s' % duration
-                            self.sessionControllersManager.add_to_chat_history(id, media_type, local_uri, remote_uri, direction, cpim_from, cpim_to, timestamp, message, status, skip_replication=True)
-                            NotificationCenter().post_notification('AudioCallLoggedToHistory', sender=self, data=NotificationData(direction='outgoing', history_entry=False, remote_party=remote_uri, local_party=local_uri, check_contact=True, missed=False))
-        except Exception as e:
-            BlinkLogger().log_error("Error: %s" % e)
-            import traceback
-            print(traceback.print_exc())
+                            nc_title = 'Missed Call (' + entry['media_types'] + ')'
+                            nc_subtitle = 'From %s' % format_identity_to_string(uri, check_contact=True, format='full')
+                            nc_body = 'Missed call at %s' % entry['start_time'].strftime("%Y-%m-%d %H:%M")
+                            NSApp.delegate().gui_notify(nc_title, nc_body, nc_subtitle)
+            except Exception as e:
+                BlinkLogger().log_error("Error: %s" % e)
+                import traceback
+                print(traceback.print_exc())
+
+        if chat_messages:
+            ChatHistory().add_messages_bulk(chat_messages)
 
         if placed_synced:
             BlinkLogger().log_info("%d placed calls synced from server history of %s" % (placed_synced, account))
@@ -1509,6 +2131,8 @@ class SessionHistoryReplicator(object):
         if received_synced:
             BlinkLogger().log_info("%d received calls synced from server history of %s" % (received_synced, account))
 
+        return True
+
     # NSURLConnection delegate method
     def connection_didReceiveAuthenticationChallenge_(self, connection, challenge):
         try:
@@ -1533,6 +2157,195 @@ class SessionHistoryReplicator(object):
                     BlinkLogger().log_error("Error: invalid web authentication when retrieving call history of %s" % key)
 
 
+def decode_journal_entries(entries, key):
+    """Decrypt and decode a batch of chat journal entries.
+
+    Runs in the journal-decode thread pool. Returns one tuple per entry,
+    (journal_id, uuid, timestamp, message, error), where message is the
+    decoded chat message or None when the entry could not be used, in
+    which case error says why. An entry missing its envelope fields
+    yields None as journal_id.
+    """
+    decoded = []
+    for entry in entries:
+        try:
+            data = entry['data']
+            uuid = entry['uuid']
+            timestamp = entry['timestamp']
+            journal_id = str(entry['id'])
+        except (KeyError, TypeError):
+            decoded.append((None, None, None, None, 'invalid journal entry'))
+            continue
+
+        try:
+            message = json.loads(decrypt_with_key(base64.b64decode(data), key))
+        except Exception as e:
+            decoded.append((journal_id, uuid, timestamp, None, 'decryption failed: %s' % e))
+            continue
+
+        if not isinstance(message, dict):
+            decoded.append((journal_id, uuid, timestamp, None, 'invalid message'))
+            continue
+
+        missing = [field for field in ChatHistoryReplicator.journal_message_fields if field not in message]
+        if missing:
+            decoded.append((journal_id, uuid, timestamp, None, 'missing %s' % ', '.join(missing)))
+            continue
+
+        message.setdefault('call_id', '')
+        message.setdefault('encryption', '')
+        decoded.append((journal_id, uuid, timestamp, message, None))
+
+    return decoded
+
+
+class ChatReplicationStore(object, metaclass=Singleton):
+    """Chat replication state, kept in history.sqlite.
+
+    Holds the journal entries not yet pushed to the chat history server,
+    the journal ids not yet deleted from it and the last journal timestamp
+    replicated for every account. Every change is written as its own
+    small statement in the db thread, the replicator keeps the working
+    copy in memory.
+    """
+    __version__ = 1
+
+    table = 'chat_replication'
+    schema = ("create table if not exists chat_replication_outgoing (account text not null, msgid text not null, data text not null, primary key (account, msgid))",
+              "create table if not exists chat_replication_deletes (account text not null, journal_id text not null, primary key (account, journal_id))",
+              "create table if not exists chat_replication_timestamps (account text primary key, timestamp numeric not null, msgids text not null)")
+    legacy_files = {'outgoing': 'chat_replication/chat_replication_journal.pickle',
+                    'deletes': 'chat_replication/chat_replication_delete_journal.pickle',
+                    'timestamps': 'chat_replication/chat_replication_timestamp.pickle'}
+    chunk_size = 500
+
+    def __init__(self):
+        path = ApplicationData.get('history')
+        makedirs(path)
+        db_uri = "sqlite://" + os.path.join(path,"history.sqlite")
+        TableVersions()    # initialize versions table
+        self._initialize(db_uri)
+
+    @run_in_db_thread
+    def _initialize(self, db_uri):
+        self.db = connectionForURI(db_uri)
+        try:
+            version = TableVersions().get_table_version(self.table)
+            for query in self.schema:
+                self.db.queryAll(query)
+        except Exception as e:
+            BlinkLogger().log_error("Error creating chat replication tables: %s" % e)
+            return
+
+        if version is None:
+            self._migrate_legacy_files()
+            TableVersions().set_table_version(self.table, self.__version__)
+
+    def _migrate_legacy_files(self):
+        # Caller needs to be in the db thread
+        state = {}
+        for name, filename in self.legacy_files.items():
+            try:
+                with open(ApplicationData.get(filename), 'rb') as f:
+                    state[name] = pickle.load(f)
+            except Exception:
+                state[name] = {}
+
+        queries = []
+        for account, entries in state['outgoing'].items():
+            rows = ["(%s, %s, %s)" % (self.db.sqlrepr(str(account)), self.db.sqlrepr(msgid), self.db.sqlrepr(entry['data'])) for msgid, entry in entries.items()]
+            queries.extend("insert or replace into chat_replication_outgoing (account, msgid, data) values %s" % ", ".join(rows[i:i+self.chunk_size]) for i in range(0, len(rows), self.chunk_size))
+        for account, journal_ids in state['deletes'].items():
+            rows = ["(%s, %s)" % (self.db.sqlrepr(str(account)), self.db.sqlrepr(str(journal_id))) for journal_id in journal_ids]
+            queries.extend("insert or replace into chat_replication_deletes (account, journal_id) values %s" % ", ".join(rows[i:i+self.chunk_size]) for i in range(0, len(rows), self.chunk_size))
+        for account, journal_timestamp in state['timestamps'].items():
+            msgids = json.dumps(list(journal_timestamp.get('msgid_list', [])))
+            queries.append("insert or replace into chat_replication_timestamps (account, timestamp, msgids) values (%s, %s, %s)" % (self.db.sqlrepr(str(account)), self.db.sqlrepr(journal_timestamp['timestamp']), self.db.sqlrepr(msgids)))
+
+        if queries:
+            transaction = self.db.transaction()
+            try:
+                for query in queries:
+                    transaction.query(query)
+            except Exception as e:
+                transaction.rollback()
+                BlinkLogger().log_error("Error migrating chat replication journal: %s" % e)
+                return
+            else:
+                transaction.commit(close=True)
+            BlinkLogger().log_info("Migrated chat replication journal to the history database")
+
+        for filename in self.legacy_files.values():
+            try:
+                os.unlink(ApplicationData.get(filename))
+            except OSError:
+                pass
+
+    def _execute(self, queries):
+        # Caller needs to be in the db thread
+        transaction = self.db.transaction()
+        try:
+            for query in queries:
+                transaction.query(query)
+        except Exception as e:
+            transaction.rollback()
+            BlinkLogger().log_error("Error updating chat replication journal: %s" % e)
+            return False
+        else:
+            transaction.commit(close=True)
+            return True
+
+    @run_in_db_thread
+    def load(self):
+        outgoing_entries = {}
+        delete_entries = {}
+        journal_timestamps = {}
+        try:
+            for account, msgid, data in self.db.queryAll("select account, msgid, data from chat_replication_outgoing"):
+                outgoing_entries.setdefault(account, {})[msgid] = {'data': data, 'id': msgid}
+            for account, journal_id in self.db.queryAll("select account, journal_id from chat_replication_deletes"):
+                delete_entries.setdefault(account, set()).add(journal_id)
+            for account, timestamp, msgids in self.db.queryAll("select account, timestamp, msgids from chat_replication_timestamps"):
+                journal_timestamps[account] = {'timestamp': timestamp, 'msgids': set(json.loads(msgids))}
+        except Exception as e:
+            BlinkLogger().log_error("Error loading chat replication journal: %s" % e)
+        return outgoing_entries, delete_entries, journal_timestamps
+
+    @run_in_db_thread
+    def add_outgoing_entry(self, account, msgid, data):
+        query = "insert or replace into chat_replication_outgoing (account, msgid, data) values (%s, %s, %s)" % (self.db.sqlrepr(str(account)), self.db.sqlrepr(msgid), self.db.sqlrepr(data))
+        return self._execute([query])
+
+    @run_in_db_thread
+    def remove_outgoing_entries(self, account, msgids):
+        msgids = [self.db.sqlrepr(msgid) for msgid in msgids]
+        queries = ["delete from chat_replication_outgoing where account = %s and msgid in (%s)" % (self.db.sqlrepr(str(account)), ", ".join(msgids[i:i+self.chunk_size])) for i in range(0, len(msgids), self.chunk_size)]
+        return self._execute(queries)
+
+    @run_in_db_thread
+    def add_delete_entries(self, account, journal_ids):
+        rows = ["(%s, %s)" % (self.db.sqlrepr(str(account)), self.db.sqlrepr(str(journal_id))) for journal_id in journal_ids]
+        queries = ["insert or replace into chat_replication_deletes (account, journal_id) values %s" % ", ".join(rows[i:i+self.chunk_size]) for i in range(0, len(rows), self.chunk_size)]
+        return self._execute(queries)
+
+    @run_in_db_thread
+    def remove_delete_entries(self, account, journal_ids):
+        journal_ids = [self.db.sqlrepr(str(journal_id)) for journal_id in journal_ids]
+        queries = ["delete from chat_replication_deletes where account = %s and journal_id in (%s)" % (self.db.sqlrepr(str(account)), ", ".join(journal_ids[i:i+self.chunk_size])) for i in range(0, len(journal_ids), self.chunk_size)]
+        return self._execute(queries)
+
+    @run_in_db_thread
+    def remove_pending_entries(self, account):
+        queries = ["delete from chat_replication_outgoing where account = %s" % self.db.sqlrepr(str(account)),
+                   "delete from chat_replication_deletes where account = %s" % self.db.sqlrepr(str(account))]
+        return self._execute(queries)
+
+    @run_in_db_thread
+    def set_journal_timestamp(self, account, timestamp, msgids):
+        query = "insert or replace into chat_replication_timestamps (account, timestamp, msgids) values (%s, %s, %s)" % (self.db.sqlrepr(str(account)), self.db.sqlrepr(timestamp), self.db.sqlrepr(json.dumps(msgids)))
+        return self._execute([query])
+
+
 @implementer(IObserver)
 class ChatHistoryReplicator(object, metaclass=Singleton):
 
@@ -1542,17 +2355,23 @@ class ChatHistoryReplicator(object, metaclass=Singleton):
     connections_for_outgoing_replication = {}
     connections_for_incoming_replication = {}
     connections_for_delete_replication = {}
+    connection_owners = {}
     last_journal_timestamp = {}
     replication_server_summary = {}
     disabled_accounts = set()
     paused = False
+    state_loaded = False
     debug = False
     sync_counter = {}
+    journal_page_size = 500
+    journal_decode_batch_size = 100
+    journal_message_fields = ('msgid', 'media_type', 'local_uri', 'remote_uri', 'direction', 'cpim_from', 'cpim_to', 'cpim_timestamp',
+                              'body', 'content_type', 'private', 'status', 'time')
+    replication_keys = {}
 
     def __init__(self):
         BlinkLogger().log_debug('Starting Chat History Replicator')
         notification_center = NotificationCenter()
-        notification_center.add_observer(self, name='BlinkWillTerminate')
         notification_center.add_observer(self, name='ChatReplicationJournalEntryAdded')
         notification_center.add_observer(self, name='ChatReplicationJournalEntryDeleted')
         notification_center.add_observer(self, name='CFGSettingsObjectDidChange')
@@ -1563,8 +2382,6 @@ class ChatHistoryReplicator(object, metaclass=Singleton):
         path = ApplicationData.get('chat_replication')
         makedirs(path)
 
-        valid_accounts = list(account.id for account in AccountManager().get_accounts() if account is not BonjourAccount() and account.server.settings_url)
-        
         try:
             with open(ApplicationData.get('chat_replication_journal.pickle'), 'rb'): pass
         except IOError:
@@ -1601,78 +2418,45 @@ class ChatHistoryReplicator(object, metaclass=Singleton):
             except shutil.Error:
                 pass
 
-        try:
-            with open(ApplicationData.get('chat_replication/chat_replication_journal.pickle'), 'rb') as f:
-                self.outgoing_entries = pickle.load(f)
-        except Exception:
-            pass
-        else:
-            replication_accounts = list(self.outgoing_entries.keys())
-            for key in replication_accounts:
-                if key not in valid_accounts:
-                    del self.outgoing_entries[key]
-
-            for key in list(self.outgoing_entries.keys()):
-                if len(self.outgoing_entries[key]):
-                    BlinkLogger().log_debug("%d new chat entries not yet replicated to chat history server for account %s" % (len(self.outgoing_entries[key]), key))
-                else:
-                    BlinkLogger().log_debug("No pending chat entries for chat history server of account %s" % key)
-
-        try:
-            with open(ApplicationData.get('chat_replication/chat_replication_delete_journal.pickle'), 'rb') as f:
-                self.for_delete_entries = pickle.load(f)
-        except Exception:
-            pass
-        else:
-            replication_accounts = list(self.for_delete_entries.keys())
-            for key in replication_accounts:
-                if key not in valid_accounts:
-                    del self.for_delete_entries[key]
-
-            for key in list(self.for_delete_entries.keys()):
-                BlinkLogger().log_debug("%d chat deleted entries not yet replicated to chat history server of account %s" % (len(self.for_delete_entries[key]), key))
-
-        try:
-            with open(ApplicationData.get('chat_replication/chat_replication_timestamp.pickle'), 'rb') as f:
-                self.last_journal_timestamp = pickle.load(f)
-        except Exception:
-            pass
+        self.store = ChatReplicationStore()
+        self.store.load().addCallback(self._load_state)
 
         self.timer = NSTimer.timerWithTimeInterval_target_selector_userInfo_repeats_(80.0, self, "updateTimer:", None, True)
         NSRunLoop.currentRunLoop().addTimer_forMode_(self.timer, NSRunLoopCommonModes)
         NSRunLoop.currentRunLoop().addTimer_forMode_(self.timer, NSEventTrackingRunLoopMode)
 
-    def save_delete_journal_on_disk(self):
-        storage_path = ApplicationData.get('chat_replication/chat_replication_delete_journal.pickle')
-        try:
-            pickle.dump(self.for_delete_entries, open(storage_path, "wb+"))
-        except (pickle.PickleError, IOError):
-            pass
+    @run_in_gui_thread
+    def _load_state(self, state):
+        outgoing_entries, delete_entries, journal_timestamps = state
+        valid_accounts = list(account.id for account in AccountManager().get_accounts() if account is not BonjourAccount() and account.server.settings_url)
 
-    def save_journal_on_disk(self):
-        storage_path = ApplicationData.get('chat_replication/chat_replication_journal.pickle')
-        try:
-            pickle.dump(self.outgoing_entries, open(storage_path, "wb+"))
-        except (pickle.PickleError, IOError):
-            pass
+        for key in set(outgoing_entries) | set(delete_entries):
+            if key not in valid_accounts:
+                outgoing_entries.pop(key, None)
+                delete_entries.pop(key, None)
+                self.store.remove_pending_entries(key)
 
-    def save_journal_timestamp_on_disk(self):
-        storage_path = ApplicationData.get('chat_replication/chat_replication_timestamp.pickle')
-        try:
-            pickle.dump(self.last_journal_timestamp, open(storage_path, "wb+"))
-        except (pickle.PickleError, IOError):
-            pass
+        for key, entries in outgoing_entries.items():
+            pending_entries = self.outgoing_entries.setdefault(key, {})
+            for msgid, entry in entries.items():
+                pending_entries.setdefault(msgid, entry)
+            BlinkLogger().log_debug("%d new chat entries not yet replicated to chat history server for account %s" % (len(entries), key))
+
+        for key, journal_ids in delete_entries.items():
+            self.for_delete_entries.setdefault(key, set()).update(journal_ids)
+            BlinkLogger().log_debug("%d chat deleted entries not yet replicated to chat history server of account %s" % (len(journal_ids), key))
+
+        for key, journal_timestamp in journal_timestamps.items():
+            self.last_journal_timestamp.setdefault(key, journal_timestamp)
+
+        self.state_loaded = True
+        self.updateTimer_(None)
 
     @run_in_gui_thread
     def handle_notification(self, notification):
         handler = getattr(self, '_NH_%s' % notification.name, Null)
         handler(notification.sender, notification.data)
 
-    def _NH_BlinkWillTerminate(self, sender, data):
-        self.save_journal_on_disk()
-        self.save_delete_journal_on_disk()
-        self.save_journal_timestamp_on_disk()
-
     def _NH_SystemWillSleep(self, sender, data):
         self.paused = True
 
@@ -1684,6 +2468,7 @@ class ChatHistoryReplicator(object, metaclass=Singleton):
         self.updateTimer_(None)
 
     def _NH_ChatReplicationJournalEntryDeleted(self, sender, data):
+        scheduled_entries = {}
         for entry in data.entries:
             journal_id = entry[0]
             account = entry[1]
@@ -1693,14 +2478,18 @@ class ChatHistoryReplicator(object, metaclass=Singleton):
                 continue
             else:
                 if acc is BonjourAccount():
-                    return
+                    continue
                 if acc.chat.disable_replication:
                     continue
 
                 self.for_delete_entries.setdefault(account, set())
                 self.for_delete_entries[account].add(journal_id)
+                scheduled_entries.setdefault(account, []).append(journal_id)
                 BlinkLogger().log_debug("Scheduling deletion of chat journal id %s for account %s" % (journal_id, account))
 
+        for account, journal_ids in scheduled_entries.items():
+            self.store.add_delete_entries(account, journal_ids)
+
     def _NH_ChatReplicationJournalEntryAdded(self, sender, data):
         try:
             account = data.entry['local_uri']
@@ -1728,7 +2517,7 @@ class ChatHistoryReplicator(object, metaclass=Singleton):
 
             if replication_password:
                 try:
-                    entry = encrypt(entry, replication_password).encode('base64')
+                    entry = base64.b64encode(encrypt_with_key(entry, self.replication_key(account, replication_password))).decode()
                 except Exception as e:
                     BlinkLogger().log_debug("Failed to encrypt replication data for %s: %s" % (account, e))
                     return
@@ -1736,6 +2525,7 @@ class ChatHistoryReplicator(object, metaclass=Singleton):
                 self.outgoing_entries[account][data.entry['msgid']] = {'data': entry,
                                                                        'id'   : data.entry['msgid']
                                                                       }
+                self.store.add_outgoing_entry(account, data.entry['msgid'], entry)
 
     def _NH_CFGSettingsObjectDidChange(self, sender, data):
         if isinstance(sender, Account) and sender.enabled:
@@ -1744,12 +2534,25 @@ class ChatHistoryReplicator(object, metaclass=Singleton):
             except KeyError:
                 pass
 
+    def replication_key(self, account, replication_password):
+        # the AES key is derived from the password once and reused for every entry
+        try:
+            password, key = self.replication_keys[account]
+        except KeyError:
+            pass
+        else:
+            if password == replication_password:
+                return key
+        key = derive_key(replication_password)
+        self.replication_keys[account] = (replication_password, key)
+        return key
+
     def disableReplication(self, account, reason=None):
         BlinkLogger().log_debug("Disabled chat history replication for %s: %s" % (account, reason))
         self.disabled_accounts.add(account)
 
     def get_last_journal_timestamp(self, account):
-        last_journal_timestamp = {'timestamp': 0, 'msgid_list': []}
+        last_journal_timestamp = {'timestamp': 0, 'msgids': set()}
         try:
             last_journal_timestamp = self.last_journal_timestamp[account]
         except KeyError:
@@ -1794,13 +2597,16 @@ class ChatHistoryReplicator(object, metaclass=Singleton):
 
     @run_in_green_thread
     @allocate_autorelease_pool
-    def addLocalHistoryFromRemoteJournalEntries(self, journal, account):
-        try:
-            counter = self.sync_counter[account]
-        except KeyError:
-            self.sync_counter[account] = 1
-        else:
-            self.sync_counter[account] += 1
+    def addLocalHistoryFromRemoteJournalEntries(self, journal, account, first_page=True, last_page=True):
+        # a journal streamed from the server is applied in several pages,
+        # only the first one counts as a new synchronization
+        if first_page:
+            try:
+                counter = self.sync_counter[account]
+            except KeyError:
+                self.sync_counter[account] = 1
+            else:
+                self.sync_counter[account] += 1
 
         try:
             success = journal['success']
@@ -1861,91 +2667,99 @@ class ChatHistoryReplicator(object, metaclass=Singleton):
         if not replication_password:
             return
 
-        notify_data = {}
-        for entry in results:
-            try:
-                data           = entry['data']
-                uuid           = entry['uuid']
-                timestamp      = entry['timestamp']
-                journal_id     = str(entry['id'])
-                try:
-                    last_journal_timestamp = self.last_journal_timestamp[account]
-                    old_timestamp = last_journal_timestamp['timestamp']
-                except KeyError:
-                    self.last_journal_timestamp[account] = {'timestamp': timestamp, 'msgid_list': []}
-                else:
-                    if old_timestamp < timestamp:
-                        self.last_journal_timestamp[account] = {'timestamp': timestamp, 'msgid_list': []}
+        # decryption and decoding run in parallel batches off this thread,
+        # only the validated messages come back here
+        key = self.replication_key(account, replication_password)
+        batch_size = self.journal_decode_batch_size
+        batches = [deferToThreadPool(reactor, decode_pool, decode_journal_entries, results[i:i+batch_size], key) for i in range(0, len(results), batch_size)]
+        decoded_entries = (entry for batch in block_on(defer.gatherResults(batches, consumeErrors=True)) for entry in batch)
 
-            except KeyError:
+        notify_data = {}
+        messages = []
+        journal_timestamp_changed = False
+        for journal_id, uuid, timestamp, data, error in decoded_entries:
+            if journal_id is None:
                 BlinkLogger().log_debug("Failed to parse chat history server results for %s" % account)
                 self.disableReplication(account)
                 return
 
-            if replication_password:
-                try:
-                    data = decrypt(data.decode('base64'), replication_password)
-                except Exception as e:
-                    BlinkLogger().log_debug("Failed to decrypt chat history server journal id %s for %s: %s" % (journal_id, account, e))
-                    continue
-
             try:
-                data = json.loads(data)
-            except (TypeError, json.decoder.JSONDecodeError) as e:
-                BlinkLogger().log_debug("Failed to decode chat history server journal id %s for %s: %s" % (journal_id, account, e))
+                last_journal_timestamp = self.last_journal_timestamp[account]
+                old_timestamp = last_journal_timestamp['timestamp']
+            except KeyError:
+                self.last_journal_timestamp[account] = {'timestamp': timestamp, 'msgids': set()}
+                journal_timestamp_changed = True
+            else:
+                if old_timestamp < timestamp:
+                    self.last_journal_timestamp[account] = {'timestamp': timestamp, 'msgids': set()}
+                    journal_timestamp_changed = True
+
+            if data is None:
+                BlinkLogger().log_debug("Failed to decode chat history server journal id %s for %s: %s" % (journal_id, account, error))
                 continue
 
-            if data['msgid'] not in self.last_journal_timestamp[account]['msgid_list']:
+            if data['msgid'] not in self.last_journal_timestamp[account]['msgids']:
+                self.last_journal_timestamp[account]['msgids'].add(data['msgid'])
+                journal_timestamp_changed = True
+
+                messages.append({'msgid': data['msgid'],
+                                 'media_type': data['media_type'],
+                                 'local_uri': data['local_uri'],
+                                 'remote_uri': data['remote_uri'],
+                                 'direction': data['direction'],
+                                 'cpim_from': data['cpim_from'],
+                                 'cpim_to': data['cpim_to'],
+                                 'cpim_timestamp': data['cpim_timestamp'],
+                                 'body': data['body'],
+                                 'content_type': data['content_type'],
+                                 'private': data['private'],
+                                 'status': data['status'],
+                                 'uuid': uuid,
+                                 'journal_id': journal_id,
+                                 'call_id': data['call_id'],
+                                 'encryption': data['encryption']
+                                 })
+
                 try:
-                    self.last_journal_timestamp[account]['msgid_list'].append(data['msgid'])
-                    try:
-                        data['call_id']
-                    except KeyError:
-                        data['call_id'] = ''
+                    start_time = datetime.strptime(data['time'], "%Y-%m-%d %H:%M:%S")
+                except (TypeError, ValueError):
+                    start_time = None
+
+                if start_time is not None and datetime.utcnow() - start_time < timedelta(hours=2):
                     try:
-                        data['encryption']
+                        notify_data[data['remote_uri']]
                     except KeyError:
-                        data['encryption'] = ''
-
-                    ChatHistory().add_message(data['msgid'], data['media_type'], data['local_uri'], data['remote_uri'], data['direction'], data['cpim_from'], data['cpim_to'], data['cpim_timestamp'], data['body'], data['content_type'], data['private'], data['status'], time=data['time'], uuid=uuid, journal_id=journal_id, call_id=data['call_id'], encryption=data['encryption'])
-
+                        notify_data[data['remote_uri']] = 1
+                    else:
+                        notify_data[data['remote_uri']] += 1
 
-                    start_time = datetime.strptime(data['time'], "%Y-%m-%d %H:%M:%S")
-                    elapsed = datetime.utcnow() - start_time
+                    if data['media_type'] == 'chat' and self.sync_counter[account] > 1:
+                        notification_data = NotificationData()
+                        notification_data.chat_message = data
+                        NotificationCenter().post_notification('ChatReplicationJournalEntryReceived', sender=self, data=notification_data)
 
-                    elapsed_hours = elapsed.days * 24 + elapsed.seconds / (60*60)
-                    if elapsed_hours < 2:
-                        try:
-                            notify_data[data['remote_uri']]
-                        except KeyError:
-                            notify_data[data['remote_uri']] = 1
-                        else:
-                            notify_data[data['remote_uri']] += 1
-
-                        if data['media_type'] == 'chat' and self.sync_counter[account] > 1:
-                            notification_data = NotificationData()
-                            notification_data.chat_message = data
-                            NotificationCenter().post_notification('ChatReplicationJournalEntryReceived', sender=self, data=notification_data)
+                if data['direction'] == 'incoming':
+                    BlinkLogger().log_debug("Save %s chat message id %s with journal id %s from %s to %s on device %s" % (data['direction'], data['msgid'], journal_id, data['remote_uri'], account, uuid))
+                else:
+                    BlinkLogger().log_debug("Save %s chat message id %s with journal id %s from %s to %s on device %s" % (data['direction'], data['msgid'], journal_id, account, data['remote_uri'], uuid))
 
-                    if data['direction'] == 'incoming':
-                        BlinkLogger().log_debug("Save %s chat message id %s with journal id %s from %s to %s on device %s" % (data['direction'], data['msgid'], journal_id, data['remote_uri'], account, uuid))
-                    else:
-                        BlinkLogger().log_debug("Save %s chat message id %s with journal id %s from %s to %s on device %s" % (data['direction'], data['msgid'], journal_id, account, data['remote_uri'], uuid))
+        if messages:
+            ChatHistory().add_messages_bulk(messages)
 
-                except KeyError:
-                    BlinkLogger().log_debug("Failed to apply chat history server journal to local chat history database for %s" % account)
-                    return
+        if journal_timestamp_changed:
+            last_journal_timestamp = self.last_journal_timestamp[account]
+            self.store.set_journal_timestamp(account, last_journal_timestamp['timestamp'], list(last_journal_timestamp['msgids']))
 
         if notify_data:
             for key in list(notify_data.keys()):
                 log_text = '%d new chat messages for %s replicated from chat history server' % (notify_data[key], key)
                 BlinkLogger().log_info(log_text)
-        else:
+        elif first_page and last_page:
             BlinkLogger().log_debug('Local chat history is in sync with chat history server for %s' % account)
 
     @run_in_gui_thread
     def updateTimer_(self, timer):
-        if self.paused:
+        if self.paused or not self.state_loaded:
             return
         accounts = (account for account in AccountManager().iter_accounts() if account is not BonjourAccount() and account.enabled and not account.chat.disable_replication and account.server.settings_url and account.chat.replication_password and account.id not in self.disabled_accounts)
         for account in accounts:
@@ -1977,7 +2791,8 @@ class ChatHistoryReplicator(object, metaclass=Singleton):
                         request.setHTTPMethod_("POST")
                         request.setHTTPBody_(data.dataUsingEncoding_(NSUTF8StringEncoding))
                         connection = NSURLConnection.alloc().initWithRequest_delegate_(request, self)
-                        self.connections_for_outgoing_replication[account.id] = {'postData': self.outgoing_entries[account.id], 'responseData': '', 'authRequestCount': 0, 'connection': connection, 'url': url}
+                        self.connections_for_outgoing_replication[account.id] = {'postData': dict(outgoing_entries), 'responseData': bytearray(), 'authRequestCount': 0, 'connection': connection, 'url': url}
+                        self.connection_owners[connection] = (self.connections_for_outgoing_replication, account.id)
 
             try:
                 delete_entries = self.for_delete_entries[account.id]
@@ -2008,7 +2823,8 @@ class ChatHistoryReplicator(object, metaclass=Singleton):
                         request.setHTTPMethod_("POST")
                         request.setHTTPBody_(data.dataUsingEncoding_(NSUTF8StringEncoding))
                         connection = NSURLConnection.alloc().initWithRequest_delegate_(request, self)
-                        self.connections_for_delete_replication[account.id] = {'postData': self.for_delete_entries[account.id], 'responseData': '', 'authRequestCount': 0, 'connection': connection, 'url': url}
+                        self.connections_for_delete_replication[account.id] = {'postData': set(delete_entries), 'responseData': bytearray(), 'authRequestCount': 0, 'connection': connection, 'url': url}
+                        self.connection_owners[connection] = (self.connections_for_delete_replication, account.id)
 
             connection = None
             try:
@@ -2047,37 +2863,52 @@ class ChatHistoryReplicator(object, metaclass=Singleton):
         nsurl = NSURL.URLWithString_(url)
         request = NSURLRequest.requestWithURL_cachePolicy_timeoutInterval_(nsurl, NSURLRequestReloadIgnoringLocalAndRemoteCacheData, 15)
         connection = NSURLConnection.alloc().initWithRequest_delegate_(request, self)
-        self.connections_for_incoming_replication[account.id] = {'responseData': '','authRequestCount': 0, 'connection':connection, 'url': url}
+        self.connections_for_incoming_replication[account.id] = {'parser': JournalStreamParser(), 'pages': 0, 'summary_applied': False, 'authRequestCount': 0, 'connection':connection, 'url': url}
+        self.connection_owners[connection] = (self.connections_for_incoming_replication, account.id)
+
+    def applyIncomingJournalPage(self, key, last_page=False):
+        # Hand over the journal entries parsed so far. Entries can only be
+        # applied once the server said the request succeeded, until then
+        # they are kept by the parser and applied with the last page.
+        request = self.connections_for_incoming_replication[key]
+        parser = request['parser']
+        if not last_page and (parser.members.get('success') is not True or len(parser.results) < self.journal_page_size):
+            return
+
+        journal = dict(parser.members)
+        journal['results'] = parser.pop_results()
+        if 'summary' in journal:
+            if request['summary_applied']:
+                del journal['summary']
+            else:
+                request['summary_applied'] = True
+
+        self.addLocalHistoryFromRemoteJournalEntries(journal, key, first_page=not request['pages'], last_page=last_page)
+        request['pages'] += 1
 
     # NSURLConnection delegate methods
     def connection_didReceiveData_(self, connection, data):
         try:
-            key = next((account for account in list(self.connections_for_outgoing_replication.keys()) if self.connections_for_outgoing_replication[account]['connection'] == connection))
-        except StopIteration:
-            pass
-        else:
-            self.connections_for_outgoing_replication[key]['responseData'] = self.connections_for_outgoing_replication[key]['responseData'] + str(data)
-
-        try:
-            key = next((account for account in list(self.connections_for_incoming_replication.keys()) if self.connections_for_incoming_replication[account]['connection'] == connection))
-        except StopIteration:
-            pass
-        else:
-            self.connections_for_incoming_replication[key]['responseData'] = self.connections_for_incoming_replication[key]['responseData'] + str(data)
+            connections, key = self.connection_owners[connection]
+        except KeyError:
+            return
 
-        try:
-            key = next((account for account in list(self.connections_for_delete_replication.keys()) if self.connections_for_delete_replication[account]['connection'] == connection))
-        except StopIteration:
-            pass
+        if connections is self.connections_for_incoming_replication:
+            # large journals are decoded and applied while they stream in
+            parser = connections[key]['parser']
+            parser.feed(data.bytes())
+            if parser.error is None:
+                self.applyIncomingJournalPage(key)
         else:
-            self.connections_for_delete_replication[key]['responseData'] = self.connections_for_delete_replication[key]['responseData'] + str(data)
+            connections[key]['responseData'].extend(data.bytes())
 
     def connectionDidFinishLoading_(self, connection):
         try:
-            key = next((account for account in list(self.connections_for_outgoing_replication.keys()) if self.connections_for_outgoing_replication[account]['connection'] == connection))
-        except StopIteration:
-            pass
-        else:
+            connections, key = self.connection_owners.pop(connection)
+        except KeyError:
+            return
+
+        if connections is self.connections_for_outgoing_replication:
             BlinkLogger().log_debug("Outgoing chat journal for %s pushed to %s" % (key, self.connections_for_outgoing_replication[key]['url']))
             try:
                 account = AccountManager().get_account(key)
@@ -2090,52 +2921,47 @@ class ChatHistoryReplicator(object, metaclass=Singleton):
                 self.connections_for_outgoing_replication[account.id]['connection'] = None
                 try:
                     data = json.loads(self.connections_for_outgoing_replication[key]['responseData'])
-                except (TypeError, json.decoder.JSONDecodeError) as e:
+                except (TypeError, ValueError) as e:
                     BlinkLogger().log_debug("Failed to parse chat journal push response for %s from %s: %s" % (key, self.connections_for_outgoing_replication[key]['url'], e))
                 else:
                     self.updateLocalHistoryWithRemoteJournalId(data, key)
 
                 try:
-                    for key in list(self.connections_for_outgoing_replication[key]['postData'].keys()):
+                    msgids = list(self.connections_for_outgoing_replication[key]['postData'].keys())
+                except KeyError:
+                    pass
+                else:
+                    for msgid in msgids:
                         try:
-                            del self.outgoing_entries[account.id][key]
+                            del self.outgoing_entries[account.id][msgid]
                         except KeyError:
                             pass
-                except KeyError:
-                    pass
+                    self.store.remove_outgoing_entries(account.id, msgids)
 
                 try:
                     del self.connections_for_outgoing_replication[key]
                 except KeyError:
                     pass
 
-        try:
-            key = next((account for account in list(self.connections_for_incoming_replication.keys()) if self.connections_for_incoming_replication[account]['connection'] == connection))
-        except StopIteration:
-            pass
-        else:
+        elif connections is self.connections_for_incoming_replication:
             BlinkLogger().log_debug("Incoming chat journal for %s received from %s" % (key, self.connections_for_incoming_replication[key]['url']))
             try:
                 account = AccountManager().get_account(key)
             except KeyError:
-                try:
-                    del self.connections_for_incoming_replication[key]
-                except KeyError:
-                    pass
+                pass
             else:
-                try:
-                    data = json.loads(self.connections_for_incoming_replication[key]['responseData'])
-                except (TypeError, json.decoder.JSONDecodeError) as e:
-                    BlinkLogger().log_debug("Failed to parse chat journal for %s from %s: %s" % (key, self.connections_for_incoming_replication[key]['url'], e))
+                parser = self.connections_for_incoming_replication[key]['parser']
+                parser.close()
+                if parser.error is not None:
+                    BlinkLogger().log_debug("Failed to parse chat journal for %s from %s: %s" % (key, self.connections_for_incoming_replication[key]['url'], parser.error))
                 else:
-                    self.addLocalHistoryFromRemoteJournalEntries(data, key)
+                    self.applyIncomingJournalPage(key, last_page=True)
+            try:
                 del self.connections_for_incoming_replication[key]
+            except KeyError:
+                pass
 
-        try:
-            key = next((account for account in list(self.connections_for_delete_replication.keys()) if self.connections_for_delete_replication[account]['connection'] == connection))
-        except StopIteration:
-            pass
-        else:
+        elif connections is self.connections_for_delete_replication:
             BlinkLogger().log_debug("Delete chat journal entries for %s pushed to %s" % (key, self.connections_for_delete_replication[key]['url']))
             try:
                 account = AccountManager().get_account(key)
@@ -2148,7 +2974,7 @@ class ChatHistoryReplicator(object, metaclass=Singleton):
                 self.connections_for_delete_replication[account.id]['connection'] = None
                 try:
                     data = json.loads(self.connections_for_delete_replication[key]['responseData'])
-                except (TypeError, json.decoder.JSONDecodeError) as e:
+                except (TypeError, ValueError) as e:
                     BlinkLogger().log_debug("Failed to parse chat journal delete response for %s from %s: %s" % (key, self.connections_for_delete_replication[key]['url'], e))
                 else:
                     try:
@@ -2167,10 +2993,12 @@ class ChatHistoryReplicator(object, metaclass=Singleton):
                             BlinkLogger().log_debug("Delete journal entries succeeded for account %s" % account.id)
 
                     try:
-                        for entry in self.connections_for_delete_replication[key]['postData'].copy():
-                            self.for_delete_entries[account.id].discard(entry)
+                        journal_ids = self.connections_for_delete_replication[key]['postData']
+                        self.for_delete_entries[account.id].difference_update(journal_ids)
                     except KeyError:
                         pass
+                    else:
+                        self.store.remove_delete_entries(account.id, journal_ids)
 
                     try:
                         del self.connections_for_delete_replication[key]
@@ -2179,106 +3007,36 @@ class ChatHistoryReplicator(object, metaclass=Singleton):
 
     def connection_didFailWithError_(self, connection, error):
         try:
-            key = next((account for account in list(self.connections_for_outgoing_replication.keys()) if self.connections_for_outgoing_replication[account]['connection'] == connection))
-        except StopIteration:
-            return
-        else:
-            try:
-                connection = self.connections_for_outgoing_replication[key]['connection']
-            except KeyError:
-                pass
-            else:
-                BlinkLogger().log_error("Failed to retrieve chat messages for %s from %s: %s" % (key, self.connections_for_outgoing_replication[key]['url'], error.userInfo()['NSLocalizedDescription']))
-                self.connections_for_outgoing_replication[key]['connection'] = None
-
-        try:
-            key = next((account for account in list(self.connections_for_incoming_replication.keys()) if self.connections_for_incoming_replication[account]['connection'] == connection))
-        except StopIteration:
+            connections, key = self.connection_owners.pop(connection)
+        except KeyError:
             return
-        else:
-            try:
-                connection = self.connections_for_incoming_replication[key]['connection']
-            except KeyError:
-                pass
-            else:
-                BlinkLogger().log_debug("Failed to retrieve chat messages for %s from %s: %s" % (key, self.connections_for_incoming_replication[key]['url'], error))
-                self.connections_for_incoming_replication[key]['connection'] = None
-                del self.connections_for_incoming_replication[key]
 
-        try:
-            key = next((account for account in list(self.connections_for_delete_replication.keys()) if self.connections_for_delete_replication[account]['connection'] == connection))
-        except StopIteration:
-            return
+        if connections is self.connections_for_outgoing_replication:
+            BlinkLogger().log_error("Failed to retrieve chat messages for %s from %s: %s" % (key, connections[key]['url'], error.userInfo()['NSLocalizedDescription']))
+            connections[key]['connection'] = None
         else:
-            try:
-                connection = self.connections_for_delete_replication[key]['connection']
-            except KeyError:
-                pass
-            else:
-                BlinkLogger().log_debug("Failed to retrieve chat messages for %s from %s: %s" % (key, self.connections_for_delete_replication[key]['url'], error))
-                self.connections_for_delete_replication[key]['connection'] = None
-                del self.connections_for_delete_replication[key]
+            BlinkLogger().log_debug("Failed to retrieve chat messages for %s from %s: %s" % (key, connections[key]['url'], error))
+            connections[key]['connection'] = None
+            del connections[key]
 
     def connection_didReceiveAuthenticationChallenge_(self, connection, challenge):
         try:
-            key = next((account for account in list(self.connections_for_outgoing_replication.keys()) if self.connections_for_outgoing_replication[account]['connection'] == connection))
-        except StopIteration:
-            pass
-        else:
-            try:
-                account = AccountManager().get_account(key)
-            except KeyError:
-                pass
-            else:
-                try:
-                    self.connections_for_outgoing_replication[key]['authRequestCount'] += 1
-                except KeyError:
-                    self.connections_for_outgoing_replication[key]['authRequestCount'] = 1
-
-                if self.connections_for_outgoing_replication[key]['authRequestCount'] < 2:
-                    credential = NSURLCredential.credentialWithUser_password_persistence_(account.id.username, account.server.web_password or account.auth.password, NSURLCredentialPersistenceNone)
-                    challenge.sender().useCredential_forAuthenticationChallenge_(credential, challenge)
-                else:
-                    BlinkLogger().log_error("Error: Invalid web authentication when retrieving chat history of %s" % key)
+            connections, key = self.connection_owners[connection]
+        except KeyError:
+            return
 
         try:
-            key = next((account for account in list(self.connections_for_incoming_replication.keys()) if self.connections_for_incoming_replication[account]['connection'] == connection))
-        except StopIteration:
+            account = AccountManager().get_account(key)
+        except KeyError:
             pass
         else:
             try:
-                account = AccountManager().get_account(key)
+                connections[key]['authRequestCount'] += 1
             except KeyError:
-                pass
-            else:
-                try:
-                    self.connections_for_incoming_replication[key]['authRequestCount'] += 1
-                except KeyError:
-                    self.connections_for_incoming_replication[key]['authRequestCount'] = 1
+                connections[key]['authRequestCount'] = 1
 
-                if self.connections_for_incoming_replication[key]['authRequestCount'] < 2:
-                    credential = NSURLCredential.credentialWithUser_password_persistence_(account.id.username, account.server.web_password or account.auth.password, NSURLCredentialPersistenceNone)
-                    challenge.sender().useCredential_forAuthenticationChallenge_(credential, challenge)
-                else:
-                    BlinkLogger().log_error("Error: Invalid web authentication when retrieving chat history of %s" % key)
-
-        try:
-            key = next((account for account in list(self.connections_for_delete_replication.keys()) if self.connections_for_delete_replication[account]['connection'] == connection))
-        except StopIteration:
-            pass
-        else:
-            try:
-                account = AccountManager().get_account(key)
-            except KeyError:
-                pass
+            if connections[key]['authRequestCount'] < 2:
+                credential = NSURLCredential.credentialWithUser_password_persistence_(account.id.username, account.server.web_password or account.auth.password, NSURLCredentialPersistenceNone)
+                challenge.sender().useCredential_forAuthenticationChallenge_(credential, challenge)
             else:
-                try:
-                    self.connections_for_delete_replication[key]['authRequestCount'] += 1
-                except KeyError:
-                    self.connections_for_delete_replication[key]['authRequestCount'] = 1
-
-                if self.connections_for_delete_replication[key]['authRequestCount'] < 2:
-                    credential = NSURLCredential.credentialWithUser_password_persistence_(account.id.username, account.server.web_password or account.auth.password, NSURLCredentialPersistenceNone)
-                    challenge.sender().useCredential_forAuthenticationChallenge_(credential, challenge)
-                else:
-                    BlinkLogger().log_error("Error: Invalid web authentication when retrieving chat history of %s" % key)
+                BlinkLogger().log_error("Error: Invalid web authentication when retrieving chat history of %s" % key)
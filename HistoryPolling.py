@@ -0,0 +1,66 @@
+# Copyright (C) 2025 AG Projects. See LICENSE for details.
+#
+
+import hashlib
+
+
+__all__ = ['ConditionalPoll', 'POLL_NOT_MODIFIED', 'POLL_UNCHANGED', 'POLL_MODIFIED']
+
+
+POLL_NOT_MODIFIED = 'not-modified'    # the server answered 304
+POLL_UNCHANGED = 'unchanged'          # the server sent the same document again
+POLL_MODIFIED = 'modified'
+
+
+class ConditionalPoll(object):
+    """
+    State of a document polled over HTTP: the validators of the last response,
+    the digest of the last document and the interval until the next request.
+
+    Validators and digest of a new document only take effect once the caller
+    reports with applied() that the document was processed, so a document that
+    failed to apply is requested and applied again by the next poll.
+    """
+
+    def __init__(self, interval, max_interval):
+        self.min_interval = interval
+        self.max_interval = max_interval
+        self.interval = interval
+        self.etag = None
+        self.last_modified = None
+        self.digest = None
+        self._pending = None    # (etag, last_modified, digest) of the document being applied
+
+    def request_headers(self):
+        headers = {}
+        if self.etag:
+            headers['If-None-Match'] = self.etag
+        if self.last_modified:
+            headers['If-Modified-Since'] = self.last_modified
+        return headers
+
+    def response_received(self, status, headers, body):
+        """Classify a response, returns one of POLL_NOT_MODIFIED, POLL_UNCHANGED or POLL_MODIFIED"""
+        if status == 304:
+            return POLL_NOT_MODIFIED
+        # servers without validators still return the same document while nothing changed
+        digest = hashlib.sha1(body if isinstance(body, bytes) else body.encode()).digest()
+        if digest == self.digest:
+            return POLL_UNCHANGED
+        self._pending = (headers.get('Etag') or headers.get('ETag'), headers.get('Last-Modified'), digest)
+        return POLL_MODIFIED
+
+    def applied(self, success):
+        pending, self._pending = self._pending, None
+        if success and pending is not None:
+            self.etag, self.last_modified, self.digest = pending
+        elif not success:
+            self.etag = self.last_modified = self.digest = None
+
+    def next_interval(self, changed):
+        """Interval until the next request, doubled up to max_interval while the document does not change"""
+        if changed:
+            self.interval = self.min_interval
+        else:
+            self.interval = min(self.interval * 2, self.max_interval)
+        return self.interval
@@ -34,7 +34,6 @@ from Foundation import (NSBundle,
                         NSWindowController,
                         NSZeroPoint)
 import objc
-import pgpy
 import re
 
 import datetime
@@ -44,12 +43,14 @@ from application.python import Null
 from eventlib.twistedutil import block_on
 from sipsimple.threading.green import run_in_green_thread
 from sipsimple.util import ISOTimestamp
+from twisted.internet import defer
 from zope.interface import implementer
 
 from resources import ApplicationData
 from BlinkLogger import BlinkLogger
 from ContactListModel import BlinkHistoryViewerContact, BlinkPresenceContact
 from HistoryManager import ChatHistory, SessionHistory
+from PGPDecryptionService import PGPDecryptionService, is_pgp_message
 from util import is_anonymous, sipuri_components_from_string, run_in_gui_thread
 
 
@@ -115,7 +116,6 @@ class HistoryViewer(NSWindowController):
     contact_cache = {}
     display_name_cache = {}
     refresh_in_progress = False
-    private_keys = {}
 
     daily_order_fields = {'date': 'DESC', 'local_uri': 'ASC', 'remote_uri': 'ASC'}
     media_type_array = {0: None, 1: ('audio', 'video'), 2: ('chat', 'sms'), 3: 'file-transfer', 4: 'audio-recording', 5: 'availability', 6: 'voicemail', 7: 'video-recording'}
@@ -492,75 +492,52 @@ class HistoryViewer(NSWindowController):
                 after_date = self.after_date if self.after_date else None
             if not before_date:
                 before_date = self.before_date if self.before_date else None
-            results = self.chat_history.get_messages(count=count, local_uri=local_uri, remote_uri=remote_uri, media_type=media_type, date=date, search_text=search_text, after_date=after_date, before_date=before_date)
-            # Pre-decrypt PGP messages off the GUI thread so pagination and the
-            # initial render don't block while pgpy decrypts every message.
-            self._decrypted_bodies = self._decrypt_history_messages(results)
+            # search results are ordered by relevance, the most relevant match is rendered last
+            results = self.chat_history.get_messages(count=count, local_uri=local_uri, remote_uri=remote_uri, media_type=media_type, date=date, search_text=search_text, after_date=after_date, before_date=before_date, orderBy='rank' if search_text else 'time')
+            # PGP messages are rendered with a placeholder and are decrypted
+            # off the GUI thread, each batch is shown as soon as it is done
+            self._decrypted_bodies = {}
             self.renderMessages(results)
-            self.updateBusyIndicator(False)
+            operation = self._decrypt_history_messages(results, self._decrypted_bodies)
+            operation.addBoth(lambda result: self.updateBusyIndicator(False))
 
     @objc.python_method
-    def _decrypt_history_messages(self, messages):
+    def _decrypt_history_messages(self, messages, decrypted_bodies):
         """Decrypt PGP-encrypted history messages off the GUI thread.
 
-        Caches the per-account private keys in ``self.private_keys`` and writes
-        the plaintext back to the history database so subsequent loads are fast.
-        Returns a dict ``{msgid: (text, encryption_label)}``; ``encryption_label``
-        is ``'verified'`` for successfully decrypted entries and ``None`` when
-        decryption failed (in which case ``text`` is a placeholder).
+        The messages of each account are decrypted in parallel by the
+        PGPDecryptionService. Every finished batch is written back to the
+        history database, so subsequent loads are fast, and is shown in the
+        chat view by showDecryptedMessages, which adds it to decrypted_bodies.
+        Returns a deferred that fires when all messages are done.
         """
-        decrypted_bodies = {}
-
+        service = PGPDecryptionService()
+        encrypted_messages = {}
         for message in messages:
-            body = message.body
-            if not body:
-                continue
-
-            if not (body.startswith('-----BEGIN PGP MESSAGE-----') and body.endswith('-----END PGP MESSAGE-----')):
-                continue
-
-            try:
-                private_key = self.private_keys[message.local_uri]
-            except KeyError:
-                private_key_path = "%s/%s.privkey" % (self.keys_path, message.local_uri)
-                try:
-                    private_key, _ = pgpy.PGPKey.from_file(private_key_path)
-                except Exception as e:
-                    BlinkLogger().log_error('Cannot import PGP private key from %s: %s' % (private_key_path, str(e)))
-                    self.private_keys[message.local_uri] = None
-                    decrypted_bodies[message.msgid] = ('Encrypted message for which we have no private key', None)
-                    continue
-                else:
-                    BlinkLogger().log_info('PGP private key imported from %s' % private_key_path)
-                    self.private_keys[message.local_uri] = private_key
-
-            if not private_key:
-                decrypted_bodies[message.msgid] = ('Encrypted message for which we have no private key', None)
-                continue
-
-            try:
-                pgpMessage = pgpy.PGPMessage.from_blob(body.strip())
-                decrypted_message = private_key.decrypt(pgpMessage)
-            except (pgpy.errors.PGPDecryptionError, pgpy.errors.PGPError):
-                decrypted_bodies[message.msgid] = ('Encrypted message for which we have no private key', None)
-                continue
+            if message.body and is_pgp_message(message.body):
+                encrypted_messages.setdefault(message.local_uri, []).append((message.msgid, message.body))
 
-            try:
-                text = bytes(decrypted_message.message, 'latin1').decode()
-            except (TypeError, UnicodeEncodeError, UnicodeDecodeError):
-                try:
-                    text = bytes(decrypted_message.message, 'utf-8').decode('utf-8', errors='replace')
-                except Exception as e:
-                    BlinkLogger().log_error('Failed to decode message %s: %s' % (message.msgid, str(e)))
-                    continue
+        def save_decrypted_messages(results):
+            for msgid, text in results.items():
+                if text is not None:
+                    self.chat_history.update_decrypted_message(msgid, text)
+            self.showDecryptedMessages(results, decrypted_bodies)
 
-            decrypted_bodies[message.msgid] = (text, 'verified')
-            try:
-                self.chat_history.update_decrypted_message(message.msgid, text)
-            except Exception as e:
-                BlinkLogger().log_error('Failed to persist decrypted message %s: %s' % (message.msgid, str(e)))
+        operations = [service.decrypt_messages(service.private_key("%s/%s.privkey" % (self.keys_path, local_uri)), items, save_decrypted_messages) for local_uri, items in encrypted_messages.items()]
+        return defer.gatherResults(operations, consumeErrors=True)
 
-        return decrypted_bodies
+    @objc.python_method
+    @run_in_gui_thread
+    def showDecryptedMessages(self, results, decrypted_bodies):
+        # decrypted_bodies is a dict ``{msgid: (text, encryption_label)}``;
+        # ``encryption_label`` is ``'verified'`` for successfully decrypted
+        # entries and ``None`` when decryption failed
+        for msgid, text in results.items():
+            if text is None:
+                decrypted_bodies[msgid] = ('Encrypted message for which we have no private key', None)
+            else:
+                decrypted_bodies[msgid] = (text, 'verified')
+            self.chatViewController.updateMessageContent(msgid, decrypted_bodies[msgid][0])
 
     @objc.python_method
     @run_in_gui_thread
@@ -580,8 +557,12 @@ class HistoryViewer(NSWindowController):
             start = self.start
             end = min(start + MAX_MESSAGES_PER_PAGE, message_count)
 
-        for row in self.messages[start:end]:
-            self.renderMessage(row)
+        self.chatViewController.beginBatchRendering()
+        try:
+            for row in self.messages[start:end]:
+                self.renderMessage(row)
+        finally:
+            self.chatViewController.endBatchRendering()
 
         self.paginationButton.setEnabled_forSegment_(start > MAX_MESSAGES_PER_PAGE, 0)
         self.paginationButton.setEnabled_forSegment_(start > 0, 1)
@@ -619,12 +600,13 @@ class HistoryViewer(NSWindowController):
             encryption = message.encryption
 
             if content.startswith('-----BEGIN PGP MESSAGE-----') and content.endswith('-----END PGP MESSAGE-----'):
-                # Decryption already happened off the GUI thread in
-                # refreshMessages -> _decrypt_history_messages.
+                # Decryption happens off the GUI thread, started by
+                # refreshMessages, messages still being decrypted are
+                # updated by showDecryptedMessages.
                 decrypted_bodies = getattr(self, '_decrypted_bodies', {}) or {}
                 decrypted = decrypted_bodies.get(message.msgid)
                 if decrypted is None:
-                    content = 'Encrypted message for which we have no private key'
+                    content = 'Decrypting message...'
                 else:
                     text, decrypted_encryption = decrypted
                     content = text
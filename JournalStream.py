@@ -0,0 +1,240 @@
+# Copyright (C) 2025 AG Projects. See LICENSE for details.
+#
+
+import codecs
+import json
+import re
+import urllib.request
+
+from http.client import HTTPException
+
+
+__all__ = ['JournalStreamParser', 'JournalPage', 'iter_journal_entries', 'journal_page_url', 'sync_journal_page', 'sync_journal_pages']
+
+
+class JournalStreamParser(object):
+    """Incremental parser for the JSON object returned by get_journal_entries.
+
+    Data is fed as it arrives from the network. Top level members show
+    up in members once they are complete. Top level arrays are decoded
+    one element at a time, and the elements of "results" are collected
+    in results, so they can be applied while the rest of the response
+    is still downloading. Another array can be streamed by passing its
+    name as streamed_key.
+    """
+
+    streamed_key = 'results'
+    _whitespace = re.compile(r'[ \t\n\r]*')
+
+    def __init__(self, streamed_key=None):
+        if streamed_key is not None:
+            self.streamed_key = streamed_key
+        self.members = {}
+        self.results = []
+        self.complete = False
+        self.error = None
+        self._decoder = json.JSONDecoder()
+        self._text_decoder = codecs.getincrementaldecoder('utf-8')()
+        self._buffer = ''
+        self.bytes_received = 0
+        self._position = 0
+        self._state = 'start'
+        self._key = None
+        self._array = None
+
+    def feed(self, data):
+        if self.error is not None or self.complete:
+            return
+        self.bytes_received += len(data)
+        try:
+            self._buffer += self._text_decoder.decode(bytes(data))
+            self._parse()
+        except ValueError as e:
+            self.error = e
+        if self._position > 65536:
+            self._buffer = self._buffer[self._position:]
+            self._position = 0
+
+    def close(self):
+        if self.error is None and not self.complete:
+            self.error = ValueError('Unexpected end of data')
+
+    def pop_results(self):
+        results = self.results[:]
+        del self.results[:]
+        return results
+
+    def _decode(self):
+        # a value is only accepted when something follows it, a number at
+        # the end of the buffer may still be missing digits
+        try:
+            value, end = self._decoder.raw_decode(self._buffer, self._position)
+        except ValueError:
+            return False, None
+        if end >= len(self._buffer):
+            return False, None
+        self._position = end
+        return True, value
+
+    def _parse(self):
+        while True:
+            self._position = self._whitespace.match(self._buffer, self._position).end()
+            if self._position >= len(self._buffer):
+                return
+            char = self._buffer[self._position]
+            state = self._state
+
+            if state == 'start':
+                if char != '{':
+                    raise ValueError('Expected an object at position %d' % self._position)
+                self._position += 1
+                self._state = 'member'
+            elif state == 'member':
+                if char == '}':
+                    self._position += 1
+                    self._state = 'end'
+                    self.complete = True
+                    continue
+                if char != '"':
+                    raise ValueError('Expected a member name at position %d' % self._position)
+                decoded, self._key = self._decode()
+                if not decoded:
+                    return
+                self._state = 'colon'
+            elif state == 'colon':
+                if char != ':':
+                    raise ValueError('Expected ":" at position %d' % self._position)
+                self._position += 1
+                self._state = 'value'
+            elif state == 'value':
+                if char == '[':
+                    self._position += 1
+                    self._array = self.results if self._key == self.streamed_key else []
+                    self._state = 'element'
+                    continue
+                decoded, value = self._decode()
+                if not decoded:
+                    return
+                self.members[self._key] = value
+                self._state = 'next_member'
+            elif state in ('element', 'next_element'):
+                if char == ']':
+                    self._position += 1
+                    self.members[self._key] = None if self._key == self.streamed_key else self._array
+                    self._array = None
+                    self._state = 'next_member'
+                    continue
+                if state == 'next_element':
+                    if char != ',':
+                        raise ValueError('Expected "," at position %d' % self._position)
+                    self._position += 1
+                    self._state = 'element'
+                    continue
+                decoded, value = self._decode()
+                if not decoded:
+                    return
+                self._array.append(value)
+                self._state = 'next_element'
+            elif state == 'next_member':
+                if char == ',':
+                    self._position += 1
+                    self._state = 'member'
+                elif char == '}':
+                    self._position += 1
+                    self._state = 'end'
+                    self.complete = True
+                else:
+                    raise ValueError('Expected "," at position %d' % self._position)
+            elif state == 'end':
+                raise ValueError('Extra data at position %d' % self._position)
+
+
+def iter_journal_entries(response, parser, read_size=65536):
+    """
+    Read response in chunks of read_size bytes and yield the streamed entries
+    as soon as they are parsed. Errors raised by response.read propagate, a
+    parse error ends the iteration with parser.error set.
+    """
+    while not parser.complete and parser.error is None:
+        data = response.read(read_size)
+        if not data:
+            parser.close()
+            break
+        parser.feed(data)
+        yield from parser.pop_results()
+
+
+def sync_journal_pages(sync_page, page_size):
+    """
+    Call sync_page, which applies one page of at most page_size entries and
+    returns a (result, count) tuple, until the journal is exhausted. The next
+    page is only requested after a complete page holding exactly page_size
+    entries, a server that ignores the limit returns everything at once.
+    Returns the result of the last page and the total count.
+    """
+    synced = 0
+    while True:
+        result, count = sync_page()
+        synced += count
+        if result != 'complete' or count != page_size:
+            return result, synced
+
+
+class JournalPage(object):
+    """Outcome of sync_journal_page"""
+
+    def __init__(self, result, applied=0, bytes_received=0, error=None):
+        self.result = result                    # 'complete', 'failed' or 'unauthorized'
+        self.applied = applied
+        self.bytes_received = bytes_received
+        self.error = error
+
+
+def journal_page_url(history_url, last_id, page_size):
+    """URL of the page of at most page_size entries following last_id"""
+    url = history_url.replace("@", "%40")
+    if last_id:
+        url = "%s/%s" % (url, last_id)
+    return "%s?limit=%d" % (url, page_size)
+
+
+def sync_journal_page(url, headers, apply, commit, commit_size, read_size=65536, timeout=20):
+    """
+    Download one page of journal entries and apply them while the response is
+    being received. apply is called with every entry and returns its message
+    id or None. commit is called with the last message id after every
+    commit_size applied entries and once more at the end of the page, even if
+    the page failed, so an interrupted sync resumes from the last committed
+    entry. Returns a JournalPage.
+    """
+    request = urllib.request.Request(url, headers=headers, method="GET")
+    try:
+        response = urllib.request.urlopen(request, timeout=timeout)
+    except (OSError, HTTPException) as e:
+        return JournalPage('unauthorized' if getattr(e, 'code', None) == 401 else 'failed', error=e)
+
+    parser = JournalStreamParser(streamed_key='messages')
+    page = JournalPage('complete')
+    last_message_id = None
+
+    try:
+        for entry in iter_journal_entries(response, parser, read_size):
+            message_id = apply(entry)
+            page.applied += 1
+            if message_id:
+                last_message_id = message_id
+            if page.applied % commit_size == 0 and last_message_id:
+                commit(last_message_id)
+    except (OSError, HTTPException, ValueError) as e:
+        page.result = 'failed'
+        page.error = e
+    finally:
+        response.close()
+
+    if parser.error is not None:
+        page.result = 'failed'
+        page.error = parser.error
+
+    page.bytes_received = parser.bytes_received
+    commit(last_message_id)
+    return page
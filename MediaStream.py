@@ -10,6 +10,10 @@ from application.notification import NotificationCenter, NotificationData
 from Foundation import NSObject
 from AppKit import NSApp
 import objc
+import time
+
+from HistoryManager import QoSHistory
+from QoSStatistics import encode_qos_sample
 
 # Session states
 STATE_IDLE       = "IDLE"
@@ -38,6 +42,8 @@ class MediaStream(NSObject):
     stream = None
     status = None
     type = None
+    qos_samples = None
+    qos_start_time = None
 
     def __new__(cls, *args, **kwargs):
         return cls.alloc().initWithOwner_stream_(*args)
@@ -78,6 +84,20 @@ class MediaStream(NSObject):
     def resetStream(self):
         pass
 
+    @objc.python_method
+    def addQoSSample(self, rtt, jitter, loss_rx, loss_tx, rx_speed, tx_speed):
+        now = time.time()
+        if self.qos_samples is None:
+            self.qos_samples = bytearray()
+            self.qos_start_time = now
+        self.qos_samples += encode_qos_sample(now - self.qos_start_time, rtt, jitter, loss_rx, loss_tx, rx_speed, tx_speed)
+
+    @objc.python_method
+    def saveQoSSamples(self):
+        samples, self.qos_samples = self.qos_samples, None
+        if samples and self.sessionController is not None:
+            QoSHistory().add_samples(self.sessionController.history_id, self.type, self.qos_start_time, bytes(samples))
+
     @objc.python_method
     def removeFromSession(self):
         self.sessionController.removeStreamHandler(self)
@@ -0,0 +1,260 @@
+# Copyright (C) 2025 AG Projects. See LICENSE for details.
+#
+
+import hashlib
+import json
+import os
+import pgpy
+import subprocess
+import threading
+
+from collections import OrderedDict
+
+from application.python.types import Singleton
+from Foundation import NSBundle
+from twisted.internet import defer, reactor
+from twisted.internet.threads import deferToThreadPool
+from twisted.python.threadpool import ThreadPool
+
+from BlinkLogger import BlinkLogger
+from PGPDecryptionWorker import decrypt_body
+
+
+__all__ = ['PGPDecryptionService', 'is_pgp_message']
+
+
+PGP_DECRYPT_BATCH_SIZE = 10     # messages decrypted by one pool job
+PGP_DECRYPT_PROCESSES = min(4, os.cpu_count() or 1)
+PLAINTEXT_CACHE_SIZE = 2048     # decrypted bodies kept in memory
+
+
+class DecryptionProcessPool(object):
+    """
+    Worker processes running PGPDecryptionWorker.
+
+    pgpy holds the GIL while it parses and decrypts, so the batches are
+    decrypted in these processes and the pgp-decrypt threads only hand them
+    over. Processes are started when first needed. If a process cannot be
+    started or fails, the pool is disabled and batches are decrypted in the
+    pgp-decrypt threads instead.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self._lock = threading.Lock()
+        self._processes = set()
+        self._idle = []
+        self._disabled = False
+
+    def decrypt(self, key_blob, messages):
+        """Decrypt (msgid, body) pairs in a worker, returns {msgid: plaintext or None} or None if no worker is available"""
+        process = self._get_process()
+        if process is None:
+            return None
+        try:
+            process.stdin.write(json.dumps({'key': key_blob, 'messages': messages}).encode() + b'\n')
+            process.stdin.flush()
+            results = json.loads(process.stdout.readline().decode())
+        except (OSError, ValueError) as e:
+            BlinkLogger().log_error('PGP decryption process failed, decrypting in threads: %s' % str(e))
+            self._disable()
+            return None
+        with self._lock:
+            if process in self._processes:
+                self._idle.append(process)
+        return results
+
+    def stop(self):
+        self._disable()
+
+    def _get_process(self):
+        with self._lock:
+            if self._idle:
+                return self._idle.pop()
+            if self._disabled or len(self._processes) >= self.size:
+                return None
+            try:
+                process = subprocess.Popen([NSBundle.mainBundle().executablePath(), '--pgp-decrypt-worker'], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+            except OSError as e:
+                self._disabled = True
+                BlinkLogger().log_error('Cannot start PGP decryption process, decrypting in threads: %s' % str(e))
+                return None
+            self._processes.add(process)
+            return process
+
+    def _disable(self):
+        with self._lock:
+            processes = self._processes
+            self._processes = set()
+            self._idle = []
+            self._disabled = True
+        for process in processes:
+            # workers exit once stdin is closed
+            try:
+                process.stdin.close()
+            except OSError:
+                pass
+            try:
+                process.wait(1)
+            except subprocess.TimeoutExpired:
+                process.kill()
+                process.wait()
+
+
+decrypt_processes = DecryptionProcessPool(PGP_DECRYPT_PROCESSES)
+
+# one thread per worker process, the threads only wait for the processes
+decrypt_pool = ThreadPool(minthreads=1, maxthreads=PGP_DECRYPT_PROCESSES, name='pgp-decrypt')
+decrypt_pool.start()
+reactor.addSystemEventTrigger('before', 'shutdown', decrypt_pool.stop)
+reactor.addSystemEventTrigger('before', 'shutdown', decrypt_processes.stop)
+
+
+def is_pgp_message(body):
+    if not isinstance(body, str):
+        return False
+    body = body.strip()
+    return body.startswith('-----BEGIN PGP MESSAGE-----') and body.endswith('-----END PGP MESSAGE-----')
+
+
+class PGPDecryptionService(object, metaclass=Singleton):
+    """
+    Decrypts PGP armoured message bodies for all the chat and SMS code paths.
+
+    Private keys are parsed once per key file and kept until the file changes.
+    Decrypted bodies are kept in a LRU cache keyed by the digest of the
+    armoured body, so the same message seen by several code paths, or again
+    by a later sync, is only decrypted once. Batches of messages are spread
+    over the worker processes with decrypt_messages.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._private_keys = {}              # key path -> (mtime, key)
+        self._plaintexts = OrderedDict()     # armoured body digest -> plaintext
+
+    def private_key(self, path):
+        """Return the private key stored in path, None if it cannot be loaded"""
+        if not path:
+            return None
+        try:
+            mtime = os.path.getmtime(path)
+        except OSError:
+            return None
+
+        with self._lock:
+            try:
+                key_mtime, key = self._private_keys[path]
+            except KeyError:
+                pass
+            else:
+                if key_mtime == mtime:
+                    return key
+
+        try:
+            key, _ = pgpy.PGPKey.from_file(path)
+        except Exception as e:
+            BlinkLogger().log_error('Cannot import PGP private key from %s: %s' % (path, str(e)))
+            key = None
+        else:
+            BlinkLogger().log_info('PGP private key imported from %s' % path)
+
+        with self._lock:
+            self._private_keys[path] = (mtime, key)
+        return key
+
+    def cached_plaintext(self, body):
+        digest = self._digest(body)
+        with self._lock:
+            try:
+                self._plaintexts.move_to_end(digest)
+            except KeyError:
+                return None
+            return self._plaintexts[digest]
+
+    def decrypt(self, private_key, body):
+        """Decrypt body in the calling thread, returns the plaintext or None"""
+        digest = self._digest(body)
+        with self._lock:
+            try:
+                self._plaintexts.move_to_end(digest)
+            except KeyError:
+                pass
+            else:
+                return self._plaintexts[digest]
+
+        if private_key is None:
+            return None
+
+        plaintext = decrypt_body(private_key, body)
+        if plaintext is not None:
+            self._store(digest, plaintext)
+        return plaintext
+
+    def decrypt_messages(self, private_key, messages, callback=None):
+        """
+        Decrypt (msgid, body) pairs in parallel in the worker processes.
+
+        Returns a deferred firing with a {msgid: plaintext or None} dict once
+        all messages are done. Bodies already in the cache are not queued.
+        If given, callback is called with the partial dict of the cached
+        bodies right away and, from a pool thread, with the partial dict of
+        every batch as soon as that batch is decrypted.
+        """
+        results = {}
+        pending = []
+        for msgid, body in messages:
+            plaintext = self.cached_plaintext(body)
+            if plaintext is not None:
+                results[msgid] = plaintext
+            else:
+                pending.append((msgid, body))
+
+        if callback is not None and results:
+            callback(dict(results))
+
+        if not pending:
+            return defer.succeed(results)
+
+        if private_key is None:
+            results.update((msgid, None) for msgid, body in pending)
+            if callback is not None:
+                callback(dict((msgid, None) for msgid, body in pending))
+            return defer.succeed(results)
+
+        key_blob = str(private_key)
+        batches = [deferToThreadPool(reactor, decrypt_pool, self._decrypt_batch, private_key, key_blob, pending[i:i+PGP_DECRYPT_BATCH_SIZE], callback) for i in range(0, len(pending), PGP_DECRYPT_BATCH_SIZE)]
+
+        def collect(batch_results):
+            for batch in batch_results:
+                results.update(batch)
+            return results
+
+        return defer.gatherResults(batches, consumeErrors=True).addCallback(collect)
+
+    def _decrypt_batch(self, private_key, key_blob, messages, callback):
+        plaintexts = decrypt_processes.decrypt(key_blob, messages)
+        if plaintexts is None:
+            results = dict((msgid, self.decrypt(private_key, body)) for msgid, body in messages)
+        else:
+            results = {}
+            for msgid, body in messages:
+                plaintext = plaintexts.get(msgid)
+                if plaintext is not None:
+                    self._store(self._digest(body), plaintext)
+                results[msgid] = plaintext
+        if callback is not None:
+            try:
+                callback(results)
+            except Exception as e:
+                BlinkLogger().log_error('Error processing decrypted messages: %s' % str(e))
+        return results
+
+    def _store(self, digest, plaintext):
+        with self._lock:
+            self._plaintexts[digest] = plaintext
+            while len(self._plaintexts) > PLAINTEXT_CACHE_SIZE:
+                self._plaintexts.popitem(last=False)
+
+    def _digest(self, body):
+        return hashlib.sha1(body.strip().encode()).digest()
@@ -0,0 +1,68 @@
+# Copyright (C) 2025 AG Projects. See LICENSE for details.
+#
+
+"""
+Decryption of PGP message bodies in a separate process.
+
+pgpy parses and decrypts in pure Python, holding the GIL, so Blink runs it
+in worker processes started from its own executable with the
+--pgp-decrypt-worker argument (see main.m). This module must not import
+anything from Blink. A worker reads requests from stdin and writes replies
+to stdout, one JSON document per line. A request holds an armoured private
+key and a list of [msgid, body] pairs, the reply maps every msgid to the
+plaintext or to null if the body cannot be decrypted. The worker exits when
+stdin is closed.
+"""
+
+import hashlib
+import json
+import sys
+
+import pgpy
+
+
+__all__ = ['decrypt_body']
+
+
+def decrypt_body(private_key, body):
+    """Decrypt an armoured message body, returns the plaintext or None"""
+    try:
+        pgp_message = pgpy.PGPMessage.from_blob(body.strip())
+        decrypted_message = private_key.decrypt(pgp_message)
+    except (pgpy.errors.PGPDecryptionError, pgpy.errors.PGPError, ValueError):
+        return None
+
+    try:
+        plaintext = bytes(decrypted_message.message, 'latin1')
+    except (TypeError, UnicodeEncodeError):
+        try:
+            plaintext = bytes(decrypted_message.message, 'utf-8')
+        except (TypeError, UnicodeEncodeError):
+            return None
+    try:
+        return plaintext.decode('utf-8')
+    except UnicodeDecodeError:
+        return plaintext.decode('utf-8', errors='replace')
+
+
+def main():
+    private_keys = {}    # armoured key digest -> key
+    for line in sys.stdin.buffer:
+        request = json.loads(line.decode())
+        key_blob = request['key']
+        digest = hashlib.sha1(key_blob.encode()).digest()
+        try:
+            private_key = private_keys[digest]
+        except KeyError:
+            try:
+                private_key, _ = pgpy.PGPKey.from_blob(key_blob)
+            except Exception:
+                private_key = None
+            private_keys[digest] = private_key
+        results = dict((msgid, decrypt_body(private_key, body) if private_key is not None else None) for msgid, body in request['messages'])
+        sys.stdout.buffer.write(json.dumps(results).encode() + b'\n')
+        sys.stdout.buffer.flush()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,204 @@
+# Copyright (C) 2025 AG Projects. See LICENSE for details.
+#
+
+import glob
+import hashlib
+import os
+import pgpy
+import re
+import threading
+import time
+
+from application.notification import NotificationCenter
+from application.python.types import Singleton
+from application.system import makedirs
+from sqlobject import connectionForURI
+
+from BlinkLogger import BlinkLogger
+from HistoryManager import TableVersions, run_in_db_thread
+from resources import ApplicationData
+
+
+__all__ = ['PGPKeyring', 'extract_public_key']
+
+
+_public_key_block = re.compile(r'^-----BEGIN PGP PUBLIC KEY BLOCK-----$.*?^-----END PGP PUBLIC KEY BLOCK-----$', re.MULTILINE | re.DOTALL)
+
+
+def extract_public_key(text):
+    """Return the first armoured public key block found in text, None if there is none"""
+    if isinstance(text, bytes):
+        text = text.decode(errors='replace')
+    match = _public_key_block.search(text.replace('\r\n', '\n'))
+    return match.group(0) + '\n' if match else None
+
+
+class PGPKeyring(object, metaclass=Singleton):
+    """
+    Public keys of the remote parties, kept in history.sqlite.
+
+    The whole index (URI -> fingerprint, checksum and armoured key) is loaded
+    in memory at start and parsed keys are cached, so looking up the key used
+    to encrypt a message costs a dictionary access. Lookups do not wait for
+    the index to load, PGPKeyringDidLoad is posted once it is. Changes are
+    written in the db thread, one transaction per call to add_keys.
+    """
+    __version__ = 1
+
+    table = 'pgp_public_keys'
+    schema = "create table if not exists pgp_public_keys (uri text primary key, fingerprint text not null, checksum text not null, public_key text not null, timestamp numeric not null)"
+    load_timeout = 5.0
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._loaded = threading.Event()
+        self._entries = {}    # uri -> (fingerprint, checksum, armoured key)
+        self._keys = {}       # uri -> parsed key
+        self.keys_path = ApplicationData.get('keys')
+        path = ApplicationData.get('history')
+        makedirs(path)
+        db_uri = "sqlite://" + os.path.join(path,"history.sqlite")
+        TableVersions()    # initialize versions table
+        self._initialize(db_uri)
+
+    @run_in_db_thread
+    def _initialize(self, db_uri):
+        self.db = connectionForURI(db_uri)
+        try:
+            version = TableVersions().get_table_version(self.table)
+            self.db.queryAll(self.schema)
+            if version is None:
+                self._import_key_files()
+                TableVersions().set_table_version(self.table, self.__version__)
+            rows = self.db.queryAll("select uri, fingerprint, checksum, public_key from pgp_public_keys")
+        except Exception as e:
+            BlinkLogger().log_error("Error loading PGP public keys: %s" % e)
+        else:
+            with self._lock:
+                for uri, fingerprint, checksum, public_key in rows:
+                    self._entries.setdefault(uri, (fingerprint, checksum, public_key))
+        finally:
+            self._loaded.set()
+            NotificationCenter().post_notification('PGPKeyringDidLoad', sender=self)
+
+    def _import_key_files(self):
+        # Caller needs to be in the db thread. Keys of our own accounts stay in
+        # their files next to the private keys.
+        keys = []
+        for path in glob.glob(os.path.join(self.keys_path, '*.pubkey')):
+            uri = os.path.basename(path)[:-len('.pubkey')]
+            if os.path.exists(os.path.join(self.keys_path, '%s.privkey' % uri)):
+                continue
+            try:
+                with open(path) as f:
+                    public_key = extract_public_key(f.read())
+            except OSError:
+                continue
+            entry = public_key and self._parse(uri, public_key)
+            if entry:
+                keys.append(entry)
+        if keys and self._write(keys):
+            BlinkLogger().log_info("Imported %d PGP public keys into the keyring" % len(keys))
+
+    def _parse(self, uri, public_key):
+        try:
+            key, _ = pgpy.PGPKey.from_blob(public_key)
+        except Exception as e:
+            BlinkLogger().log_error("Invalid PGP public key of %s: %s" % (uri, e))
+            return None
+        return uri, str(key.fingerprint).replace(' ', ''), hashlib.sha1(public_key.encode()).hexdigest(), public_key, key
+
+    @run_in_db_thread
+    def _save(self, keys):
+        self._write(keys)
+
+    def _write(self, keys):
+        # Caller needs to be in the db thread
+        now = int(time.time())
+        rows = ["(%s, %s, %s, %s, %s)" % (self.db.sqlrepr(uri), self.db.sqlrepr(fingerprint), self.db.sqlrepr(checksum), self.db.sqlrepr(public_key), now) for uri, fingerprint, checksum, public_key, key in keys]
+        transaction = self.db.transaction()
+        try:
+            for i in range(0, len(rows), 500):
+                transaction.query("insert or replace into pgp_public_keys (uri, fingerprint, checksum, public_key, timestamp) values %s" % ", ".join(rows[i:i+500]))
+        except Exception as e:
+            transaction.rollback()
+            BlinkLogger().log_error("Error saving %d PGP public keys: %s" % (len(rows), e))
+            return False
+        else:
+            transaction.commit(close=True)
+            return True
+
+    @property
+    def loaded(self):
+        return self._loaded.is_set()
+
+    def _wait_loaded(self):
+        # Only for callers outside the GUI thread
+        if not self._loaded.is_set():
+            self._loaded.wait(self.load_timeout)
+
+    def get_key(self, uri):
+        """
+        Return the parsed public key of uri, None if there is none. Also
+        returns None while the keyring is being loaded, check loaded and wait
+        for the PGPKeyringDidLoad notification in that case.
+        """
+        if not self.loaded:
+            return None
+        with self._lock:
+            try:
+                return self._keys[uri]
+            except KeyError:
+                try:
+                    fingerprint, checksum, public_key = self._entries[uri]
+                except KeyError:
+                    return None
+        entry = self._parse(uri, public_key)
+        key = entry[4] if entry else None
+        with self._lock:
+            self._keys[uri] = key
+        return key
+
+    def get_checksum(self, uri):
+        if not self.loaded:
+            return None
+        with self._lock:
+            entry = self._entries.get(uri)
+        return entry[1] if entry else None
+
+    def add_key(self, uri, text):
+        """Store the public key found in text, see add_keys"""
+        return self.add_keys([(uri, text)])
+
+    def add_keys(self, keys):
+        """
+        Store the public keys found in the (uri, text) pairs. Keys identical to
+        the stored ones are skipped and the new or changed ones are saved in
+        one transaction. Returns a list of (uri, public key, checksum) for the
+        keys that were added or changed.
+        """
+        self._wait_loaded()
+        entries = {}
+        for uri, text in keys:
+            public_key = extract_public_key(text)
+            if public_key is None:
+                BlinkLogger().log_info("No public PGP key detected in the payload from %s" % uri)
+                continue
+            checksum = hashlib.sha1(public_key.encode()).hexdigest()
+            with self._lock:
+                current = self._entries.get(uri)
+            if (current is not None and current[1] == checksum) or (uri in entries and entries[uri][2] == checksum):
+                continue
+            entry = self._parse(uri, public_key)
+            if entry:
+                entries[uri] = entry
+
+        if not entries:
+            return []
+
+        with self._lock:
+            for uri, fingerprint, checksum, public_key, key in entries.values():
+                self._entries[uri] = (fingerprint, checksum, public_key)
+                self._keys[uri] = key
+        self._save(list(entries.values()))
+        return [(uri, public_key, checksum) for uri, fingerprint, checksum, public_key, key in entries.values()]
@@ -2162,6 +2162,11 @@ SettingDescription = {
                       'logs.trace_pjsip_to_file': NSLocalizedString("Log Core Engine", "Label"),
                       'logs.trace_notifications_to_file': NSLocalizedString("Log Notifications", "Label"),
                       'logs.pjsip_level': NSLocalizedString("Core Engine Level", "Label"),
+                      'logs.fsync_on_error': NSLocalizedString("Sync Logs to Disk on Errors", "Label"),
+                      'logs.max_file_size': NSLocalizedString("Rotate Logs Larger Than", "Label"),
+                      'logs.max_file_age': NSLocalizedString("Rotate Logs Older Than", "Label"),
+                      'logs.max_rotated_files': NSLocalizedString("Rotated Logs Kept", "Label"),
+                      'logs.compress_rotated_files': NSLocalizedString("Compress Rotated Logs", "Label"),
                       'message_summary.voicemail_uri': NSLocalizedString("Mailbox URI", "Label"),
                       'message_summary.enabled': NSLocalizedString("Enabled", "Label"),
                       'msrp.transport': NSLocalizedString("Transport", "Label"),
@@ -2286,7 +2291,7 @@ GeneralSettingsOrder = {
                        'sip': ['transport_list', 'udp_port', 'tcp_port', 'tls_port', 'invite_timeout'],
                        'sounds': ['audio_inbound', 'audio_outbound', 'message_received', 'message_sent', 'file_received' ,'file_sent', 'night_volume'],
                        'gui': ['extended_debug', 'use_default_web_browser_for_alerts', 'media_support_detection', 'idle_threshold', 'rtt_threshold', 'close_delay'],
-                       'logs': ['trace_sip_to_file', 'trace_msrp_to_file', 'trace_xcap_to_file', 'trace_notifications_to_file', 'trace_pjsip_to_file', 'pjsip_level'],
+                       'logs': ['trace_sip_to_file', 'trace_msrp_to_file', 'trace_xcap_to_file', 'trace_notifications_to_file', 'trace_pjsip_to_file', 'pjsip_level', 'fsync_on_error', 'max_file_size', 'max_file_age', 'max_rotated_files', 'compress_rotated_files'],
                        'h264': ['profile', 'level']
                        }
 
@@ -2316,7 +2321,9 @@ UnitOptions = {
                'subscribe_interval': NSLocalizedString("seconds", "Label"),
                'idle_threshold': NSLocalizedString("seconds", "Label"),
                'rtt_threshold': NSLocalizedString("milliseconds", "Label"),
-               'framerate': NSLocalizedString("frames/s", "Label")
+               'framerate': NSLocalizedString("frames/s", "Label"),
+               'max_file_size': NSLocalizedString("MB", "Label"),
+               'max_file_age': NSLocalizedString("days", "Label")
                }
 
 ToolTips = {
@@ -2348,6 +2355,8 @@ ToolTips = {
              'tls.certificate': NSLocalizedString("X.509 certificate and unencrypted private key concatenated in the same file", "Label"),
              'tls.verify_server': NSLocalizedString("Verify the validity of TLS certificate presented by remote server. The certificate must be signed by a Certificate Authority installed in the system.", "Label"),
              'tls.ca_list': NSLocalizedString("File that contains a list of Certificate Autorities (CA) additional to the ones provided by MacOSX. Each CA must be in PEM format, multiple CA can be concantenated.", "Label"),
+             'logs.fsync_on_error': NSLocalizedString("Force log files to disk whenever an error is logged, slower but nothing is lost if the application crashes right after", "Label"),
+             'logs.max_rotated_files': NSLocalizedString("Number of rotated segments kept for each log file, older ones are deleted. If 0, all segments are kept", "Label"),
              'gui.close_delay': NSLocalizedString("Interval to keep GUI elements alive after session ends (seconds)", "Label"),
              'xcap.xcap_root': NSLocalizedString("If empty, it is automatically discovered using DNS lookup for TXT record of xcap.domain", "Label")
            }
@@ -0,0 +1,266 @@
+# Copyright (C) 2025 AG Projects. See LICENSE for details.
+#
+
+from AppKit import NSImage
+from Foundation import NSData
+
+import atexit
+import base64
+import hashlib
+import http.client
+import os
+import queue
+import threading
+import time
+import urllib.parse
+
+from application.python.types import Singleton
+from application.system import makedirs, unlink
+from sipsimple.payloads import prescontent
+
+from BlinkLogger import BlinkLogger
+from resources import ApplicationData
+from util import allocate_autorelease_pool
+
+
+__all__ = ['IconCache', 'PresenceIconFetcher', 'ICON_MODIFIED', 'ICON_NOT_MODIFIED', 'ICON_FAILED']
+
+
+ICON_FETCH_WORKERS = 4      # icons downloaded in parallel
+ICON_FETCH_TIMEOUT = 15     # seconds
+ICON_MAX_REDIRECTS = 3
+ICON_CACHE_MAX_AGE = 30 * 86400             # seconds since an image was last used
+ICON_CACHE_MAX_SIZE = 50 * 1024 * 1024      # bytes
+
+ICON_MODIFIED = 'modified'
+ICON_NOT_MODIFIED = 'not-modified'
+ICON_FAILED = 'failed'
+
+
+class IconCache(object, metaclass=Singleton):
+    """
+    Content addressed store of downloaded icons. Every distinct image is kept
+    once, named after the SHA1 of its content, so contacts publishing the same
+    image download it only once. The per contact icon files are copies, as
+    they can be replaced by the user. Images not used for a while are removed
+    by prune.
+    """
+
+    def __init__(self):
+        self.base_path = ApplicationData.get('photos/cache')
+        makedirs(self.base_path)
+
+    def path_for_digest(self, digest):
+        return os.path.join(self.base_path, digest)
+
+    def has(self, digest):
+        return digest is not None and os.path.isfile(self.path_for_digest(digest))
+
+    def store(self, content):
+        digest = hashlib.sha1(content).hexdigest()
+        path = self.path_for_digest(digest)
+        if os.path.isfile(path):
+            self._touch(path)
+        else:
+            tmp_path = '%s.%d.tmp' % (path, threading.get_ident())
+            with open(tmp_path, 'wb') as f:
+                f.write(content)
+            os.replace(tmp_path, path)
+        return digest
+
+    def copy(self, digest, path):
+        source = self.path_for_digest(digest)
+        tmp_path = '%s.tmp' % path
+        with open(source, 'rb') as src, open(tmp_path, 'wb') as dst:
+            dst.write(src.read())
+        os.replace(tmp_path, path)
+        self._touch(source)
+
+    def prune(self, max_age=ICON_CACHE_MAX_AGE, max_size=ICON_CACHE_MAX_SIZE):
+        """Remove the images not used for max_age seconds, then the least recently used ones above max_size"""
+        entries = []
+        for name in os.listdir(self.base_path):
+            if name.endswith('.tmp'):
+                continue
+            path = os.path.join(self.base_path, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        entries.sort(reverse=True)
+
+        now = time.time()
+        total_size = 0
+        removed = 0
+        for mtime, size, path in entries:
+            total_size += size
+            if now - mtime > max_age or total_size > max_size:
+                unlink(path)
+                removed += 1
+        if removed:
+            BlinkLogger().log_debug('Removed %d images from the icon cache' % removed)
+
+    def _touch(self, path):
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+
+class PresenceIconFetcher(object, metaclass=Singleton):
+    """
+    Downloads the icons published in presence documents on a small pool of
+    worker threads. Each worker keeps one connection per host open across
+    requests. Concurrent requests for the same URL are joined into a single
+    download and an URL whose ETag was already fetched is answered from the
+    icon cache without any request.
+
+    The callback is called from a worker thread with the URL, one of
+    ICON_MODIFIED, ICON_NOT_MODIFIED or ICON_FAILED, the ETag and the digest
+    of the image in the IconCache (None if it is not known).
+    """
+
+    def __init__(self):
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._threads = []
+        self._pending = {}       # url -> callbacks waiting for the download
+        self._validators = {}    # url -> (etag, digest) of the last download
+        self._pruned = False
+        atexit.register(self.stop)
+
+    def fetch(self, url, etag, callback, expected_etag=None):
+        with self._lock:
+            etag_and_digest = self._validators.get(url)
+            if etag_and_digest is not None and expected_etag is not None and etag_and_digest[0] == expected_etag and IconCache().has(etag_and_digest[1]):
+                cached = etag_and_digest
+            else:
+                cached = None
+                callbacks = self._pending.get(url)
+                if callbacks is not None:
+                    callbacks.append(callback)
+                    return
+                self._pending[url] = [callback]
+                self._start()
+
+        if cached is not None:
+            callback(url, ICON_MODIFIED, *cached)
+        else:
+            self._queue.put((url, etag))
+
+    def stop(self):
+        with self._lock:
+            threads, self._threads = self._threads, []
+        for thread in threads:
+            self._queue.put(None)
+
+    def _start(self):
+        while len(self._threads) < ICON_FETCH_WORKERS:
+            prune = not self._threads and not self._pruned
+            self._pruned = True
+            thread = threading.Thread(target=self._run, args=(prune,), name='Presence icon fetcher %d' % (len(self._threads) + 1), daemon=True)
+            self._threads.append(thread)
+            thread.start()
+
+    def _run(self, prune=False):
+        if prune:
+            try:
+                IconCache().prune()
+            except OSError as e:
+                BlinkLogger().log_error('Failed to prune the icon cache: %s' % str(e))
+        connections = {}
+        while True:
+            job = self._queue.get()
+            if job is None:
+                break
+            self._process(connections, *job)
+        for connection in connections.values():
+            connection.close()
+
+    @allocate_autorelease_pool
+    def _process(self, connections, url, etag):
+        try:
+            result = self._download(connections, url, etag)
+        except Exception as e:
+            BlinkLogger().log_error('Failed to get icon %s: %s' % (url, str(e)))
+            result = (ICON_FAILED, None, None)
+
+        with self._lock:
+            if result[0] == ICON_MODIFIED:
+                self._validators[url] = result[1:]
+            callbacks = self._pending.pop(url, [])
+
+        for callback in callbacks:
+            try:
+                callback(url, *result)
+            except Exception as e:
+                BlinkLogger().log_error('Failed to process icon %s: %s' % (url, str(e)))
+
+    def _download(self, connections, url, etag):
+        response, content = self._request(connections, url, etag)
+        if response.status == 304:
+            with self._lock:
+                etag_and_digest = self._validators.get(url)
+            digest = etag_and_digest[1] if etag_and_digest is not None and etag_and_digest[0] == etag else None
+            return ICON_NOT_MODIFIED, etag, digest
+        if response.status != 200:
+            BlinkLogger().log_error('Failed to get icon %s: %d %s' % (url, response.status, response.reason))
+            return ICON_FAILED, None, None
+
+        etag = response.getheader('etag') or ''
+        if etag.startswith('W/'):
+            etag = etag[2:]
+        etag = etag.replace('\"', '')
+
+        if response.getheader('content-type') == prescontent.PresenceContentDocument.content_type:
+            pres_content = prescontent.PresenceContentDocument.parse(content)
+            content = base64.b64decode(pres_content.data.value)
+
+        cache = IconCache()
+        digest = hashlib.sha1(content).hexdigest()
+        if not cache.has(digest):
+            # only images never seen before need to be checked
+            icon = NSImage.alloc().initWithData_(NSData.alloc().initWithBytes_length_(content, len(content)))
+            if icon is None:
+                BlinkLogger().log_error('Icon %s is not a valid image' % url)
+                return ICON_FAILED, None, None
+            del icon
+            cache.store(content)
+        return ICON_MODIFIED, etag, digest
+
+    def _request(self, connections, url, etag):
+        for redirect in range(ICON_MAX_REDIRECTS + 1):
+            parts = urllib.parse.urlsplit(url)
+            key = (parts.scheme, parts.netloc)
+            path = urllib.parse.urlunsplit(('', '', parts.path or '/', parts.query, ''))
+            headers = {'If-None-Match': etag} if etag else {}
+
+            for attempt in range(2):
+                connection = connections.get(key)
+                if connection is None:
+                    connection_class = http.client.HTTPSConnection if parts.scheme == 'https' else http.client.HTTPConnection
+                    connection = connections[key] = connection_class(parts.netloc, timeout=ICON_FETCH_TIMEOUT)
+                try:
+                    connection.request('GET', path, headers=headers)
+                    response = connection.getresponse()
+                    content = response.read()
+                except (http.client.HTTPException, OSError):
+                    connection.close()
+                    del connections[key]
+                    # the server may have closed a connection that was idle, retry once on a new one
+                    if attempt:
+                        raise
+                else:
+                    if response.will_close:
+                        connection.close()
+                        del connections[key]
+                    break
+
+            location = response.getheader('location')
+            if response.status in (301, 302, 303, 307, 308) and location:
+                url = urllib.parse.urljoin(url, location)
+                continue
+            return response, content
+
+        raise http.client.HTTPException('too many redirects')
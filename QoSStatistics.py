@@ -0,0 +1,141 @@
+# Copyright (C) 2025 AG Projects. See LICENSE for details.
+#
+
+"""
+Encoding and aggregation of per call QoS samples.
+
+Samples are stored as fixed width little endian records, one per statistics
+interval, so that a whole call is a single compact blob that can be appended
+to while the call is running and decoded without any parsing. This module has
+no dependencies on the rest of Blink so that it can also be used by the
+command line report in scripts/qos_report.py.
+"""
+
+import struct
+
+from collections import namedtuple
+
+
+__all__ = ['QoSSample', 'QOS_SAMPLE_SIZE', 'encode_qos_sample', 'decode_qos_samples', 'percentile', 'loss_bursts', 'summarize_qos', 'aggregate_qos', 'qos_report']
+
+
+# offset (s), rtt (ms), jitter (ms), rx loss (1/100 %), tx loss (1/100 %), rx speed (bps), tx speed (bps)
+_sample_format = struct.Struct('<IHHHHII')
+
+QOS_SAMPLE_SIZE = _sample_format.size
+
+QoSSample = namedtuple('QoSSample', ['offset', 'rtt', 'jitter', 'loss_rx', 'loss_tx', 'rx_speed', 'tx_speed'])
+
+
+def _clamp(value, maximum):
+    return max(0, min(int(round(value)), maximum))
+
+
+def encode_qos_sample(offset, rtt, jitter, loss_rx, loss_tx, rx_speed, tx_speed):
+    return _sample_format.pack(_clamp(offset, 0xffffffff), _clamp(rtt, 0xffff), _clamp(jitter, 0xffff), _clamp(loss_rx * 100, 10000), _clamp(loss_tx * 100, 10000), _clamp(rx_speed, 0xffffffff), _clamp(tx_speed, 0xffffffff))
+
+
+def decode_qos_samples(data):
+    data = data[:len(data) - len(data) % QOS_SAMPLE_SIZE]    # ignore a truncated trailing record
+    return [QoSSample(offset, rtt, jitter, loss_rx / 100.0, loss_tx / 100.0, rx_speed, tx_speed) for offset, rtt, jitter, loss_rx, loss_tx, rx_speed, tx_speed in _sample_format.iter_unpack(data)]
+
+
+def percentile(values, p):
+    """Linearly interpolated percentile p (0-100) of values, None if there are no values"""
+    values = sorted(values)
+    if not values:
+        return None
+    position = (len(values) - 1) * p / 100.0
+    lower = int(position)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+
+def loss_bursts(samples, threshold=3.0, field='loss_rx'):
+    """Return (start offset, duration, peak loss) for each run of consecutive samples with loss above threshold"""
+    bursts = []
+    start = previous = peak = None
+    for sample in samples:
+        loss = getattr(sample, field)
+        if loss > threshold:
+            if start is None:
+                start = sample.offset
+                peak = loss
+            else:
+                peak = max(peak, loss)
+            previous = sample.offset
+        elif start is not None:
+            bursts.append((start, previous - start + 1, peak))
+            start = None
+    if start is not None:
+        bursts.append((start, previous - start + 1, peak))
+    return bursts
+
+
+def summarize_qos(samples, loss_threshold=3.0):
+    """Summary of the samples of one stream"""
+    if not samples:
+        return None
+    bursts = loss_bursts(samples, loss_threshold)
+    rtt = [sample.rtt for sample in samples]
+    jitter = [sample.jitter for sample in samples]
+    loss_rx = [sample.loss_rx for sample in samples]
+    loss_tx = [sample.loss_tx for sample in samples]
+    return {'samples': len(samples),
+            'duration': samples[-1].offset - samples[0].offset + 1,
+            'rtt_p50': percentile(rtt, 50),
+            'rtt_p95': percentile(rtt, 95),
+            'rtt_max': max(rtt),
+            'jitter_p50': percentile(jitter, 50),
+            'jitter_p95': percentile(jitter, 95),
+            'loss_rx_mean': sum(loss_rx) / len(loss_rx),
+            'loss_rx_p95': percentile(loss_rx, 95),
+            'loss_tx_mean': sum(loss_tx) / len(loss_tx),
+            'loss_bursts': len(bursts),
+            'longest_loss_burst': max((duration for start, duration, peak in bursts), default=0),
+            'rx_speed_mean': sum(sample.rx_speed for sample in samples) / len(samples),
+            'tx_speed_mean': sum(sample.tx_speed for sample in samples) / len(samples)}
+
+
+def aggregate_qos(summaries):
+    """Distribution of per call summaries across many calls"""
+    summaries = [summary for summary in summaries if summary]
+    if not summaries:
+        return None
+    rtt = [summary['rtt_p95'] for summary in summaries]
+    jitter = [summary['jitter_p95'] for summary in summaries]
+    loss = [summary['loss_rx_mean'] for summary in summaries]
+    return {'calls': len(summaries),
+            'duration': sum(summary['duration'] for summary in summaries),
+            'rtt_p95_p50': percentile(rtt, 50),
+            'rtt_p95_p95': percentile(rtt, 95),
+            'jitter_p95_p50': percentile(jitter, 50),
+            'jitter_p95_p95': percentile(jitter, 95),
+            'loss_rx_mean_p50': percentile(loss, 50),
+            'loss_rx_mean_p95': percentile(loss, 95),
+            'calls_with_loss_bursts': sum(1 for summary in summaries if summary['loss_bursts'])}
+
+
+def qos_report(db, media_type='audio', remote_uri=None, after_date=None, before_date=None, count=1000, loss_threshold=3.0):
+    """Per call summaries of the most recent calls and their aggregate, read from an sqlite3 connection to the history database"""
+    query = "select q.session_id, s.remote_uri, s.start_time, s.duration, q.samples from session_qos q join sessions s on s.session_id = q.session_id where q.media_type = ?"
+    args = [media_type]
+    if remote_uri:
+        query += " and s.remote_uri = ?"
+        args.append(remote_uri)
+    if after_date:
+        query += " and s.start_time >= ?"
+        args.append(after_date)
+    if before_date:
+        query += " and s.start_time < ?"
+        args.append(before_date)
+    query += " group by q.session_id order by s.start_time desc limit ?"
+    args.append(count)
+
+    calls = []
+    for session_id, uri, start_time, duration, samples in db.execute(query, args).fetchall():
+        summary = summarize_qos(decode_qos_samples(bytes(samples)), loss_threshold)
+        if summary:
+            summary.update(session_id=session_id, remote_uri=uri, start_time=start_time, call_duration=duration)
+            calls.append(summary)
+    return {'calls': calls, 'aggregate': aggregate_qos(calls)}
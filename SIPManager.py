@@ -16,7 +16,6 @@ from application.python.types import Singleton
 from application.system import host, makedirs, unlink
 
 from collections import defaultdict
-from datetime import datetime
 from eventlib import api, coros, proc
 from eventlib.green import select
 from gnutls.crypto import X509Certificate, X509PrivateKey
@@ -32,7 +31,7 @@ from sipsimple.addressbook import Contact, Group, ContactURI
 from sipsimple.configuration import DefaultValue
 from sipsimple.configuration import ConfigurationManager, ObjectNotFoundError
 from sipsimple.configuration.settings import SIPSimpleSettings
-from sipsimple.core import FrozenSIPURI, SIPURI, SIPCoreError, CORE_REVISION, PJ_VERSION, PJ_SVN_REVISION
+from sipsimple.core import FrozenSIPURI, SIPCoreError, CORE_REVISION, PJ_VERSION, PJ_SVN_REVISION
 try:
     from sipsimple.core import CORE_BUILD
 except ImportError:
@@ -43,12 +42,13 @@ from sipsimple.threading import run_in_twisted_thread
 from sipsimple.threading.green import call_in_green_thread, run_in_green_thread, Command
 
 from BlinkLogger import BlinkLogger, FileLogger
+from HistoryManager import RecordingHistory
 
 from configuration.account import AccountExtension, BonjourAccountExtension
 from configuration.contact import BlinkContactExtension, BlinkContactURIExtension, BlinkGroupExtension
 from configuration.settings import SIPSimpleSettingsExtension
 from resources import ApplicationData, Resources
-from util import beautify_audio_codec, beautify_video_codec, format_identity_to_string, run_in_gui_thread, trusted_cas
+from util import beautify_audio_codec, beautify_video_codec, run_in_gui_thread, trusted_cas
 
 
 @implementer(IObserver)
@@ -313,7 +313,7 @@ class SIPManager(object, metaclass=Singleton):
         settings.save()
 
     def get_recordings_directory(self):
-        return ApplicationData.get('history')
+        return RecordingHistory().directory
 
     def get_contacts_backup_directory(self):
         path = ApplicationData.get('contacts_backup')
@@ -321,52 +321,7 @@ class SIPManager(object, metaclass=Singleton):
         return path
 
     def get_recordings(self, filter_uris=[]):
-        result = []
-        historydir = self.get_recordings_directory()
-
-        for acct in os.listdir(historydir):
-            dirname = historydir + "/" + acct
-            if not os.path.isdir(dirname):
-                continue
-
-            files = [dirname+"/"+f for f in os.listdir(dirname)]
-
-            for file in files:
-                try:
-                    recording_type = "audio" if file.endswith(".wav") else "video"
-                    stat = os.stat(file)
-                    toks = file.split("/")[-1].split("-", 2)
-                    if len(toks) == 3:
-                        date, time, rest = toks
-                        timestamp = date[:4]+"/"+date[4:6]+"/"+date[6:8]+" "+time[:2]+":"+time[2:4]
-
-                        pos = rest.rfind(".")
-                        if pos >= 0:
-                            remote = rest[:pos]
-                        else:
-                            remote = rest
-                        try:
-                            identity = SIPURI.parse('sip:'+str(remote))
-                            remote_party = format_identity_to_string(identity, check_contact=True)
-                        except SIPCoreError:
-                            remote_party = "%s" % (remote)
-
-                    else:
-                        try:
-                            identity = SIPURI.parse('sip:'+str(file[:-4]))
-                            remote_party = format_identity_to_string(identity, check_contact=True)
-                        except SIPCoreError:
-                            remote_party = file[:-4]
-                        timestamp = datetime.fromtimestamp(int(stat.st_ctime)).strftime("%E %T")
-
-                    if filter_uris and remote_party not in filter_uris:
-                        continue
-                    result.append((timestamp, remote_party, file, recording_type))
-                except Exception:
-                    pass
-
-        sorted(result, key=lambda x: x[0])
-        return result
+        return [(start_time.strftime("%Y/%m/%d %H:%M"), remote_uri, path, recording_type) for start_time, path, recording_type, local_uri, remote_uri, duration in RecordingHistory().get_recordings(remote_uris=filter_uris)]
 
     def get_contact_backups(self):
         result = []
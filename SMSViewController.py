@@ -44,6 +44,7 @@ from application.python import Null
 from application.python.queue import EventQueue
 from application.system import host
 from dateutil.parser._parser import ParserError as DateParserError
+from eventlib.twistedutil import block_on
 from zope.interface import implementer
 from resources import ApplicationData
 
@@ -66,6 +67,8 @@ from pgpy.constants import PubKeyAlgorithm, KeyFlags, HashAlgorithm, SymmetricKe
 from BlinkLogger import BlinkLogger
 from ChatViewController import MSG_STATE_SENDING, MSG_STATE_SENT, MSG_STATE_DELIVERED, MSG_STATE_FAILED, MSG_STATE_DISPLAYED, MSG_STATE_FAILED_LOCAL, MSG_STATE_DEFERRED
 from HistoryManager import ChatHistory
+from PGPDecryptionService import PGPDecryptionService, is_pgp_message
+from PGPKeyring import PGPKeyring
 from SmileyManager import SmileyManager
 from util import format_identity_to_string, html2txt, sipuri_components_from_string, run_in_gui_thread
 from ChatOTR import ChatOtrSmp
@@ -169,6 +172,7 @@ class SMSViewController(NSObject):
     bonjour_lookup_enabled = True
     account_info = None
     oldest_timestamp = None
+    oldest_cursor = None
 
     def initWithAccount_target_name_instance_(self, account, target, display_name, instance_id, selected_contact=None, is_replication_message=False):
         self = objc.super(SMSViewController, self).init()
@@ -207,6 +211,7 @@ class SMSViewController(NSObject):
             
             self.is_replication_message = is_replication_message
 
+            self.notification_center.add_observer(self, name='PGPKeyringDidLoad')
             self.load_remote_public_keys()
             self.load_private_key()
 
@@ -238,18 +243,17 @@ class SMSViewController(NSObject):
 
     @objc.python_method
     def load_remote_public_keys(self):
-        public_key_path = "%s/%s.pubkey" % (self.keys_path, self.remote_uri)
-        
-        if not os.path.exists(public_key_path):
-            self.requestPublicKey()
+        keyring = PGPKeyring()
+        public_key = keyring.get_key(self.remote_uri)
+        if public_key is None:
+            # a keyring that is not loaded yet may still have the key,
+            # we look again on PGPKeyringDidLoad
+            if keyring.loaded:
+                self.requestPublicKey()
             return
 
-        try:
-            self.public_key, _ = pgpy.PGPKey.from_file(public_key_path)
-        except Exception as e:
-            self.log_info('Cannot import PGP public key: %s' % str(e))
-        else:
-            self.log_info('PGP public key of %s imported from %s' % (self.remote_uri, public_key_path))
+        self.public_key = public_key
+        self.log_info('PGP public key of %s loaded from the keyring' % self.remote_uri)
 
     @objc.python_method
     def load_private_key(self):
@@ -265,12 +269,8 @@ class SMSViewController(NSObject):
             # nothing to load; encrypted messaging stays unavailable for now.
             return
 
-        try:
-            self.private_key, _ = pgpy.PGPKey.from_file(self.account.sms.private_key)
-        except Exception as e:
-            self.log_info('Cannot import PGP private key: %s' % str(e))
-        else:
-            self.log_info('My PGP private key imported from %s' % self.account.sms.private_key)
+        # parsed once per key file and shared with the other decryption paths
+        self.private_key = PGPDecryptionService().private_key(self.account.sms.private_key)
 
         public_key_path = "%s/%s.pubkey" % (self.keys_path, self.account.id)
 
@@ -495,18 +495,15 @@ class SMSViewController(NSObject):
                     self.chatViewController.showSystemMessage("No PGP private key available", ISOTimestamp.now(), is_error=True)
                     return
                 else:
-                    try:
-                        pgpMessage = pgpy.PGPMessage.from_blob(text_content)
-                        decrypted_message = self.private_key.decrypt(pgpMessage)
-                    except (pgpy.errors.PGPDecryptionError, pgpy.errors.PGPError) as e:
+                    plaintext = PGPDecryptionService().decrypt(self.private_key, text_content)
+                    if plaintext is None:
                         if self.pgp_encrypted:
                             self.pgp_encrypted = False
                             self.notification_center.post_notification('PGPEncryptionStateChanged', sender=self)
-                        #self.chatViewController.showSystemMessage("PGP decryption error: %s" % str(e), ISOTimestamp.now(), is_error=True)
 
-                        self.chatViewController.showMessage(call_id, id, direction, sender_name, icon, "PGP decryption error: %s" % str(e), timestamp, state=MSG_STATE_FAILED, media_type='sms')
+                        self.chatViewController.showMessage(call_id, id, direction, sender_name, icon, "PGP decryption error", timestamp, state=MSG_STATE_FAILED, media_type='sms')
 
-                        self.log_error('PGP decrypt error: %s' % str(e))
+                        self.log_error('PGP decrypt error for message %s' % id)
                         if require_delivered_notification:
                             self.sendIMDNNotification(id, 'failed')
                         return
@@ -516,15 +513,7 @@ class SMSViewController(NSObject):
                             self.pgp_encrypted = True
                             self.notification_center.post_notification('PGPEncryptionStateChanged', sender=self)
 
-                        try:
-                            content = bytes(decrypted_message.message, 'latin1')
-                        except (TypeError, UnicodeEncodeError) as e:
-                            try:
-                                content = bytes(decrypted_message.message, 'utf-8')
-                            except (TypeError, UnicodeEncodeError) as e:
-                                self.log_error('Decrypted data encode error: %s' % str(e))
-                                self.log_error('Decrypted data: %s' % decrypted_message)
-                                return
+                        content = plaintext.encode()
             else:
                 self.pgp_encrypted = False
             
@@ -729,24 +718,12 @@ class SMSViewController(NSObject):
             if not self.private_key:
                 self.log_debug('Discarding encrypted metadata message %s — no PGP key available' % id)
                 return
-            try:
-                pgpMessage = pgpy.PGPMessage.from_blob(stripped)
-                decrypted_message = self.private_key.decrypt(pgpMessage)
-            except (pgpy.errors.PGPDecryptionError, pgpy.errors.PGPError) as e:
-                self.log_debug('Discarding encrypted metadata message %s — PGP decrypt failed: %s' % (id, str(e)))
+            # usually a cache hit, the live receive path already decrypted
+            # the tick to tell origin from update ticks
+            text_content = PGPDecryptionService().decrypt(self.private_key, stripped)
+            if text_content is None:
+                self.log_debug('Discarding encrypted metadata message %s — PGP decrypt failed' % id)
                 return
-            try:
-                plaintext = bytes(decrypted_message.message, 'latin1')
-            except (TypeError, UnicodeEncodeError):
-                try:
-                    plaintext = bytes(decrypted_message.message, 'utf-8')
-                except (TypeError, UnicodeEncodeError):
-                    self.log_debug('Discarding metadata message %s — cannot encode decrypted body' % id)
-                    return
-            try:
-                text_content = plaintext.decode('utf-8')
-            except UnicodeDecodeError:
-                text_content = plaintext.decode('utf-8', errors='replace')
 
         try:
             timestamp = ISOTimestamp(imdn_timestamp)
@@ -786,9 +763,9 @@ class SMSViewController(NSObject):
                 target_bubble_id, location['lat'], location['lng'], location['accuracy'],
             )
             # Rewrite the origin row's body so a chat reload sees the
-            # latest position. update_message_body is decorated with
-            # @run_in_db_thread so it returns immediately.
-            self.history.update_message_body(target_bubble_id, text_content)
+            # latest position. Ticks arriving in quick succession are
+            # coalesced by the history and only the newest one is written.
+            self.history.queue_message_body_update(target_bubble_id, text_content)
             return
 
         # Origin tick or first-seen update — render a new bubble keyed by
@@ -902,6 +879,17 @@ class SMSViewController(NSObject):
         self.log_info("Public PGP key for %s was updated" % self.remote_uri)
         self.load_remote_public_keys()
 
+    @objc.python_method
+    def _NH_PGPKeyringDidLoad(self, sender, data):
+        self.notification_center.discard_observer(self, name='PGPKeyringDidLoad')
+        if self.public_key is not None:
+            return
+
+        self.load_remote_public_keys()
+        if self.account.sms.private_key and self.public_key and not self.pgp_encrypted:
+            self.pgp_encrypted = True
+            self.notification_center.post_notification('PGPEncryptionStateChanged', sender=self)
+
     @objc.python_method
     def _NH_BlinkContactsHaveChanged(self, sender, data):
         self.bonjour_lookup_enabled = True
@@ -1580,21 +1568,8 @@ class SMSViewController(NSObject):
                 
             zoom_factor = self.chatViewController.scrolling_zoom_factor
             self.log_info('Replay history with zoom factor %s for %s' % (zoom_factor, ", ".join(remote_uris)))
-            after_date = None
 
             if zoom_factor:
-                period_array = {
-                    1: datetime.datetime.now()-datetime.timedelta(days=2),
-                    2: datetime.datetime.now()-datetime.timedelta(days=7),
-                    3: datetime.datetime.now()-datetime.timedelta(days=31),
-                    4: datetime.datetime.now()-datetime.timedelta(days=90),
-                    5: datetime.datetime.now()-datetime.timedelta(days=180),
-                    6: datetime.datetime.now()-datetime.timedelta(days=365),
-                    7: datetime.datetime.now()-datetime.timedelta(days=3650)
-                    }
-
-                #after_date = period_array[zoom_factor].strftime("%Y-%m-%d")
-
                 if zoom_factor == 1:
                     self.zoom_period_label = NSLocalizedString("Displaying messages from last day", "Label")
                 elif zoom_factor == 2:
@@ -1610,80 +1585,57 @@ class SMSViewController(NSObject):
                 elif zoom_factor == 7:
                     self.zoom_period_label = NSLocalizedString("Displaying all messages", "Label")
                     self.chatViewController.setHandleScrolling_(False)
-                
-                results = self.history.get_messages(remote_uri=remote_uris, media_type=('chat', 'sms'), after_date=after_date, before_date=self.oldest_timestamp, count=self.showHistoryEntries, search_text=self.chatViewController.search_text)
-            else:
-                results = self.history.get_messages(remote_uri=remote_uris, media_type=('chat', 'sms'), count=self.showHistoryEntries, search_text=self.chatViewController.search_text, before_date=self.oldest_timestamp)
 
+            results = self.history.iter_messages(remote_uris, ('chat', 'sms'), before=self.oldest_cursor, limit=self.showHistoryEntries, search_text=self.chatViewController.search_text)
             messages = [row for row in reversed(results)]
         except Exception:
             import traceback
             traceback.print_exc()
         else:
-            # Decrypt PGP messages off the GUI thread so the UI stays responsive
-            # while we work through the journal. The render method below only
-            # consumes the pre-decrypted text.
-            decrypted_bodies = self._decrypt_history_messages(messages)
+            # PGP messages are rendered with a placeholder and are decrypted
+            # off the GUI thread, each batch is shown as soon as it is done.
+            # Metadata decides how a message is rendered, so it is decrypted
+            # before rendering.
+            decrypted_bodies = {}
+            metadata = [message for message in messages if message.content_type == 'application/sylk-message-metadata']
+            if metadata:
+                block_on(self._decrypt_history_messages(metadata, decrypted_bodies))
             self.render_history_messages(messages, decrypted_bodies)
+            self._decrypt_history_messages([message for message in messages if message.content_type != 'application/sylk-message-metadata'], decrypted_bodies)
 
     @objc.python_method
-    def _decrypt_history_messages(self, messages):
+    def _decrypt_history_messages(self, messages, decrypted_bodies):
         """Decrypt PGP-encrypted history messages off the GUI thread.
 
-        Returns a dict ``{msgid: (text, encryption_label)}`` for every encrypted
-        message in ``messages``. ``encryption_label`` is ``'verified'`` when the
-        message was successfully decrypted and ``None`` otherwise (in which case
-        ``text`` holds a placeholder so the GUI does not try to decrypt again).
+        The messages are decrypted in parallel by the PGPDecryptionService.
+        Every finished batch is written back to the history right away and
+        is shown in the chat view by show_decrypted_messages, which adds it
+        to decrypted_bodies. Returns a deferred that fires when all messages
+        are done.
         """
-        decrypted_bodies = {}
-        private_key = self.private_key
-
-        for message in messages:
-            body = message.body
-            if not body:
-                continue
-
-            stripped = body.strip()
-            if not (stripped.startswith('-----BEGIN PGP MESSAGE-----') and stripped.endswith('-----END PGP MESSAGE-----')):
-                continue
-
-            if not private_key:
-                decrypted_bodies[message.msgid] = ('Encrypted message for which we have no private key', None)
-                continue
-
-            try:
-                pgpMessage = pgpy.PGPMessage.from_blob(stripped)
-                decrypted_message = private_key.decrypt(pgpMessage)
-            except (pgpy.errors.PGPDecryptionError, pgpy.errors.PGPError):
-                decrypted_bodies[message.msgid] = ('Encrypted message for which we have no private key', None)
-                continue
-
-            try:
-                content_bytes = bytes(decrypted_message.message, 'latin1')
-            except (TypeError, UnicodeEncodeError):
-                try:
-                    content_bytes = bytes(decrypted_message.message, 'utf-8')
-                except (TypeError, UnicodeEncodeError) as e:
-                    self.log_info('Failed to decrypt message %s: %s' % (message.id, str(e)))
-                    continue
+        encrypted_messages = [(message.msgid, message.body) for message in messages if message.body and is_pgp_message(message.body)]
 
-            try:
-                text = content_bytes.decode()
-            except UnicodeDecodeError:
-                try:
-                    text = content_bytes.decode('utf-8', errors='replace')
-                except Exception as e:
-                    self.log_info('Failed to decode message %s: %s' % (message.id, str(e)))
-                    continue
+        def save_decrypted_messages(results):
+            for msgid, text in results.items():
+                if text is not None:
+                    self.history.update_decrypted_message(msgid, text)
+            self.show_decrypted_messages(results, decrypted_bodies)
 
-            decrypted_bodies[message.msgid] = (text, 'verified')
-
-            try:
-                self.history.update_decrypted_message(message.msgid, text)
-            except Exception as e:
-                self.log_error('Failed to persist decrypted message %s: %s' % (message.msgid, str(e)))
+        return PGPDecryptionService().decrypt_messages(self.private_key, encrypted_messages, save_decrypted_messages)
 
-        return decrypted_bodies
+    @objc.python_method
+    @run_in_gui_thread
+    def show_decrypted_messages(self, results, decrypted_bodies):
+        # decrypted_bodies is a dict ``{msgid: (text, encryption_label)}``;
+        # ``encryption_label`` is ``'verified'`` when the message was
+        # successfully decrypted and ``None`` otherwise, in which case
+        # ``text`` holds a placeholder so the GUI does not try to decrypt again
+        for msgid, text in results.items():
+            if text is None:
+                decrypted_bodies[msgid] = ('Encrypted message for which we have no private key', None)
+            else:
+                decrypted_bodies[msgid] = (text, 'verified')
+            self.chatViewController.updateMessageContent(msgid, decrypted_bodies[msgid][0])
 
     @objc.python_method
     @run_in_gui_thread
@@ -1698,12 +1650,10 @@ class SMSViewController(NSObject):
 #        self.log_info('Oldest message timestamp %s' % self.oldest_timestamp)
 
         if len(messages):
-            oldest_timestamp = messages[0].time
-            if self.oldest_timestamp is None:
-                self.oldest_timestamp = oldest_timestamp
-            else:
-                if oldest_timestamp < self.oldest_timestamp:
-                    self.oldest_timestamp = oldest_timestamp
+            # pages arrive oldest first, scroll-back pages were reversed above
+            oldest_message = messages[-1] if before else messages[0]
+            self.oldest_timestamp = oldest_message.time
+            self.oldest_cursor = oldest_message.cursor
 
         self.log_info('Render history started')
         if self.chatViewController.scrolling_zoom_factor:
@@ -1748,6 +1698,26 @@ class SMSViewController(NSObject):
                 elif delta.days <= 3650:
                     self.chatViewController.scrolling_zoom_factor = 7
 
+        # hand the whole page over to the web view in one go
+        if self.chatViewController:
+            self.chatViewController.beginBatchRendering()
+        try:
+            self._render_history_entries(messages, decrypted_bodies, before)
+        finally:
+            if self.chatViewController:
+                self.chatViewController.endBatchRendering()
+
+        self.log_info('Render history completed')
+        self.chatViewController.loadingProgressIndicator.stopAnimation_(None)
+        self.chatViewController.loadingTextIndicator.setStringValue_("")
+
+        if not self.incoming_queue_started:
+            self.incoming_queue.start()
+            #self.log_info('Render queue started')
+            self.incoming_queue_started = True
+ 
+    @objc.python_method
+    def _render_history_entries(self, messages, decrypted_bodies, before):
         call_id = None
         seen_sms = {}
         last_media_type = 'sms'
@@ -1806,11 +1776,12 @@ class SMSViewController(NSObject):
                 encryption = None
                 
                 if message.body.strip().startswith('-----BEGIN PGP MESSAGE-----') and message.body.strip().endswith('-----END PGP MESSAGE-----'):
-                    # Decryption already happened off the GUI thread in
-                    # replay_history -> _decrypt_history_messages.
+                    # Decryption happens off the GUI thread, started by
+                    # replay_history, messages still being decrypted are
+                    # updated by show_decrypted_messages.
                     decrypted = decrypted_bodies.get(message.msgid)
                     if decrypted is None:
-                        content = 'Encrypted message for which we have no private key'
+                        content = 'Decrypting message...'
                     else:
                         content, decrypted_encryption = decrypted
                         if decrypted_encryption:
@@ -1896,15 +1867,6 @@ class SMSViewController(NSObject):
             except Exception as e:
                 print('Render message exception: %s' % str(e))
 
-        self.log_info('Render history completed')
-        self.chatViewController.loadingProgressIndicator.stopAnimation_(None)
-        self.chatViewController.loadingTextIndicator.setStringValue_("")
-
-        if not self.incoming_queue_started:
-            self.incoming_queue.start()
-            #self.log_info('Render queue started')
-            self.incoming_queue_started = True
- 
     @objc.python_method
     def normalizeSender(self, sender):
         if sender == self.remote_uri and self.display_name:
@@ -26,11 +26,8 @@ import uuid
 import pgpy
 from pgpy.constants import PubKeyAlgorithm, KeyFlags, HashAlgorithm, SymmetricKeyAlgorithm, CompressionAlgorithm
 import json
-import socket
 import string
 import random
-import urllib
-from http.client import RemoteDisconnected
 
 from Crypto.Protocol.KDF import PBKDF2
 from binascii import unhexlify, hexlify
@@ -60,11 +57,19 @@ from ChatViewController import MSG_STATE_SENT, MSG_STATE_DELIVERED, MSG_STATE_DI
 
 from BlinkLogger import BlinkLogger
 from HistoryManager import ChatHistory
+from JournalStream import journal_page_url, sync_journal_page, sync_journal_pages
+from PGPDecryptionService import PGPDecryptionService
+from PGPKeyring import PGPKeyring
 from SMSViewController import SMSViewController
 from util import format_identity_to_string, run_in_gui_thread, call_later
 
 unpad = lambda s: s[:-ord(s[len(s) - 1:])]
 
+# message journal sync with SylkServer
+SYNC_PAGE_SIZE = 1000       # journal entries requested at once
+SYNC_COMMIT_SIZE = 100      # applied entries after which history_last_id is saved
+SYNC_READ_SIZE = 65536      # bytes read from the response at once
+
 
 def generate_pgp_keypair(account):
     """Generate a fresh 4096-bit RSA PGP key pair for the account and persist
@@ -521,7 +526,6 @@ class SMSWindowManagerClass(NSObject):
     syncConversationsInProgress = {}
     pendingSaveMessage = {}
     new_contacts = set()
-    private_keys = {}
 
     def init(self):
         self = objc.super(SMSWindowManagerClass, self).init()
@@ -532,6 +536,7 @@ class SMSWindowManagerClass(NSObject):
             self.notification_center.add_observer(self, name="CFGSettingsObjectDidChange")
             self.notification_center.add_observer(self, name="SIPAccountRegistrationDidSucceed")
             self.notification_center.add_observer(self, name="MessageSaved")
+            self.notification_center.add_observer(self, name="MessagesSaved")
             self.keys_path = ApplicationData.get('keys')
             makedirs(self.keys_path)
             self.history = ChatHistory()
@@ -593,6 +598,15 @@ class SMSWindowManagerClass(NSObject):
                 #BlinkLogger().log_info('Sync conversations completed')
             else:
                 BlinkLogger().log_info('%d pending history messages' % remaining_messages)
+
+    @objc.python_method
+    def _NH_MessagesSaved(self, sender, data):
+        # posted once for the messages saved together by add_messages_bulk
+        for msgid in data.msgids:
+            self.pendingSaveMessage.pop(msgid, None)
+
+        if self.pendingSaveMessage:
+            BlinkLogger().log_info('%d pending history messages' % len(self.pendingSaveMessage))
             
     @objc.python_method
     def _NH_SIPAccountRegistrationDidSucceed(self, account, data):
@@ -655,29 +669,14 @@ class SMSWindowManagerClass(NSObject):
         content = payload['data']
         account = payload['account']
         if content.startswith('-----BEGIN PGP MESSAGE-----') and content.endswith('-----END PGP MESSAGE-----'):
-            try:
-                private_key = self.private_keys[account]
-            except KeyError:
-                private_key_path = "%s/%s.privkey" % (self.keys_path, account)
-            
-                try:
-                    private_key, _ = pgpy.PGPKey.from_file(private_key_path)
-                except Exception as e:
-                    BlinkLogger().log_error('Cannot import PGP private key from %s: %s' % (private_key_path, str(e)))
-                    return
-                else:
-                    BlinkLogger().log_info('PGP private key imported from %s' % private_key_path)
-                    self.private_keys[account] = private_key
+            private_key = PGPDecryptionService().private_key("%s/%s.privkey" % (self.keys_path, account))
+            if private_key is None:
+                return
 
-            if private_key:
-                try:
-                    pgpMessage = pgpy.PGPMessage.from_blob(content.strip())
-                    decrypted_message = private_key.decrypt(pgpMessage)
-                except (pgpy.errors.PGPDecryptionError, pgpy.errors.PGPError) as e:
-                    BlinkLogger().log_info('PGP decryption failed for contact update')
-                    return
-                else:
-                    content = bytes(decrypted_message.message, 'latin1').decode()
+            content = PGPDecryptionService().decrypt(private_key, content)
+            if content is None:
+                BlinkLogger().log_info('PGP decryption failed for contact update')
+                return
 
         try:
             contact_data = json.loads(content)
@@ -724,209 +723,184 @@ class SMSWindowManagerClass(NSObject):
        else:
            return
 
+       # messages of the first sync ever are only stored, the value must stay the same for all pages
+       initial_last_id = account.sms.history_last_id
        sync_contacts = set()
-       url = account.sms.history_url.replace("@", "%40")
-       last_id = account.sms.history_last_id
+       result = 'failed'
 
-       if last_id:
-           url = "%s/%s" % (url, last_id)
+       self.contacts_queue.pause()
+       try:
+           result, synced = sync_journal_pages(lambda: self._syncJournalPage(account, initial_last_id, sync_contacts), SYNC_PAGE_SIZE)
+           if synced:
+               self._syncConversationsDone(account, sync_contacts)
+       finally:
+           self.contacts_queue.unpause()
+           if result != 'unauthorized':
+               # otherwise the new token request restarts the sync
+               self.syncConversationsInProgress.pop(account.id, None)
 
-       BlinkLogger().log_info('Sync conversations from %s' % url)
+    @objc.python_method
+    def _syncConversationsDone(self, account, sync_contacts):
+       BlinkLogger().log_info('Sync done till %s' % account.sms.history_last_id)
+       # Only notify when at least one contact actually
+       # produced a renderable message this round. Bursts
+       # that only carry key exchanges, contact updates or
+       # filtered-out metadata advance last_message_id but
+       # leave sync_contacts empty — surfacing "From 0
+       # contacts" in that case is noise, not signal.
+       if sync_contacts:
+           nc_title = NSLocalizedString("Offline messages received", "Label")
+           count = len(sync_contacts)
+           if count == 1:
+               nc_body = NSLocalizedString("From 1 contact", "Label")
+           else:
+               nc_body = NSLocalizedString("From %d contacts" % count, "Label")
+           NSApp.delegate().gui_notify(nc_title, nc_body)
+        
+       for uri in sync_contacts:
+           self.saveContact(uri)
+
+       # Post-sync history refresh — limit it to the viewer the
+       # user is actually looking at right now. The live path
+       # (_presentJournalIncomingMessage -> gotMessage) already
+       # appends new messages to every open viewer as the burst
+       # is processed, so non-focused tabs aren't going to miss
+       # anything — they just don't get a re-render. When the
+       # user clicks a stale tab next, replay_history runs as
+       # part of the existing chat-view-load flow and the panel
+       # catches up.
+       #
+       # Old behaviour (one scroll_back_in_time per contact in
+       # sync_contacts × per viewer) is what stacked thousands
+       # of run_in_gui_thread render calls onto the main thread
+       # at the tail end of a big sync and pushed the app into
+       # a 1–2 minute beachball.
+       for window in self.windows:
+           if not window.window().isVisible():
+               continue
+           focused = window.selectedSessionController()
+           if focused is None or focused.account != account:
+               continue
+           if focused.remote_uri in sync_contacts:
+               BlinkLogger().log_info('Refresh focused viewer for %s' % focused.remote_uri)
+               focused.scroll_back_in_time()
+    
+       self.addContactsToMessagesGroup()
 
-       req = urllib.request.Request(url, method="GET")
-       req.add_header('Authorization', 'Apikey %s' % account.sms.history_token)
+    @objc.python_method
+    def _syncJournalPage(self, account, initial_last_id, sync_contacts):
+        """
+        Download one page of journal entries newer than history_last_id and
+        apply them while the response is being received. history_last_id is
+        saved every SYNC_COMMIT_SIZE entries, so an interrupted sync resumes
+        from the last saved entry. Returns a (result, applied entries) tuple,
+        where result is 'complete', 'failed' or 'unauthorized'.
+        """
+        url = journal_page_url(account.sms.history_url, account.sms.history_last_id, SYNC_PAGE_SIZE)
 
-       try:
-           raw_response = urllib.request.urlopen(req, timeout=20)
-       except (urllib.error.URLError, ConnectionRefusedError) as e:
-           BlinkLogger().log_info('SylkServer connection error for %s: %s' % (url, str(e)))
-           try:
-               code = getattr(e, "code")
-           except AttributeError:
-               pass
-           else:
-               if code == 401:
-                   # request new token on 401
-                   reactor.callLater(30, self.request_token, account)
-               return
-       except (TimeoutError, socket.timeout, RemoteDisconnected, urllib.error.HTTPError) as e:
-           BlinkLogger().log_info('SylkServer connection error for %s: %s' % (url, str(e)))
-           try:
-               del self.syncConversationsInProgress[account.id]
-           except KeyError:
-               pass
-           return
-       else:
-           try:
-               raw_data = raw_response.read().decode().replace('\\/', '/')
-           except Exception as e:
-               BlinkLogger().log_debug('SylkServer API read error for %s: %s' % (url, str(e)))
-               try:
-                   del self.syncConversationsInProgress[account.id]
-               except KeyError:
-                   pass
-               return
+        BlinkLogger().log_info('Sync conversations from %s' % url)
 
-           try:
-               json_data = json.loads(raw_data)
-           except (TypeError, json.decoder.JSONDecodeError):
-               BlinkLogger().log_debug('Error parsing SylkServer response: %s' % str(e))
-               return
+        public_keys = []
 
-           else:
-               last_message_id = None
-               BlinkLogger().log_debug('Sync %d message journal entries for %s (%d bytes)' % (len(json_data['messages']), account.id, len(raw_data)))
-
-               i = 0
-               self.contacts_queue.pause()
-               for msg in json_data['messages']:
-                   #BlinkLogger().log_info('Process journal %d: %s' % (i, msg['timestamp']))
-                   i = i + 1
-                   try:
-                       content_type = msg['content_type']
-                       last_message_id = msg['message_id']
-
-                       if content_type == 'application/sylk-conversation-remove':
-                           BlinkLogger().log_info('Remove conversation with %s' % msg['content'])
-                           self.history.delete_messages(local_uri=str(account.id), remote_uri=msg['content'])
-                           self.history.delete_messages(local_uri=msg['content'], remote_uri=str(account.id))
-                       elif content_type == 'application/sylk-message-remove':
-                           BlinkLogger().log_info('Remove message %s with %s' % (msg['message_id'], msg['contact']))
-                           self.history.delete_message(msg['message_id']);
-                       elif content_type == 'message/imdn':
-                           payload = eval(msg['content'])
-                           imdn_status = payload['state']
-                           imdn_message_id = payload['message_id']
-                           status = None
-                           if imdn_status == 'delivered':
-                               status = MSG_STATE_DELIVERED
-                           elif imdn_status == 'displayed':
-                               status = MSG_STATE_DISPLAYED
-                           elif imdn_status == 'failed':
-                               status = MSG_STATE_FAILED
-                               
-                           if status:
-                               #BlinkLogger().log_info('Sync IMDN state %s for message %s' % (status, imdn_message_id))
-                               self.pendingSaveMessage[imdn_message_id] = True
-                               self.history.update_message_status(imdn_message_id, status)
-                       elif content_type == 'application/sylk-contact-update':
-                           self.contacts_queue.put({'account': str(account.id), 'data': msg['content']})
-                       elif content_type == 'text/pgp-public-key':
-                           uri = msg['contact']
-                           BlinkLogger().log_info(u"Public key from %s received" % (uri))
-                           content = msg['content'].encode()
-
-                           if AccountManager().has_account(uri):
-                               BlinkLogger().log_debug(u"Public key save skipped for own accounts")
-                               continue
-
-                           public_key = ''
-                           start_public = False
-
-                           for l in content.decode().split("\n"):
-                               if l == "-----BEGIN PGP PUBLIC KEY BLOCK-----":
-                                   start_public = True
-
-                               if l == "-----END PGP PUBLIC KEY BLOCK-----":
-                                   public_key = public_key + l + '\n'
-                                   start_public = False
-                                   break
-
-                               if start_public:
-                                   public_key = public_key + l + '\n'
-                           
-                           if public_key:
-                               public_key_checksum = hashlib.sha1(public_key.encode()).hexdigest()
-                               key_file = "%s/%s.pubkey" % (self.keys_path, uri)
-                               fd = open(key_file, "wb+")
-                               fd.write(public_key.encode())
-                               fd.close()
-                               #BlinkLogger().log_info(u"Public key for %s was saved to %s" % (uri, key_file))
-                               nc_title = NSLocalizedString("Public key", "System notification title")
-                               nc_subtitle = format_identity_to_string(sender_identity, check_contact=True, format='full')
-                               nc_body = NSLocalizedString("Public key received", "System notification title")
-                               #NSApp.delegate().gui_notify(nc_title, nc_body, nc_subtitle)
-                               self.notification_center.post_notification('PGPPublicKeyReceived', sender=account, data=NotificationData(uri=uri, key=public_key))
-
-                               self.saveContact(uri, {'public_key': key_file, 'public_key_checksum': public_key_checksum})
-                           else:
-                                BlinkLogger().log_info(u"No public key detected in the payload")
-
-                       elif content_type.startswith('text/') or content_type == 'application/sylk-message-metadata':
-                           # application/sylk-message-metadata is the wire format
-                           # Sylk Mobile uses for live-location ticks (action='location')
-                           # and other rich metadata. Treat it like a regular text
-                           # message at the persistence layer; the renderer
-                           # branches on content_type to draw a location bubble.
-                           if msg['direction'] == 'incoming':
-                               sync_contacts.add(msg['contact'])
-                               self.syncIncomingMessage(account, msg, account.sms.history_last_id)
-                           elif msg['direction'] == 'outgoing':
-                               sync_contacts.add(msg['contact'])
-                               self.syncOutgoingMessage(account, msg, account.sms.history_last_id)
-                       else:
-                           pass
-                           #BlinkLogger().log_error("Unknown sync message type %s" % content_type)
-                           
-                   except Exception as e:
-                       BlinkLogger().log_error('Failed to sync message %s' % msg)
-                       import traceback
-                       traceback.print_exc()
-
-               try:
-                   del self.syncConversationsInProgress[account.id]
-               except KeyError:
-                   pass
-
-               if last_message_id:
-                   account.sms.history_last_id = last_message_id
-                   BlinkLogger().log_info('Sync done till %s' % last_message_id)
-                   # Only notify when at least one contact actually
-                   # produced a renderable message this round. Bursts
-                   # that only carry key exchanges, contact updates or
-                   # filtered-out metadata advance last_message_id but
-                   # leave sync_contacts empty — surfacing "From 0
-                   # contacts" in that case is noise, not signal.
-                   if sync_contacts:
-                       nc_title = NSLocalizedString("Offline messages received", "Label")
-                       count = len(sync_contacts)
-                       if count == 1:
-                           nc_body = NSLocalizedString("From 1 contact", "Label")
-                       else:
-                           nc_body = NSLocalizedString("From %d contacts" % count, "Label")
-                       NSApp.delegate().gui_notify(nc_title, nc_body)
-                   account.save()
+        def apply(msg):
+            return self._syncJournalMessage(account, msg, initial_last_id, sync_contacts, public_keys)
+
+        def commit(last_message_id):
+            self._storePublicKeys(account, public_keys)
+            del public_keys[:]
+            if last_message_id and last_message_id != account.sms.history_last_id:
+                account.sms.history_last_id = last_message_id
+                account.save()
+
+        page = sync_journal_page(url, {'Authorization': 'Apikey %s' % account.sms.history_token}, apply, commit, SYNC_COMMIT_SIZE, SYNC_READ_SIZE)
+
+        if page.error is not None:
+            BlinkLogger().log_info('SylkServer error for %s: %s' % (url, str(page.error)))
+        if page.result == 'unauthorized':
+            # request new token on 401
+            reactor.callLater(30, self.request_token, account)
+
+        BlinkLogger().log_debug('Synced %d message journal entries for %s (%d bytes)' % (page.applied, account.id, page.bytes_received))
+
+        return page.result, page.applied
+
+    @objc.python_method
+    def _syncJournalMessage(self, account, msg, last_id, sync_contacts, public_keys):
+        """Apply one journal entry, returns its message id. Public keys are appended to public_keys"""
+        try:
+            content_type = msg['content_type']
+            last_message_id = msg['message_id']
+            if isinstance(msg['content'], str):
+                msg['content'] = msg['content'].replace('\\/', '/')
+
+            if content_type == 'application/sylk-conversation-remove':
+                BlinkLogger().log_info('Remove conversation with %s' % msg['content'])
+                self.history.delete_messages(local_uri=str(account.id), remote_uri=msg['content'])
+                self.history.delete_messages(local_uri=msg['content'], remote_uri=str(account.id))
+            elif content_type == 'application/sylk-message-remove':
+                BlinkLogger().log_info('Remove message %s with %s' % (msg['message_id'], msg['contact']))
+                self.history.delete_message(msg['message_id']);
+            elif content_type == 'message/imdn':
+                payload = eval(msg['content'])
+                imdn_status = payload['state']
+                imdn_message_id = payload['message_id']
+                status = None
+                if imdn_status == 'delivered':
+                    status = MSG_STATE_DELIVERED
+                elif imdn_status == 'displayed':
+                    status = MSG_STATE_DISPLAYED
+                elif imdn_status == 'failed':
+                    status = MSG_STATE_FAILED
+                    
+                if status:
+                    #BlinkLogger().log_info('Sync IMDN state %s for message %s' % (status, imdn_message_id))
+                    self.pendingSaveMessage[imdn_message_id] = True
+                    self.history.update_message_status(imdn_message_id, status)
+            elif content_type == 'application/sylk-contact-update':
+                self.contacts_queue.put({'account': str(account.id), 'data': msg['content']})
+            elif content_type == 'text/pgp-public-key':
+                uri = msg['contact']
+                BlinkLogger().log_info(u"Public key from %s received" % (uri))
+
+                if AccountManager().has_account(uri):
+                    BlinkLogger().log_debug(u"Public key save skipped for own accounts")
+                    return last_message_id
+
+                # stored in bulk by _syncJournalPage
+                public_keys.append((uri, msg['content']))
+
+            elif content_type.startswith('text/') or content_type == 'application/sylk-message-metadata':
+                # application/sylk-message-metadata is the wire format
+                # Sylk Mobile uses for live-location ticks (action='location')
+                # and other rich metadata. Treat it like a regular text
+                # message at the persistence layer; the renderer
+                # branches on content_type to draw a location bubble.
+                if msg['direction'] == 'incoming':
+                    sync_contacts.add(msg['contact'])
+                    self.syncIncomingMessage(account, msg, last_id)
+                elif msg['direction'] == 'outgoing':
+                    sync_contacts.add(msg['contact'])
+                    self.syncOutgoingMessage(account, msg, last_id)
+            else:
+                pass
+                #BlinkLogger().log_error("Unknown sync message type %s" % content_type)
                 
-               for uri in sync_contacts:
-                   self.saveContact(uri)
-
-               # Post-sync history refresh — limit it to the viewer the
-               # user is actually looking at right now. The live path
-               # (_presentJournalIncomingMessage -> gotMessage) already
-               # appends new messages to every open viewer as the burst
-               # is processed, so non-focused tabs aren't going to miss
-               # anything — they just don't get a re-render. When the
-               # user clicks a stale tab next, replay_history runs as
-               # part of the existing chat-view-load flow and the panel
-               # catches up.
-               #
-               # Old behaviour (one scroll_back_in_time per contact in
-               # sync_contacts × per viewer) is what stacked thousands
-               # of run_in_gui_thread render calls onto the main thread
-               # at the tail end of a big sync and pushed the app into
-               # a 1–2 minute beachball.
-               for window in self.windows:
-                   if not window.window().isVisible():
-                       continue
-                   focused = window.selectedSessionController()
-                   if focused is None or focused.account != account:
-                       continue
-                   if focused.remote_uri in sync_contacts:
-                       BlinkLogger().log_info('Refresh focused viewer for %s' % focused.remote_uri)
-                       focused.scroll_back_in_time()
-            
-               self.addContactsToMessagesGroup()
-               self.contacts_queue.unpause()
+        except Exception as e:
+            BlinkLogger().log_error('Failed to sync message %s' % msg)
+            import traceback
+            traceback.print_exc()
+            return msg.get('message_id') if isinstance(msg, dict) else None
+
+        return last_message_id
+
+    @objc.python_method
+    def _storePublicKeys(self, account, keys):
+        if not keys:
+            return
+        for uri, public_key, public_key_checksum in PGPKeyring().add_keys(keys):
+            self.notification_center.post_notification('PGPPublicKeyReceived', sender=account, data=NotificationData(uri=uri, key=public_key))
+            # the key is kept in the keyring, a key file path left on the contact would be stale
+            self.saveContact(uri, {'public_key': None, 'public_key_checksum': public_key_checksum})
 
     @objc.python_method
     def saveContact(self, uri, data={}):
@@ -1192,42 +1166,13 @@ class SMSWindowManagerClass(NSObject):
         """Decrypt a PGP-armoured body using the account's private key.
 
         Returns the decoded plaintext on success, ``None`` if there is
-        no key or decryption fails. Reuses the per-account ``private_keys``
-        cache that handle_contacts_queue already populates so we don't
-        re-read the key file on every journal entry.
+        no key or decryption fails. The key and the plaintext are cached
+        by PGPDecryptionService, so a journal entry that is inspected by
+        several code paths is only decrypted once.
         """
-        try:
-            private_key = self.private_keys[account_id]
-        except KeyError:
-            private_key_path = "%s/%s.privkey" % (self.keys_path, account_id)
-            try:
-                private_key, _ = pgpy.PGPKey.from_file(private_key_path)
-            except Exception as e:
-                BlinkLogger().log_error('Cannot import PGP private key from %s: %s' % (private_key_path, str(e)))
-                self.private_keys[account_id] = None
-                return None
-            self.private_keys[account_id] = private_key
-
-        if not private_key:
-            return None
-
-        try:
-            pgpMessage = pgpy.PGPMessage.from_blob(body.strip())
-            decrypted_message = private_key.decrypt(pgpMessage)
-        except (pgpy.errors.PGPDecryptionError, pgpy.errors.PGPError):
-            return None
-
-        try:
-            plaintext = bytes(decrypted_message.message, 'latin1')
-        except (TypeError, UnicodeEncodeError):
-            try:
-                plaintext = bytes(decrypted_message.message, 'utf-8')
-            except (TypeError, UnicodeEncodeError):
-                return None
-        try:
-            return plaintext.decode('utf-8')
-        except UnicodeDecodeError:
-            return plaintext.decode('utf-8', errors='replace')
+        service = PGPDecryptionService()
+        private_key = service.private_key("%s/%s.privkey" % (self.keys_path, account_id))
+        return service.decrypt(private_key, body)
 
     @objc.python_method
     def _decode_location_metadata(self, account_id, body):
@@ -1360,8 +1305,10 @@ class SMSWindowManagerClass(NSObject):
                 bubble_id = data['messageId']
                 if data.get('metadataId') is not None:
                     # Update tick — refresh the existing row's body so a
-                    # later replay shows the most recent position.
-                    self.history.update_message_body(bubble_id, body)
+                    # later replay shows the most recent position. A sync
+                    # batch holds many ticks of the same share, they are
+                    # coalesced and only the newest one is written.
+                    self.history.queue_message_body_update(bubble_id, body)
                     return
                 # Origin tick — persist under the bubble id so subsequent
                 # update ticks (live or journaled) all rewrite this row.
@@ -1756,37 +1703,7 @@ class SMSWindowManagerClass(NSObject):
                     BlinkLogger().log_info(u"Public key save skipped for accounts that have private keys")
                     return
 
-            public_key = ''
-            start_public = False
-
-            for l in content.decode().split("\n"):
-                if l == "-----BEGIN PGP PUBLIC KEY BLOCK-----":
-                    start_public = True
-
-                if l == "-----END PGP PUBLIC KEY BLOCK-----":
-                    public_key = public_key + l + '\n'
-                    start_public = False
-                    break
-
-                if start_public:
-                    public_key = public_key + l + '\n'
-            
-            if public_key:
-                public_key_checksum = hashlib.sha1(public_key.encode()).hexdigest()
-                key_file = "%s/%s.pubkey" % (self.keys_path, uri)
-                fd = open(key_file, "wb+")
-                fd.write(public_key.encode())
-                fd.close()
-                nc_title = NSLocalizedString("Public key", "System notification title")
-                nc_subtitle = format_identity_to_string(sender_identity, check_contact=True, format='full')
-                nc_body = NSLocalizedString("Public key received", "System notification title")
-                #NSApp.delegate().gui_notify(nc_title, nc_body, nc_subtitle)
-                self.notification_center.post_notification('PGPPublicKeyReceived', sender=account, data=NotificationData(uri=uri, key=public_key))
-                
-                self.saveContact(uri, {'public_key': key_file, 'public_key_checksum': public_key_checksum})
-                #BlinkLogger().log_info(u"Public key for %s saved to %s" % (uri, key_file))
-            else:
-                 BlinkLogger().log_info(u"No public PGP key detected in the payload")
+            self._storePublicKeys(account, [(uri, content)])
             return
 
         elif content_type == 'application/sylk-contact-update':
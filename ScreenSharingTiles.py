@@ -0,0 +1,236 @@
+# Copyright (C) 2025 AG Projects. See LICENSE for details.
+#
+
+from AppKit import (NSBitmapImageRep,
+                    NSDeviceRGBColorSpace,
+                    NSGraphicsContext,
+                    NSImage,
+                    NSImageCompressionFactor,
+                    NSJPEGFileType)
+from Foundation import NSData, NSMakeRect, NSMakeSize
+from Quartz import (CGDataProviderCopyData,
+                    CGImageCreateWithImageInRect,
+                    CGImageGetBitsPerPixel,
+                    CGImageGetBytesPerRow,
+                    CGImageGetDataProvider,
+                    CGImageGetHeight,
+                    CGImageGetWidth,
+                    CGRectMake)
+
+import base64
+import hashlib
+import json
+
+
+__all__ = ['FULL_FRAME_CONTENT_TYPE', 'TILES_CONTENT_TYPE', 'ScreenSharingEncoder', 'ScreenSharingCompositor', 'ScreenSharingRateController']
+
+
+FULL_FRAME_CONTENT_TYPE = 'application/blink-screensharing'
+TILES_CONTENT_TYPE = 'application/blink-screensharing-tiles'
+
+TILE_SIZE = 64
+
+
+def encode_jpeg(bitmap, compression):
+    jpg_data = bitmap.representationUsingType_properties_(NSJPEGFileType, {NSImageCompressionFactor: compression})
+    return base64.b64encode(jpg_data.bytes().tobytes()).decode()
+
+
+class ScreenSharingEncoder(object):
+    """
+    Encodes screen captures either as full JPEG frames or, for peers that
+    accept TILES_CONTENT_TYPE, as the rectangles of tiles that changed since
+    the previous frame. Full frames are sent as key frames, periodically and
+    whenever a delta would not be smaller than a full frame.
+    """
+
+    keyframe_interval = 30    # frames sent between two key frames
+    max_changed_ratio = 0.5   # above this fraction of changed tiles a key frame is sent instead
+
+    def __init__(self, tile_size=TILE_SIZE):
+        self.tile_size = tile_size
+        self.reset()
+
+    def reset(self):
+        self.size = None
+        self.hashes = None
+        self.frames_since_keyframe = 0
+        self.keyframe_requested = False
+
+    def request_keyframe(self):
+        # may be called from another thread than the one encoding, the flag is consumed by the next encode
+        self.keyframe_requested = True
+
+    def encode(self, image, compression, delta=False):
+        """Return a (content_type, data) tuple for the image or None if nothing changed since the last frame"""
+        bitmap = NSBitmapImageRep.alloc().initWithData_(image.TIFFRepresentation())
+        if not delta:
+            self.reset()
+            return FULL_FRAME_CONTENT_TYPE, encode_jpeg(bitmap, compression)
+
+        keyframe_requested, self.keyframe_requested = self.keyframe_requested, False
+        cgimage = bitmap.CGImage()
+        size = (CGImageGetWidth(cgimage), CGImageGetHeight(cgimage))
+        hashes = self._tile_hashes(cgimage)
+
+        if not keyframe_requested and self.hashes is not None and self.size == size and self.frames_since_keyframe < self.keyframe_interval:
+            changed = set(tile for tile, digest in hashes.items() if self.hashes.get(tile) != digest)
+            if not changed:
+                return None
+            if len(changed) <= len(hashes) * self.max_changed_ratio:
+                self.hashes = hashes
+                self.frames_since_keyframe += 1
+                tiles = []
+                for x, y, width, height in self._changed_regions(changed, *size):
+                    region = NSBitmapImageRep.alloc().initWithCGImage_(CGImageCreateWithImageInRect(cgimage, CGRectMake(x, y, width, height)))
+                    tiles.append({'x': x, 'y': y, 'width': width, 'height': height, 'data': encode_jpeg(region, compression)})
+                return TILES_CONTENT_TYPE, json.dumps({'width': size[0], 'height': size[1], 'tiles': tiles})
+
+        self.size = size
+        self.hashes = hashes
+        self.frames_since_keyframe = 0
+        return FULL_FRAME_CONTENT_TYPE, encode_jpeg(bitmap, compression)
+
+    def _tile_hashes(self, cgimage):
+        width = CGImageGetWidth(cgimage)
+        height = CGImageGetHeight(cgimage)
+        bytes_per_row = CGImageGetBytesPerRow(cgimage)
+        bytes_per_pixel = CGImageGetBitsPerPixel(cgimage) // 8
+        pixels = CGDataProviderCopyData(CGImageGetDataProvider(cgimage)).bytes()
+
+        columns = [(left, min(left + self.tile_size, width)) for left in range(0, width, self.tile_size)]
+        hashes = {}
+        for top in range(0, height, self.tile_size):
+            digests = [hashlib.sha1() for column in columns]
+            for row in range(top, min(top + self.tile_size, height)):
+                offset = row * bytes_per_row
+                for digest, (left, right) in zip(digests, columns):
+                    digest.update(pixels[offset + left * bytes_per_pixel:offset + right * bytes_per_pixel])
+            for digest, (left, right) in zip(digests, columns):
+                hashes[(left, top)] = digest.digest()
+        return hashes
+
+    def _changed_regions(self, changed, width, height):
+        # join changed tiles into horizontal runs, then stack runs spanning the same columns in consecutive rows
+        regions = []
+        open_regions = {}
+        for top in range(0, height, self.tile_size):
+            runs = []
+            for left in range(0, width, self.tile_size):
+                if (left, top) not in changed:
+                    continue
+                if runs and runs[-1][1] == left:
+                    runs[-1][1] = left + self.tile_size
+                else:
+                    runs.append([left, left + self.tile_size])
+            next_open_regions = {}
+            for left, right in runs:
+                region = open_regions.get((left, right))
+                if region is None:
+                    region = [left, top, right, top]
+                    regions.append(region)
+                region[3] = top + self.tile_size
+                next_open_regions[(left, right)] = region
+            open_regions = next_open_regions
+        return [(left, top, min(right, width) - left, min(bottom, height) - top) for left, top, right, bottom in regions]
+
+
+class ScreenSharingCompositor(object):
+    """
+    Rebuilds the remote screen from key frames and tile updates. Tile updates
+    received before a key frame, or for a different screen size, are ignored
+    until the next key frame arrives.
+    """
+
+    def __init__(self):
+        self.canvas = None
+
+    @property
+    def image(self):
+        if self.canvas is None:
+            return None
+        canvas = self.canvas.copy()
+        image = NSImage.alloc().initWithSize_(NSMakeSize(canvas.pixelsWide(), canvas.pixelsHigh()))
+        image.addRepresentation_(canvas)
+        return image
+
+    def add_keyframe(self, content):
+        bitmap = self._decode(content)
+        if bitmap is None:
+            return None
+        width, height = bitmap.pixelsWide(), bitmap.pixelsHigh()
+        self.canvas = NSBitmapImageRep.alloc().initWithBitmapDataPlanes_pixelsWide_pixelsHigh_bitsPerSample_samplesPerPixel_hasAlpha_isPlanar_colorSpaceName_bytesPerRow_bitsPerPixel_(None, width, height, 8, 4, True, False, NSDeviceRGBColorSpace, 0, 0)
+        self._draw([(bitmap, 0, 0, width, height)])
+        return self.image
+
+    def add_tiles(self, content):
+        payload = json.loads(content)
+        if self.canvas is None or (payload['width'], payload['height']) != (self.canvas.pixelsWide(), self.canvas.pixelsHigh()):
+            return None
+        tiles = []
+        for tile in payload['tiles']:
+            bitmap = self._decode(tile['data'])
+            if bitmap is not None:
+                tiles.append((bitmap, tile['x'], tile['y'], tile['width'], tile['height']))
+        self._draw(tiles)
+        return self.image
+
+    def _decode(self, content):
+        data = base64.b64decode(content.encode())
+        return NSBitmapImageRep.alloc().initWithData_(NSData.dataWithBytes_length_(data, len(data)))
+
+    def _draw(self, tiles):
+        # tile coordinates have their origin in the top left corner, the bitmap context in the bottom left one
+        height = self.canvas.pixelsHigh()
+        NSGraphicsContext.saveGraphicsState()
+        NSGraphicsContext.setCurrentContext_(NSGraphicsContext.graphicsContextWithBitmapImageRep_(self.canvas))
+        for bitmap, x, y, tile_width, tile_height in tiles:
+            bitmap.drawInRect_(NSMakeRect(x, height - y - tile_height, tile_width, tile_height))
+        NSGraphicsContext.restoreGraphicsState()
+
+
+class ScreenSharingRateController(object):
+    """
+    Adapts the frame rate and JPEG compression used for screen sharing to the
+    delivery latency of the frames. Both are reduced as soon as frames take
+    longer to be delivered than the frame interval and are raised back step
+    by step, up to the configured quality, while deliveries keep up.
+    """
+
+    smoothing = 0.3            # weight of the latest latency sample
+    recovery_deliveries = 5    # consecutive fast deliveries needed before raising the quality
+    min_compression = 0.2
+    min_framerate = 0.2
+
+    def __init__(self, compression, framerate):
+        self.max_compression = compression
+        self.max_framerate = framerate
+        self.compression = compression
+        self.framerate = framerate
+        self.latency = None
+        self.fast_deliveries = 0
+
+    def delivered(self, latency):
+        """Record the latency of a delivered frame, returns True if the quality changed"""
+        self.latency = latency if self.latency is None else self.smoothing * latency + (1 - self.smoothing) * self.latency
+        interval = 1.0 / self.framerate
+        if self.latency > interval:
+            self.fast_deliveries = 0
+            return self._update(max(self.min_compression, round(self.compression * 0.8, 2)), max(self.min_framerate, self.framerate / 2))
+        if self.latency < interval / 2:
+            self.fast_deliveries += 1
+            if self.fast_deliveries >= self.recovery_deliveries:
+                self.fast_deliveries = 0
+                return self._update(min(self.max_compression, round(self.compression + 0.05, 2)), min(self.max_framerate, self.framerate * 1.5))
+        return False
+
+    def failed(self):
+        """Record a frame that could not be delivered, returns True if the quality changed"""
+        self.fast_deliveries = 0
+        return self._update(max(self.min_compression, round(self.compression * 0.8, 2)), max(self.min_framerate, self.framerate / 2))
+
+    def _update(self, compression, framerate):
+        changed = (compression, framerate) != (self.compression, self.framerate)
+        self.compression = compression
+        self.framerate = framerate
+        return changed
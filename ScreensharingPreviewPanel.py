@@ -2,7 +2,7 @@
 #
 
 from AppKit import NSDefaultRunLoopMode, NSModalPanelRunLoopMode
-from Foundation import NSBundle, NSObject, NSRunLoop, NSTimer
+from Foundation import NSBundle, NSDate, NSObject, NSRunLoop, NSTimer
 import objc
 
 
@@ -11,20 +11,43 @@ class ScreensharingPreviewPanel(NSObject):
     window = objc.IBOutlet()
     view = objc.IBOutlet()
 
+    closed_by_user = False
+    expired = False
+
     def __new__(cls, *args, **kwargs):
         return cls.alloc().init()
 
     def __init__(self, image):
         NSBundle.loadNibNamed_owner_("ScreensharingPreviewPanel", self)
+        # updateImage_ shows the panel again after the timer closed it
+        self.window.setReleasedWhenClosed_(False)
         self.view.setImage_(image)
+        self.startTimer()
+        self.window.orderFront_(None)
+
+    def startTimer(self):
         self.timer = NSTimer.timerWithTimeInterval_target_selector_userInfo_repeats_(5.0, self, "closeTimer:", None, False)
         NSRunLoop.currentRunLoop().addTimer_forMode_(self.timer, NSModalPanelRunLoopMode)
         NSRunLoop.currentRunLoop().addTimer_forMode_(self.timer, NSDefaultRunLoopMode)
-        self.window.orderFront_(None)
+
+    def updateImage_(self, image):
+        if self.closed_by_user:
+            return
+        self.view.setImage_(image)
+        if self.window.isVisible():
+            self.timer.setFireDate_(NSDate.dateWithTimeIntervalSinceNow_(5.0))
+        else:
+            self.expired = False
+            self.startTimer()
+            self.window.orderFront_(None)
 
     def closeTimer_(self, timer):
+        self.expired = True
         self.window.performClose_(None)
 
+    def windowWillClose_(self, notification):
+        self.closed_by_user = not self.expired
+
     def windowShouldClose_(self, sender):
         self.timer.invalidate()
         return True
@@ -72,8 +72,9 @@ from ChatController import ChatController, BlinkChatStream
 from ScreenSharingController import ScreenSharingController, ScreenSharingServerController, ScreenSharingViewerController
 from FileTransferController import FileTransferController
 from FileTransferSession import OutgoingPushFileTransferHandler
-from HistoryManager import ChatHistory, SessionHistory
+from HistoryManager import ChatHistory, SessionHistory, RecordingHistory
 from HistoryManager import SessionHistoryReplicator, ChatHistoryReplicator
+from PGPKeyring import PGPKeyring
 from MediaStream import STATE_IDLE, STATE_CONNECTED, STATE_CONNECTING, STATE_DNS_LOOKUP, STATE_DNS_FAILED, STATE_FINISHED, STATE_FAILED
 from MediaStream import STREAM_IDLE, STREAM_FAILED, STREAM_CONNECTED, STREAM_CANCELLING
 from SessionRinger import Ringer
@@ -681,6 +682,8 @@ class SessionControllersManager(object, metaclass=Singleton):
         self.ringer = Ringer(self)
         self.get_redial_uri_from_history()
         ChatHistoryReplicator()
+        RecordingHistory()
+        PGPKeyring()
 
     def _NH_BlinkShouldTerminate(self, sender, data):
         self.closeAllSessions()
@@ -1,7 +1,7 @@
 # Copyright (C) 2009-2011 AG Projects. See LICENSE for details.
 #
 
-from AppKit import NSDefaultRunLoopMode, NSForegroundColorAttributeName, NSModalPanelRunLoopMode
+from AppKit import NSForegroundColorAttributeName
 
 from Foundation import (NSAttributedString,
                         NSBezierPath,
@@ -15,8 +15,6 @@ from Foundation import (NSAttributedString,
                         NSLocalizedString,
                         NSObject,
                         NSRect,
-                        NSRunLoop,
-                        NSTimer,
                         NSView)
 
 
@@ -33,6 +31,7 @@ from zope.interface import implementer
 from sipsimple.util import ISOTimestamp
 
 from MediaStream import STREAM_CONNECTED
+from StatisticsScheduler import StatisticsScheduler
 from util import beautify_audio_codec, beautify_video_codec, run_in_gui_thread, format_size
 
 
@@ -108,9 +107,7 @@ class SessionInfoController(NSObject):
         self.add_video_stream()
         self.add_chat_stream()
 
-        self.timer = NSTimer.timerWithTimeInterval_target_selector_userInfo_repeats_(1.0, self, "updateTimer:", None, True)
-        NSRunLoop.currentRunLoop().addTimer_forMode_(self.timer, NSModalPanelRunLoopMode)
-        NSRunLoop.currentRunLoop().addTimer_forMode_(self.timer, NSDefaultRunLoopMode)
+        StatisticsScheduler().add_observer(self)
         NSBundle.loadNibNamed_owner_("SessionInfoPanel", self)
 
         sessionBoxTitle = NSAttributedString.alloc().initWithString_attributes_(NSLocalizedString("SIP Session", "Label"), NSDictionary.dictionaryWithObject_forKey_(NSColor.orangeColor(), NSForegroundColorAttributeName))
@@ -486,8 +483,9 @@ class SessionInfoController(NSObject):
             if self.chat_stream and self.chat_stream.stream:
                 self.chat_connection_mode.setStringValue_(self.chat_stream.stream.local_role.title())
 
-    def updateTimer_(self, timer):
-        if self.sessionController is not None:
+    @objc.python_method
+    def _NH_BlinkStreamStatisticsDidUpdate(self, notification):
+        if self.sessionController is not None and self.window.isVisible():
             self.updateDuration()
             self.updateAudio()
             self.updateVideo()
@@ -718,6 +716,8 @@ class SessionInfoController(NSObject):
     @objc.python_method
     def show(self):
         self.window.orderFront_(None)
+        # values are not refreshed while the panel is hidden
+        self._NH_BlinkStreamStatisticsDidUpdate(None)
 
     @objc.python_method
     def hide(self):
@@ -741,9 +741,7 @@ class SessionInfoController(NSObject):
 
     @objc.python_method
     def stopTimer(self):
-        if self.timer:
-            self.timer.invalidate()
-            self.timer = None
+        StatisticsScheduler().remove_observer(self)
 
     def dealloc(self):
         self.audio_packet_loss_rx_graph.removeFromSuperview()
@@ -4,6 +4,7 @@
 from Foundation import NSBundle
 
 import os
+import re
 
 from application.python.types import Singleton
 from util import escape_html
@@ -17,6 +18,7 @@ class SmileyManager(object, metaclass=Singleton):
         self.icon = None
         self.smileys = {}
         self.smileys_html = {}
+        self.smileys_pattern = None
         self.smiley_keys = []
         self.load_theme(str(NSBundle.mainBundle().resourcePath())+"/smileys" , "default")
 
@@ -73,6 +75,13 @@ class SmileyManager(object, metaclass=Singleton):
             ek = escape_html(k)
             self.smileys_html[ek] = "<img src='file:%s' class='smiley' />"%(self.get_smiley(k))
 
+        # longest smileys first so that the alternation prefers them over their prefixes
+        if self.smileys_html:
+            keys = sorted(self.smileys_html, key=len, reverse=True)
+            self.smileys_pattern = re.compile("|".join(re.escape(k) for k in keys))
+        else:
+            self.smileys_pattern = None
+
     def get_smiley(self, text):
         if text in self.smileys:
             return os.path.join(self.smiley_directory, self.theme, self.smileys[text])
@@ -80,11 +89,9 @@ class SmileyManager(object, metaclass=Singleton):
 
 
     def subst_smileys_html(self, text):
-        items = list(self.smileys_html.items())
-        sorted(items, key=lambda x: x[0], reverse=True)
-        for k, v in items:
-            text = text.replace(k, v)
-        return text
+        if self.smileys_pattern is None:
+            return text
+        return self.smileys_pattern.sub(lambda match: self.smileys_html[match.group(0)], text)
 
 
     def get_smiley_list(self):
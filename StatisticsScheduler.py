@@ -0,0 +1,67 @@
+# Copyright (C) 2025 AG Projects. See LICENSE for details.
+#
+
+from AppKit import NSEventTrackingRunLoopMode
+from Foundation import NSRunLoop, NSRunLoopCommonModes, NSTimer
+
+import time
+
+from application.notification import NotificationCenter, NotificationData
+from application.python.types import Singleton
+
+from BlinkLogger import BlinkLogger
+
+
+__all__ = ['STATISTICS_INTERVAL', 'StatisticsScheduler']
+
+
+STATISTICS_INTERVAL = 1.0
+
+
+class StatisticsScheduler(object, metaclass=Singleton):
+    """
+    Drives all per stream statistics from a single timer. On every tick the
+    statistics of the registered streams are sampled in one pass, after which
+    a single BlinkStreamStatisticsDidUpdate notification is posted to all
+    observers. The timer only runs while there are observers.
+    """
+
+    def __init__(self):
+        self.timer = None
+        self.streams = []
+        self.observers = set()
+        self.notification_center = NotificationCenter()
+
+    def add_observer(self, observer, sample_statistics=False):
+        if sample_statistics and observer not in self.streams:
+            self.streams.append(observer)
+        if observer not in self.observers:
+            self.observers.add(observer)
+            self.notification_center.add_observer(observer, sender=self, name='BlinkStreamStatisticsDidUpdate')
+
+        if self.timer is None:
+            self.timer = NSTimer.timerWithTimeInterval_target_selector_userInfo_repeats_(STATISTICS_INTERVAL, self, "updateTimer:", None, True)
+            NSRunLoop.currentRunLoop().addTimer_forMode_(self.timer, NSRunLoopCommonModes)
+            NSRunLoop.currentRunLoop().addTimer_forMode_(self.timer, NSEventTrackingRunLoopMode)
+
+    def remove_observer(self, observer):
+        try:
+            self.streams.remove(observer)
+        except ValueError:
+            pass
+        if observer in self.observers:
+            self.observers.discard(observer)
+            self.notification_center.discard_observer(observer, sender=self, name='BlinkStreamStatisticsDidUpdate')
+
+        if not self.observers and self.timer is not None:
+            self.timer.invalidate()
+            self.timer = None
+
+    def updateTimer_(self, timer):
+        streams = list(self.streams)
+        for controller in streams:
+            try:
+                controller.updateStatistics()
+            except Exception as e:
+                BlinkLogger().log_error('Failed to update statistics of %s: %s' % (controller, e))
+        self.notification_center.post_notification('BlinkStreamStatisticsDidUpdate', sender=self, data=NotificationData(streams=streams, timestamp=time.time()))
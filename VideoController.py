@@ -11,12 +11,12 @@ from collections import deque
 from zope.interface import implementer
 from sipsimple.streams import MediaStreamRegistry
 from sipsimple.configuration.settings import SIPSimpleSettings
-from sipsimple.threading import run_in_thread
 
 
 from MediaStream import MediaStream, STREAM_IDLE, STREAM_PROPOSING, STREAM_INCOMING, STREAM_WAITING_DNS_LOOKUP, STREAM_FAILED, STREAM_RINGING, STREAM_DISCONNECTING, STREAM_CANCELLING, STREAM_CONNECTED, STREAM_CONNECTING
 from MediaStream import STATE_CONNECTING, STATE_CONNECTED, STATE_FAILED, STATE_DNS_FAILED, STATE_FINISHED
 from SessionInfoController import ice_candidates
+from StatisticsScheduler import STATISTICS_INTERVAL, StatisticsScheduler
 
 from VideoWindowController import VideoWindowController
 from VideoRecorder import VideoRecorder
@@ -26,7 +26,6 @@ import objc
 
 # For voice over IP over Ethernet, an RTP packet contains 54 bytes (or 432 bits) header. These 54 bytes consist of 14 bytes Ethernet header, 20 bytes IP header, 8 bytes UDP header and 12 bytes RTP header.
 RTP_PACKET_OVERHEAD = 54
-STATISTICS_INTERVAL = 1.0
 
 
 @implementer(IObserver)
@@ -40,7 +39,6 @@ class VideoController(MediaStream):
     previous_tx_packets = 0
     previous_rx_packets = 0
     all_rx_bytes = 0
-    statistics_timer = None
     last_stats = None
     initial_full_screen = False
     media_received = False
@@ -134,8 +132,8 @@ class VideoController(MediaStream):
 
         return self
 
-    @run_in_thread('video-io')
-    def updateStatisticsTimer_(self, timer):
+    @objc.python_method
+    def updateStatistics(self):
         if not self.stream:
             return
 
@@ -176,6 +174,8 @@ class VideoController(MediaStream):
             self.previous_rx_packets = stats['rx']['packets']
             self.previous_tx_packets = stats['tx']['packets']
 
+            self.addQoSSample(rtt, jitter, loss_rx, 0, self.statistics['rx_bytes'] * 8, self.statistics['tx_bytes'] * 8)
+
             # summarize statistics
             jitter = self.statistics['jitter']
             rtt = self.statistics['rtt']
@@ -194,6 +194,8 @@ class VideoController(MediaStream):
 
         self.last_stats = stats
 
+    @objc.python_method
+    def _NH_BlinkStreamStatisticsDidUpdate(self, sender, data):
         if self.all_rx_bytes > 200000 and not self.initial_full_screen and self.sessionController.video_consumer == "standalone":
             settings = SIPSimpleSettings()
             if settings.video.full_screen_after_connect:
@@ -563,9 +565,7 @@ class VideoController(MediaStream):
         self.changeStatus(STREAM_CONNECTED)
         self.sessionController.setVideoConsumer(self.sessionController.video_consumer)
 
-        self.statistics_timer = NSTimer.timerWithTimeInterval_target_selector_userInfo_repeats_(STATISTICS_INTERVAL, self, "updateStatisticsTimer:", None, True)
-        NSRunLoop.currentRunLoop().addTimer_forMode_(self.statistics_timer, NSRunLoopCommonModes)
-        NSRunLoop.currentRunLoop().addTimer_forMode_(self.statistics_timer, NSEventTrackingRunLoopMode)
+        StatisticsScheduler().add_observer(self, sample_statistics=True)
 
     @objc.python_method
     def _log_negotiated_video_fmtp(self):
@@ -694,6 +694,7 @@ class VideoController(MediaStream):
     @objc.python_method
     def _NH_MediaStreamWillEnd(self, sender, data):
         self.stopTimers()
+        self.saveQoSSamples()
         if self.videoWindowController:
             self.videoWindowController.goToWindowMode()
         self.ice_negotiation_status = None
@@ -783,10 +784,7 @@ class VideoController(MediaStream):
 
     @objc.python_method
     def stopTimers(self):
-        if self.statistics_timer is not None:
-            if self.statistics_timer.isValid():
-                self.statistics_timer.invalidate()
-            self.statistics_timer = None
+        StatisticsScheduler().remove_observer(self)
 
     @objc.python_method
     def stop_wait_for_camera_timer(self):
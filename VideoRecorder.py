@@ -23,7 +23,7 @@ from application.system import makedirs
 from sipsimple.configuration.settings import SIPSimpleSettings
 from util import run_in_gui_thread, format_identity_to_string
 from sipsimple.util import ISOTimestamp
-from HistoryManager import ChatHistory
+from HistoryManager import ChatHistory, RecordingHistory
 
 from BlinkLogger import BlinkLogger
 
@@ -106,6 +106,7 @@ class VideoRecorder(object):
         timestamp = str(ISOTimestamp.now())
         
         self.add_to_history(media_type, local_uri, remote_uri, direction, cpim_from, cpim_to, timestamp, message, status)
+        RecordingHistory().add_recording(filename, 'video', local_uri, remote_uri)
     
     def add_to_history(self,media_type, local_uri, remote_uri, direction, cpim_from, cpim_to, timestamp, message, status):
         ChatHistory().add_message(str(uuid.uuid1()), media_type, local_uri, remote_uri, direction, cpim_from, cpim_to, timestamp, message, "html", "0", status)
@@ -247,6 +247,7 @@ def _init_metal_once():
 from MediaStream import STREAM_CONNECTED, STREAM_IDLE, STREAM_FAILED
 from VideoLocalWindowController import VideoLocalWindowController
 from SIPManager import SIPManager
+from StatisticsScheduler import StatisticsScheduler
 from ZRTPAuthentication import ZRTPAuthentication
 
 from util import run_in_gui_thread
@@ -1250,15 +1251,10 @@ class VideoWindowController(NSWindowController):
         NSRunLoop.currentRunLoop().addTimer_forMode_(self.recording_timer, NSRunLoopCommonModes)
         NSRunLoop.currentRunLoop().addTimer_forMode_(self.recording_timer, NSEventTrackingRunLoopMode)
 
-        # Refresh the stats overlay once per second, in lockstep with
-        # VideoController.updateStatisticsTimer_ which recomputes the
-        # underlying RTT/codec/etc. on the same cadence.
-        self.stats_overlay_timer = NSTimer.timerWithTimeInterval_target_selector_userInfo_repeats_(
-            1.0, self, "updateStatsOverlayTimer:", None, True)
-        NSRunLoop.currentRunLoop().addTimer_forMode_(
-            self.stats_overlay_timer, NSRunLoopCommonModes)
-        NSRunLoop.currentRunLoop().addTimer_forMode_(
-            self.stats_overlay_timer, NSEventTrackingRunLoopMode)
+        # Refresh the stats overlay on every tick of the statistics
+        # scheduler, right after VideoController.updateStatistics has
+        # recomputed the underlying RTT/codec/etc.
+        StatisticsScheduler().add_observer(self)
 
     @objc.python_method
     def _setupStatsOverlay(self):
@@ -1378,7 +1374,7 @@ class VideoWindowController(NSWindowController):
             fps = 0
 
         # RTT — sc.statistics['rtt'] is already halved (one-way) in
-        # VideoController.updateStatisticsTimer_; show round-trip as
+        # VideoController.updateStatistics; show round-trip as
         # double for a more useful "what the user feels" number.
         rtt_ms = 0
         try:
@@ -1423,7 +1419,8 @@ class VideoWindowController(NSWindowController):
             return None
         return "  ".join(parts)
 
-    def updateStatsOverlayTimer_(self, timer):
+    @objc.python_method
+    def _NH_BlinkStreamStatisticsDidUpdate(self, sender, data):
         try:
             overlay = getattr(self, 'statsOverlay', None)
             if overlay is None or self.closed or self.will_close:
@@ -2307,10 +2304,7 @@ class VideoWindowController(NSWindowController):
 
     @objc.python_method
     def stopStatsOverlayTimer(self):
-        timer = getattr(self, 'stats_overlay_timer', None)
-        if timer is not None and timer.isValid():
-            timer.invalidate()
-        self.stats_overlay_timer = None
+        StatisticsScheduler().remove_observer(self)
 
     @objc.python_method
     def stopMouseOutTimer(self):
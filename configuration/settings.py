@@ -73,6 +73,7 @@ class ChatSettingsExtension(ChatSettings):
     enable_encryption = Setting(type=bool, default=True)
     font_size = Setting(type=int, default=0)
     enable_sms = Setting(type=bool, default=True)
+    location_update_interval = Setting(type=float, default=1.0)
 
 
 class ScreenSharingSettingsExtension(ScreenSharingSettings):
@@ -109,6 +110,14 @@ class LogsSettingsExtension(LogsSettings):
     trace_notifications_in_gui = Setting(type=bool, default=False)
     trace_notifications_to_file = Setting(type=bool, default=False)
 
+    fsync_on_error = Setting(type=bool, default=False)
+
+    # log files are rotated when they exceed the size (MB) or age (days), 0 disables the limit
+    max_file_size = Setting(type=NonNegativeInteger, default=50)
+    max_file_age = Setting(type=NonNegativeInteger, default=7)
+    max_rotated_files = Setting(type=NonNegativeInteger, default=10)
+    compress_rotated_files = Setting(type=bool, default=True)
+
 class ServerSettings(SettingsGroup):
     enrollment_url = Setting(type=HTTPURL, default="https://blink.sipthor.net/enrollment.phtml")
     # Collaboration editor taken from http://code.google.com/p/google-mobwrite/
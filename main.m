@@ -168,16 +168,26 @@ int main(int argc, char *argv[])
     setenv("PYTHONHOME", [pythonHome UTF8String], 1);
     setenv("PYTHONDONTWRITEBYTECODE", "1", 1);
 
+    // PGPDecryptionService starts the application executable with this
+    // argument to run its PGP decryption worker processes
+    NSString *mainFileName = @"Main";
+    for (int i = 1; i < argc; i++) {
+        if (strcmp(argv[i], "--pgp-decrypt-worker") == 0) {
+            mainFileName = @"PGPDecryptionWorker";
+            break;
+        }
+    }
+
     NSArray *possibleMainExtensions = [NSArray arrayWithObjects: @"py", @"pyc", @"pyo", nil];
     NSString *mainFilePath = nil;
 
     for (NSString *possibleMainExtension in possibleMainExtensions) {
-        mainFilePath = [mainBundle pathForResource: @"Main" ofType: possibleMainExtension];
+        mainFilePath = [mainBundle pathForResource: mainFileName ofType: possibleMainExtension];
         if ( mainFilePath != nil ) break;
     }
 
     if ( !mainFilePath ) {
-        [NSException raise: NSInternalInconsistencyException format: @"%s:%d main() Failed to find the Main.{py,pyc,pyo} file in the application wrapper's Resources directory.", __FILE__, __LINE__];
+        [NSException raise: NSInternalInconsistencyException format: @"%s:%d main() Failed to find the %@.{py,pyc,pyo} file in the application wrapper's Resources directory.", __FILE__, __LINE__, mainFileName];
     }
 
     Py_Initialize();
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+
+"""
+Report the QoS of past calls stored in Blink's history database.
+
+Without a session id, prints one line per call followed by the aggregate over
+all listed calls. With a session id, prints the samples of that call.
+"""
+
+import argparse
+import os
+import sqlite3
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from QoSStatistics import decode_qos_samples, loss_bursts, qos_report
+
+
+default_database = os.path.expanduser('~/Library/Application Support/Blink/history/history.sqlite')
+
+
+def print_samples(db, session_id, media_type, loss_threshold):
+    row = db.execute("select samples from session_qos where session_id = ? and media_type = ?", (session_id, media_type)).fetchone()
+    if row is None:
+        print('No %s QoS samples for session %s' % (media_type, session_id))
+        return
+    samples = decode_qos_samples(bytes(row[0]))
+    print('%8s %8s %8s %8s %8s %10s %10s' % ('offset', 'rtt', 'jitter', 'loss rx', 'loss tx', 'rx kbps', 'tx kbps'))
+    for sample in samples:
+        print('%8d %8d %8d %7.2f%% %7.2f%% %10.1f %10.1f' % (sample.offset, sample.rtt, sample.jitter, sample.loss_rx, sample.loss_tx, sample.rx_speed / 1000.0, sample.tx_speed / 1000.0))
+    for start, duration, peak in loss_bursts(samples, loss_threshold):
+        print('Loss burst at %ds lasting %ds, peak %.2f%%' % (start, duration, peak))
+
+
+def print_report(db, media_type, remote_uri, count, loss_threshold):
+    report = qos_report(db, media_type, remote_uri, count=count, loss_threshold=loss_threshold)
+    print('%-20s %-36s %6s %8s %8s %8s %7s' % ('start time', 'remote party', 'secs', 'rtt p95', 'jit p95', 'loss rx', 'bursts'))
+    for call in report['calls']:
+        print('%-20s %-36s %6d %8.0f %8.0f %7.2f%% %7d' % (str(call['start_time'])[:19], call['remote_uri'][:36], call['duration'], call['rtt_p95'], call['jitter_p95'], call['loss_rx_mean'], call['loss_bursts']))
+
+    aggregate = report['aggregate']
+    if aggregate is None:
+        print('No calls with %s QoS samples' % media_type)
+        return
+    print()
+    print('Calls: %(calls)d, total duration %(duration)ds, calls with loss bursts: %(calls_with_loss_bursts)d' % aggregate)
+    print('RTT p95 across calls: median %(rtt_p95_p50).0f ms, p95 %(rtt_p95_p95).0f ms' % aggregate)
+    print('Jitter p95 across calls: median %(jitter_p95_p50).0f ms, p95 %(jitter_p95_p95).0f ms' % aggregate)
+    print('Mean RX loss across calls: median %(loss_rx_mean_p50).2f%%, p95 %(loss_rx_mean_p95).2f%%' % aggregate)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('session_id', nargs='?', help='print the samples of this session')
+    parser.add_argument('--database', default=default_database, help='path to history.sqlite (default: %(default)s)')
+    parser.add_argument('--media', default='audio', choices=('audio', 'video'), help='media type (default: %(default)s)')
+    parser.add_argument('--remote-uri', help='only report calls with this remote party')
+    parser.add_argument('--count', type=int, default=100, help='number of most recent calls to report (default: %(default)s)')
+    parser.add_argument('--loss-threshold', type=float, default=3.0, help='packet loss percentage starting a loss burst (default: %(default)s)')
+    options = parser.parse_args()
+
+    db = sqlite3.connect('file:%s?mode=ro' % options.database, uri=True)
+    try:
+        if options.session_id:
+            print_samples(db, options.session_id, options.media, options.loss_threshold)
+        else:
+            print_report(db, options.media, options.remote_uri, options.count, options.loss_threshold)
+    finally:
+        db.close()
+
+
+if __name__ == '__main__':
+    main()
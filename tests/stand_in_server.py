@@ -0,0 +1,42 @@
+"""
+Stand-in HTTP servers for the tests of code that talks to a remote service.
+
+Importing this module also makes the application modules importable.
+"""
+
+import http.server
+import os
+import sys
+import threading
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+
+class StandInHandler(http.server.BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+class StandInServer(http.server.HTTPServer):
+    """Serves handler_class on a free local port, path is the path of url"""
+
+    handler_class = StandInHandler
+    path = '/'
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), self.handler_class)
+        self.requests = []
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d%s' % (self.server_address[1], self.path)
+
+
+class StandInServerTestCase(unittest.TestCase):
+    def start_server(self, server):
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        return server
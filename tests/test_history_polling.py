@@ -0,0 +1,102 @@
+"""
+Conditional polling of the call history against a stand-in CDRTool server.
+"""
+
+import hashlib
+import json
+import unittest
+import urllib.error
+import urllib.request
+
+from stand_in_server import StandInHandler, StandInServer, StandInServerTestCase
+
+from HistoryPolling import ConditionalPoll, POLL_MODIFIED, POLL_NOT_MODIFIED, POLL_UNCHANGED
+
+
+class CDRToolHandler(StandInHandler):
+    def do_GET(self):
+        server = self.server
+        server.requests.append(dict(self.headers))
+        body = json.dumps(server.history).encode()
+        etag = '"%s"' % hashlib.sha1(body).hexdigest()
+        if server.validators and self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        if server.validators:
+            self.send_header('ETag', etag)
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class CDRToolServer(StandInServer):
+    handler_class = CDRToolHandler
+    path = '/?action=get_history&realm=example.com'
+
+    def __init__(self, validators=True):
+        super().__init__()
+        self.validators = validators
+        self.history = {'received': [], 'placed': []}
+
+
+def poll_once(poll, url):
+    request = urllib.request.Request(url, headers=poll.request_headers())
+    try:
+        with urllib.request.urlopen(request, timeout=5) as response:
+            return poll.response_received(response.status, dict(response.headers), response.read())
+    except urllib.error.HTTPError as e:
+        return poll.response_received(e.code, dict(e.headers), e.read())
+
+
+class ConditionalPollTests(StandInServerTestCase):
+    def start_server(self, validators=True):
+        return super().start_server(CDRToolServer(validators))
+
+    def test_not_modified_with_validators(self):
+        server = self.start_server()
+        poll = ConditionalPoll(300, 3600)
+        self.assertEqual(poll_once(poll, server.url), POLL_MODIFIED)
+        poll.applied(True)
+        self.assertEqual(poll_once(poll, server.url), POLL_NOT_MODIFIED)
+        self.assertIn('If-None-Match', server.requests[-1])
+
+        server.history['received'].append({'callId': '1', 'fromTag': 'a'})
+        self.assertEqual(poll_once(poll, server.url), POLL_MODIFIED)
+
+    def test_unchanged_without_validators(self):
+        server = self.start_server(validators=False)
+        poll = ConditionalPoll(300, 3600)
+        self.assertEqual(poll_once(poll, server.url), POLL_MODIFIED)
+        poll.applied(True)
+        self.assertEqual(poll_once(poll, server.url), POLL_UNCHANGED)
+        self.assertNotIn('If-None-Match', server.requests[-1])
+
+    def test_failed_document_is_applied_again(self):
+        server = self.start_server()
+        poll = ConditionalPoll(300, 3600)
+        self.assertEqual(poll_once(poll, server.url), POLL_MODIFIED)
+        poll.applied(False)
+        self.assertEqual(poll.request_headers(), {})
+        self.assertEqual(poll_once(poll, server.url), POLL_MODIFIED)
+        poll.applied(True)
+        self.assertEqual(poll_once(poll, server.url), POLL_NOT_MODIFIED)
+
+    def test_document_is_not_skipped_before_it_is_applied(self):
+        server = self.start_server(validators=False)
+        poll = ConditionalPoll(300, 3600)
+        self.assertEqual(poll_once(poll, server.url), POLL_MODIFIED)
+        # the next poll happens while the previous document is still being applied
+        self.assertEqual(poll_once(poll, server.url), POLL_MODIFIED)
+
+    def test_backoff(self):
+        poll = ConditionalPoll(300, 3600)
+        self.assertEqual([poll.next_interval(False) for i in range(5)], [600, 1200, 2400, 3600, 3600])
+        self.assertEqual(poll.next_interval(True), 300)
+        self.assertEqual(poll.next_interval(False), 600)
+
+
+if __name__ == '__main__':
+    unittest.main()
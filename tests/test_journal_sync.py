@@ -0,0 +1,189 @@
+"""
+Paged sync of the SylkServer message journal against a stand-in server.
+"""
+
+import json
+import unittest
+import urllib.parse
+
+from stand_in_server import StandInHandler, StandInServer, StandInServerTestCase
+
+from JournalStream import JournalStreamParser, journal_page_url, sync_journal_page, sync_journal_pages
+
+
+PAGE_SIZE = 10
+COMMIT_SIZE = 4
+TOKEN = 'secret'
+
+
+class SylkServerHandler(StandInHandler):
+    def do_GET(self):
+        server = self.server
+        url = urllib.parse.urlsplit(self.path)
+        server.requests.append(self.path)
+        if self.headers.get('Authorization') != 'Apikey %s' % server.token:
+            self.send_response(401)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        parts = url.path.strip('/').split('/')
+        last_id = parts[3] if len(parts) > 3 else None
+        limit = dict(urllib.parse.parse_qsl(url.query)).get('limit')
+
+        messages = server.journal
+        if last_id is not None:
+            index = next(i for i, message in enumerate(messages) if message['message_id'] == last_id)
+            messages = messages[index + 1:]
+        if limit is not None and server.honor_limit:
+            messages = messages[:int(limit)]
+
+        body = json.dumps({'success': True, 'messages': messages}).encode()
+        if server.truncate:
+            body = body[:len(body) // 2]
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        # small writes, so the client parses the response while it is still arriving
+        for i in range(0, len(body), 97):
+            self.wfile.write(body[i:i+97])
+            self.wfile.flush()
+
+
+class SylkServer(StandInServer):
+    handler_class = SylkServerHandler
+    path = '/messages/history/alice@example.com'
+
+    def __init__(self, count, honor_limit=True, truncate=False):
+        super().__init__()
+        self.honor_limit = honor_limit
+        self.truncate = truncate
+        self.token = TOKEN
+        self.journal = [{'message_id': 'm%04d' % i, 'contact': 'bob@example.com', 'content_type': 'text/plain', 'content': 'message %d' % i} for i in range(count)]
+
+
+class JournalAccount(object):
+    """Keeps history_last_id the way SMSWindowManager keeps it in the account settings"""
+
+    def __init__(self, url, token=TOKEN):
+        self.url = url
+        self.token = token
+        self.history_last_id = None
+        self.applied = []
+        self.commits = []
+
+    def apply(self, message):
+        self.applied.append(message['message_id'])
+        return message['message_id']
+
+    def commit(self, last_message_id):
+        self.commits.append(last_message_id)
+        if last_message_id:
+            self.history_last_id = last_message_id
+
+    def sync_page(self):
+        url = journal_page_url(self.url, self.history_last_id, PAGE_SIZE)
+        page = sync_journal_page(url, {'Authorization': 'Apikey %s' % self.token}, self.apply, self.commit, COMMIT_SIZE, read_size=64, timeout=5)
+        return page.result, page.applied
+
+    def sync(self):
+        return sync_journal_pages(self.sync_page, PAGE_SIZE)
+
+
+class JournalSyncTests(StandInServerTestCase):
+    def start_server(self, count, **kw):
+        return super().start_server(SylkServer(count, **kw))
+
+    def test_pages(self):
+        server = self.start_server(25)
+        account = JournalAccount(server.url)
+        self.assertEqual(account.sync(), ('complete', 25))
+        self.assertEqual(account.applied, [message['message_id'] for message in server.journal])
+        self.assertEqual(account.history_last_id, 'm0024')
+        self.assertEqual(server.requests, ['/messages/history/alice%%40example.com?limit=%d' % PAGE_SIZE,
+                                           '/messages/history/alice%%40example.com/m0009?limit=%d' % PAGE_SIZE,
+                                           '/messages/history/alice%%40example.com/m0019?limit=%d' % PAGE_SIZE])
+
+    def test_commits(self):
+        server = self.start_server(PAGE_SIZE)
+        account = JournalAccount(server.url)
+        result, applied = account.sync_page()
+        self.assertEqual((result, applied), ('complete', PAGE_SIZE))
+        # every COMMIT_SIZE entries and once at the end of the page
+        self.assertEqual(account.commits, ['m0003', 'm0007', 'm0009'])
+
+    def test_last_page_full(self):
+        server = self.start_server(20)
+        account = JournalAccount(server.url)
+        self.assertEqual(account.sync(), ('complete', 20))
+        # the empty page tells that the journal is exhausted
+        self.assertEqual(len(server.requests), 3)
+        self.assertEqual(account.commits[-1], None)
+        self.assertEqual(account.history_last_id, 'm0019')
+
+    def test_resume(self):
+        server = self.start_server(15)
+        account = JournalAccount(server.url)
+        account.sync()
+        server.journal.extend({'message_id': 'n%d' % i, 'contact': 'bob@example.com', 'content_type': 'text/plain', 'content': ''} for i in range(3))
+        self.assertEqual(account.sync(), ('complete', 3))
+        self.assertEqual(account.applied[-3:], ['n0', 'n1', 'n2'])
+        self.assertTrue(server.requests[-1].endswith('/m0014?limit=%d' % PAGE_SIZE))
+
+    def test_server_ignoring_limit(self):
+        server = self.start_server(25, honor_limit=False)
+        account = JournalAccount(server.url)
+        self.assertEqual(account.sync(), ('complete', 25))
+        self.assertEqual(len(server.requests), 1)
+
+    def test_truncated_response(self):
+        server = self.start_server(25, truncate=True)
+        account = JournalAccount(server.url)
+        result, count = account.sync()
+        self.assertEqual(result, 'failed')
+        self.assertEqual(len(server.requests), 1)
+        # entries received before the response broke off are applied and committed
+        self.assertEqual(account.applied, [message['message_id'] for message in server.journal[:count]])
+        self.assertTrue(0 < count < PAGE_SIZE)
+        self.assertEqual(account.history_last_id, account.applied[-1])
+
+    def test_unauthorized(self):
+        server = self.start_server(5)
+        account = JournalAccount(server.url, token='expired')
+        self.assertEqual(account.sync(), ('unauthorized', 0))
+        self.assertEqual(account.applied, [])
+
+    def test_connection_refused(self):
+        server = self.start_server(5)
+        url = server.url
+        server.shutdown()
+        server.server_close()
+        account = JournalAccount(url)
+        self.assertEqual(account.sync(), ('failed', 0))
+
+
+class JournalStreamParserTests(unittest.TestCase):
+    def test_byte_by_byte(self):
+        document = json.dumps({'success': True, 'messages': [{'message_id': 'a', 'content': 'café'}, {'message_id': 'b', 'content': [1, 2]}], 'total': 2}).encode()
+        parser = JournalStreamParser(streamed_key='messages')
+        results = []
+        for i in range(len(document)):
+            parser.feed(document[i:i+1])
+            results.extend(parser.pop_results())
+        self.assertTrue(parser.complete)
+        self.assertIsNone(parser.error)
+        self.assertEqual([message['message_id'] for message in results], ['a', 'b'])
+        self.assertEqual(results[0]['content'], 'café')
+        self.assertEqual(parser.members['total'], 2)
+        self.assertEqual(parser.bytes_received, len(document))
+
+    def test_invalid(self):
+        parser = JournalStreamParser(streamed_key='messages')
+        parser.feed(b'[1, 2]')
+        self.assertIsNotNone(parser.error)
+
+
+if __name__ == '__main__':
+    unittest.main()